@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+
+import os
+import math
+import time
+from glob import glob
+from functools import partial
+from typing import List
+import numpy as np
+import tensorflow as tf
+from .config import Params, INPUT_PIPELINE_KEYS
+from .data_handler import parse_example
+
+# Number of examples parsed per timed run when probing the parsing cost
+_PROBE_PARSE_BATCH = 8
+
+
+def available_cpus() -> int:
+    """Number of CPUs this process can run on"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        # Not available on all platforms
+        return os.cpu_count() or 1
+
+
+def _probe_session() -> tf.Session:
+    # The probes run on CPU only, in order not to reserve GPU memory before the training
+    return tf.Session(config=tf.ConfigProto(device_count={'GPU': 0}))
+
+
+def _time_dataset(dataset: tf.data.Dataset, n_runs: int) -> List[float]:
+    next_element = dataset.make_one_shot_iterator().get_next()
+    times = list()
+    with _probe_session() as session:
+        session.run(next_element)  # warm up
+        for _ in range(n_runs):
+            start = time.perf_counter()
+            session.run(next_element)
+            times.append(time.perf_counter() - start)
+    return times
+
+
+def probe_input_pipeline(filename: str, output_shape: tuple, data_augmentation: bool, n_records: int=256) -> dict:
+    """
+    Measures the cost of the stages of the input pipeline on the first records of a tfrecords file
+    :param filename: tfrecords file
+    :param output_shape: (height, width) of the images
+    :param data_augmentation: parse with data augmentation
+    :param n_records: number of records read
+    :return: dict with the mean size of the records, the read throughput of a single file and the single threaded
+        parsing time per example (mean and percentiles)
+    """
+    with tf.Graph().as_default():
+        records = tf.data.TFRecordDataset(filename).take(n_records).batch(n_records)
+        next_records = records.make_one_shot_iterator().get_next()
+        with _probe_session() as session:
+            start = time.perf_counter()
+            serialized = session.run(next_records)
+            read_time = time.perf_counter() - start
+
+    n_records = len(serialized)
+    with tf.Graph().as_default():
+        ds = (tf.data.Dataset.from_tensor_slices(serialized)
+              .repeat()
+              .map(partial(parse_example, output_shape=output_shape, data_augmentation=data_augmentation),
+                   num_parallel_calls=1)
+              .batch(_PROBE_PARSE_BATCH))
+        parse_times = np.asarray(_time_dataset(ds, max(1, n_records // _PROBE_PARSE_BATCH))) / _PROBE_PARSE_BATCH
+
+    parse_times_ms = 1000 * parse_times
+    return {'record_bytes': float(np.mean([len(s) for s in serialized])),
+            'read_records_per_sec': n_records / read_time,
+            'parse_ms_per_example': {'mean': float(np.mean(parse_times_ms)),
+                                     'p50': float(np.percentile(parse_times_ms, 50)),
+                                     'p90': float(np.percentile(parse_times_ms, 90)),
+                                     'p99': float(np.percentile(parse_times_ms, 99))}}
+
+
+def autotune_input_pipeline(params: Params, n_records: int=256, memory_budget_mb: int=1024) -> dict:
+    """
+    Chooses the parallelism parameters of the input pipeline from the number of CPUs of the host and
+    the measured cost of reading and parsing the training records (see `probe_input_pipeline`)
+    :param params: parameters of the experiment, only the parameters set to 'auto' are chosen
+    :param n_records: number of records used for the measurements
+    :param memory_budget_mb: host memory for the shuffle (half) and prefetch (half) buffers
+    :return: dict with the chosen 'values', the 'host' description and the 'probe' measurements
+    """
+    filenames = glob(params.tfrecords_train)
+    if not filenames:
+        raise FileNotFoundError('No tfrecords found with {}'.format(params.tfrecords_train))
+
+    cpus = available_cpus()
+    try:
+        on_gpu = int(params.gpu.split(',')[0]) >= 0
+    except ValueError:
+        on_gpu = False
+    budget_bytes = memory_budget_mb * 2**20
+
+    # Parsing is CPU bound. When training on GPU keep one core for the trainer,
+    # when training on CPU leave half of the cores to the model
+    num_parallel_calls = max(1, cpus - 1) if on_gpu else max(1, cpus // 2)
+    batch_bytes = params.train_batch_size * params.input_shape[0] * params.input_shape[1] * 4
+
+    if params.packed_input:
+        # Packed datasets are not read from tfrecords files (cycle_length, block_length and shuffle_buffer_size
+        # are not used) and need no decoding, there is nothing to probe
+        chosen = {'cycle_length': 1,
+                  'block_length': 1,
+                  'shuffle_buffer_size': params.train_batch_size,
+                  'num_parallel_calls': num_parallel_calls,
+                  'prefetch_buffer_size': int(max(1, min(2, budget_bytes / 2 // batch_bytes)))}
+        return {'values': {key: chosen[key] for key in INPUT_PIPELINE_KEYS if getattr(params, key) == 'auto'},
+                'host': {'cpus': cpus, 'on_gpu': on_gpu, 'n_files': len(filenames)},
+                'probe': None}
+
+    probe = probe_input_pipeline(filenames[0], params.input_shape, params.data_augmentation, n_records)
+    parse_time = probe['parse_ms_per_example']['mean'] / 1000
+
+    # Read enough files in parallel to feed the parsing, and at least one per parsing thread to mix the files
+    n_readers = math.ceil((num_parallel_calls / parse_time) / probe['read_records_per_sec'])
+    cycle_length = max(1, min(len(filenames), max(n_readers, num_parallel_calls)))
+    # A batch takes records from every file read in parallel
+    block_length = max(1, min(16, params.train_batch_size // cycle_length))
+
+    # Shuffle buffer holds serialized records
+    shuffle_buffer_size = int(max(params.train_batch_size, min(10000, budget_bytes / 2 / probe['record_bytes'])))
+
+    # Prefetch enough batches to absorb the variability of the parsing time, within the memory budget
+    jitter = probe['parse_ms_per_example']['p99'] / probe['parse_ms_per_example']['p50']
+    prefetch_buffer_size = int(max(1, min(math.ceil(jitter) + 1, budget_bytes / 2 // batch_bytes)))
+
+    chosen = {'cycle_length': cycle_length,
+              'block_length': block_length,
+              'shuffle_buffer_size': shuffle_buffer_size,
+              'num_parallel_calls': num_parallel_calls,
+              'prefetch_buffer_size': prefetch_buffer_size}
+
+    return {'values': {key: chosen[key] for key in INPUT_PIPELINE_KEYS if getattr(params, key) == 'auto'},
+            'host': {'cpus': cpus, 'on_gpu': on_gpu, 'n_files': len(filenames)},
+            'probe': probe}
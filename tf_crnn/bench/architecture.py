@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+import os
+import json
+import time
+import argparse
+import numpy as np
+import tensorflow as tf
+from ..config import Params, import_params_from_json
+from ..model import crnn_fn, deep_cnn, deep_bidirectional_lstm
+from ..data_handler import make_input_fn
+from .helpers import time_fetches, summarize_times
+
+
+def line_latency(params: Params, checkpoint: str, width: int, n_steps: int) -> dict:
+    """
+    Measures the time of the forward pass of the network (CNN and recurrent layers, without decoding) on a single
+    line of the given width, on the devices visible to the session
+    :param params: parameters of the model
+    :param checkpoint: checkpoint of the model, random weights if None
+    :param width: width (in pixels) of the line
+    :param n_steps: number of timed runs
+    :return: summary of the times (see `summarize_times`) and number of parameters of the network
+    """
+    height = params.input_shape[0]
+    params.keep_prob_dropout = 1.0
+    with tf.Graph().as_default():
+        image = tf.random_uniform([1, height, width, 1], maxval=255.)
+        conv = deep_cnn(image, is_training=False, summaries=False, channels=params.cnn_channels,
+                        separable=params.separable_convolutions)
+        logits, _ = deep_bidirectional_lstm(conv, tf.zeros([1], dtype=tf.int64), params=params,
+                                            sequence_length=tf.constant([width // 4 - 1]), summaries=False)
+        n_parameters = int(np.sum([np.prod(var.get_shape().as_list()) for var in tf.trainable_variables()]))
+
+        with tf.Session() as session:
+            session.run(tf.global_variables_initializer())
+            if checkpoint is not None:
+                tf.train.Saver(tf.global_variables()).restore(session, checkpoint)
+            times = time_fetches(session, logits, n_steps)
+
+    results = summarize_times(times)
+    results['n_parameters'] = n_parameters
+    return results
+
+
+def evaluate_model(params: Params) -> dict:
+    """:return: evaluation metrics of the latest checkpoint of the model on its tfrecords_eval"""
+    estimator = tf.estimator.Estimator(model_fn=crnn_fn, params={'Params': params},
+                                       model_dir=params.output_model_dir)
+    input_fn = make_input_fn(params.tfrecords_eval, params.eval_batch_size, params.input_shape,
+                             repeat=False, bucket_width_step=params.bucket_width_step, shuffle=False,
+                             encoded_labels=params.encoded_labels, packed=params.packed_input)
+    return {key: float(value) for key, value in estimator.evaluate(input_fn=input_fn).items()}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Reports the accuracy and the latency per line of models of '
+                                                 'different architectures (cnn_channels, separable_convolutions, '
+                                                 'lstm_hidden), e.g a teacher and its distilled students')
+    parser.add_argument('params_files', type=str, nargs='+',
+                        help='Parameters (JSON) of each model, its latest checkpoint in output_model_dir is used')
+    parser.add_argument('-w', '--width', type=int, default=256, help='Width of the line for the latency')
+    parser.add_argument('-n', '--n_steps', type=int, default=50, help='Number of timed runs')
+    parser.add_argument('--no_eval', action='store_true', help='Only measure the latency')
+    parser.add_argument('--cpu', action='store_true', help='Measure the latency on CPU (hide the GPUs)')
+    parser.add_argument('-o', '--output', type=str, default='architecture_benchmark_{}.json'.format(round(time.time())),
+                        help='Filename of the JSON report')
+    args = parser.parse_args()
+
+    if args.cpu:
+        os.environ['CUDA_VISIBLE_DEVICES'] = ''
+
+    report = dict()
+    for params_file in args.params_files:
+        params = Params(**import_params_from_json(json_filename=params_file))
+        checkpoint = tf.train.latest_checkpoint(params.output_model_dir)
+        report[params_file] = {'architecture': {'cnn_channels': params.cnn_channels,
+                                                'separable_convolutions': params.separable_convolutions,
+                                                'lstm_hidden': params.lstm_hidden,
+                                                'rnn_implementation': params.rnn_implementation},
+                               'checkpoint': checkpoint,
+                               'latency': line_latency(params, checkpoint, args.width, args.n_steps)}
+        if not args.no_eval and checkpoint is not None:
+            report[params_file]['metrics'] = evaluate_model(params)
+
+        metrics = report[params_file].get('metrics', dict())
+        print('{}: {:>10} parameters, p50 {:>8.2f} ms per line, CER {}, accuracy {}'.format(
+            params_file, report[params_file]['latency']['n_parameters'], report[params_file]['latency']['p50_ms'],
+            metrics.get('eval/CER'), metrics.get('eval/accuracy')))
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('Report written to {}'.format(args.output))
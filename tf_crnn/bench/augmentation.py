@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+
+import os
+import argparse
+import tempfile
+from glob import glob
+from functools import partial
+import tensorflow as tf
+from ..data_handler import parse_example
+from .helpers import time_fetches, summarize_times, write_synthetic_tfrecords
+
+
+def parsing_throughput(filenames: list, output_shape: tuple, data_augmentation: bool, batch_size: int,
+                       num_parallel_calls: int, n_steps: int) -> dict:
+    """
+    Measures the throughput of the parsing of the examples (decoding, optional augmentation, resizing and padding)
+    :param filenames: tfrecords files
+    :param output_shape: (height, width) of the parsed images
+    :param data_augmentation: apply the data augmentation
+    :param batch_size: number of examples per timed run
+    :param num_parallel_calls: number of examples parsed in parallel
+    :param n_steps: number of timed runs
+    :return: summary of the times (see `summarize_times`)
+    """
+    with tf.Graph().as_default():
+        ds = (tf.data.TFRecordDataset(filenames)
+              .repeat()
+              .map(partial(parse_example, output_shape=output_shape, data_augmentation=data_augmentation),
+                   num_parallel_calls=num_parallel_calls)
+              .batch(batch_size)
+              .prefetch(1))
+        features, labels = ds.make_one_shot_iterator().get_next()
+
+        with tf.Session() as session:
+            times = time_fetches(session, [features, labels], n_steps)
+
+    return summarize_times(times, n_examples_per_run=batch_size)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compares the throughput of the training (augmented) and '
+                                                 'evaluation (deterministic) parsing of the examples')
+    parser.add_argument('-t', '--tfrecords', type=str, help='Glob of tfrecords files (synthetic data if not given)')
+    parser.add_argument('--n_synthetic', type=int, default=2000, help='Number of synthetic examples')
+    parser.add_argument('--input_shape', type=int, nargs=2, default=[32, 256], help='Height and width of the images')
+    parser.add_argument('-b', '--batch_size', type=int, default=64, help='Number of examples per timed run')
+    parser.add_argument('-p', '--num_parallel_calls', type=int, default=4, help='Examples parsed in parallel')
+    parser.add_argument('-n', '--n_steps', type=int, default=50, help='Number of timed runs')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if args.tfrecords:
+            filenames = glob(args.tfrecords)
+        else:
+            filenames = [os.path.join(tmp_dir, 'synthetic.tfrecords')]
+            write_synthetic_tfrecords(filenames[0], args.n_synthetic)
+
+        results = dict()
+        for name, augmentation in [('augmented', True), ('deterministic', False)]:
+            results[name] = parsing_throughput(filenames, tuple(args.input_shape), augmentation, args.batch_size,
+                                               args.num_parallel_calls, args.n_steps)
+            print('{:<13}: {}'.format(name, results[name]))
+
+    print('Throughput ratio deterministic / augmented: {:.2f}x'.format(
+        results['deterministic']['examples_per_sec'] / results['augmented']['examples_per_sec']))
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+
+import argparse
+import tensorflow as tf
+from ..decoding import ctc_decode
+from ..config import Params, CONST
+from .helpers import time_fetches, summarize_times
+
+
+def decoding_step_time(decoder: str, batch_size: int, width: int, n_classes: int, beam_width: int,
+                       top_paths: int, n_steps: int) -> dict:
+    """
+    Measures the time spent decoding a batch of network outputs
+    :param decoder: 'greedy' or 'beam'
+    :param batch_size: number of sequences per batch
+    :param width: width (in pixels) of the images of the batch
+    :param n_classes: number of classes (including blank)
+    :param beam_width: width of the beam
+    :param top_paths: number of paths returned by the beam search
+    :param n_steps: number of timed steps
+    :return: summary of the step times (see `summarize_times`)
+    """
+    max_time = width // CONST.DIMENSION_REDUCTION_W_POOLING - 1
+
+    with tf.Graph().as_default():
+        # Random logits are kept in a variable so that their generation is not timed
+        logits = tf.Variable(tf.random_normal([max_time, batch_size, n_classes], stddev=3.0), trainable=False)
+        sequence_length = tf.fill([batch_size], max_time)
+        decoded, log_probability = ctc_decode(logits, sequence_length, decoder=decoder,
+                                              beam_width=beam_width, top_paths=top_paths)
+
+        with tf.Session() as session:
+            session.run(tf.global_variables_initializer())
+            times = time_fetches(session, [d.values for d in decoded] + [log_probability], n_steps)
+
+    return summarize_times(times, n_examples_per_run=batch_size)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compares the time spent by the CTC decoders for one batch')
+    parser.add_argument('-b', '--batch_size', type=int, default=512, help='Number of images per batch')
+    parser.add_argument('-w', '--width', type=int, default=256, help='Width of the images')
+    parser.add_argument('--beam_width', type=int, default=100, help='Width of the beam')
+    parser.add_argument('--top_paths', type=int, default=20, help='Number of paths of the beam search (nb_logprob)')
+    parser.add_argument('-n', '--n_steps', type=int, default=10, help='Number of timed steps')
+    args = parser.parse_args()
+
+    n_classes = Params(alphabet='letters_digits_extended').n_classes
+
+    results = dict()
+    for decoder in ['greedy', 'beam']:
+        results[decoder] = decoding_step_time(decoder, args.batch_size, args.width, n_classes, args.beam_width,
+                                              args.top_paths, args.n_steps)
+        print('{:<7}: {}'.format(decoder, results[decoder]))
+
+    print('Saved per step with greedy decoding: {:.1f} ms'.format(results['beam']['mean_ms']
+                                                                  - results['greedy']['mean_ms']))
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+
+import time
+import argparse
+import tensorflow as tf
+from ..elastic_helpers import tf_distortion_maps, DistortionFieldBank
+from .helpers import time_fetches, summarize_times
+
+
+def distortion_step_time(batch_size: int, height: int, width: int, field_bank: DistortionFieldBank,
+                         n_steps: int) -> dict:
+    """
+    Measures the time to distort a batch of images kept in memory
+    :param batch_size: number of images per batch
+    :param height: height of the images
+    :param width: width of the images
+    :param field_bank: bank to sample the displacement fields from (None : generated at each step)
+    :param n_steps: number of timed steps
+    :return: summary of the step times (see `summarize_times`)
+    """
+    with tf.Graph().as_default():
+        images = tf.Variable(tf.random_uniform([batch_size, height, width, 1], 0, 255), trainable=False)
+        distorted = tf_distortion_maps(images, field_bank)
+
+        with tf.Session() as session:
+            session.run(tf.global_variables_initializer())
+            times = time_fetches(session, distorted, n_steps)
+
+    return summarize_times(times, n_examples_per_run=batch_size)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compares the step time of the elastic distortion generated '
+                                                 'on the fly and sampled from a bank of precomputed fields')
+    parser.add_argument('-b', '--batch_size', type=int, default=128, help='Number of images per batch')
+    parser.add_argument('--input_shape', type=int, nargs=2, default=[32, 256], help='Height and width of the images')
+    parser.add_argument('--bank_size', type=int, default=256, help='Number of fields in the bank')
+    parser.add_argument('-n', '--n_steps', type=int, default=20, help='Number of timed steps')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    bank = DistortionFieldBank(args.bank_size, *args.input_shape)
+    print('Bank of {} fields generated in {:.1f} s'.format(args.bank_size, time.perf_counter() - start))
+
+    on_the_fly = distortion_step_time(args.batch_size, *args.input_shape, None, args.n_steps)
+    from_bank = distortion_step_time(args.batch_size, *args.input_shape, bank, args.n_steps)
+
+    print('On the fly :', on_the_fly)
+    print('From bank  :', from_bank)
+    print('Speedup (mean step time): {:.2f}x'.format(on_the_fly['mean_ms'] / from_bank['mean_ms']))
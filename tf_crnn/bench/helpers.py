@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+import time
+import numpy as np
+import tensorflow as tf
+from typing import List, Tuple
+
+
+def time_fetches(session: tf.Session, fetches, n_steps: int, n_warmup: int=3, feed_dict: dict=None) -> List[float]:
+    """
+    Runs `fetches` several times and measures the duration of each run
+    :param session: session to run the fetches in
+    :param fetches: fetches passed to `session.run`
+    :param n_steps: number of timed runs
+    :param n_warmup: number of runs done before timing (graph optimizations, memory allocation...)
+    :param feed_dict: feed_dict passed to `session.run`
+    :return: list of durations in seconds
+    """
+    for _ in range(n_warmup):
+        session.run(fetches, feed_dict=feed_dict)
+
+    times = list()
+    for _ in range(n_steps):
+        start = time.perf_counter()
+        session.run(fetches, feed_dict=feed_dict)
+        times.append(time.perf_counter() - start)
+
+    return times
+
+
+def summarize_times(times: List[float], n_examples_per_run: int=None) -> dict:
+    """
+    Computes statistics of the durations measured with `time_fetches`
+    :param times: list of durations in seconds
+    :param n_examples_per_run: if given, the throughput in examples/sec is added
+    :return: dict with mean and percentiles of the durations in milliseconds
+    """
+    times_ms = 1000 * np.asarray(times)
+    summary = {'mean_ms': float(np.mean(times_ms)),
+               'p50_ms': float(np.percentile(times_ms, 50)),
+               'p90_ms': float(np.percentile(times_ms, 90)),
+               'p99_ms': float(np.percentile(times_ms, 99))}
+    if n_examples_per_run is not None:
+        summary['examples_per_sec'] = float(n_examples_per_run * len(times) / np.sum(times))
+
+    return summary
+
+
+def _bytes_feature(value: bytes) -> tf.train.Feature:
+    return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
+
+
+def _int64_feature(value: int) -> tf.train.Feature:
+    return tf.train.Feature(int64_list=tf.train.Int64List(value=[value]))
+
+
+def write_synthetic_tfrecords(filename: str, n_examples: int, height_range: Tuple[int, int]=(48, 128),
+                              width_range: Tuple[int, int]=(64, 1024), num_corpora: int=1,
+                              characters: str='0123456789abcdefghijklmnopqrstuvwxyz', seed: int=0) -> None:
+    """
+    Writes a tfrecords file of random grayscale images of text lines sizes, following `data_handler.feature_spec`.
+    The labels are random strings short enough to be decoded from the resized images
+    :param filename: output filename
+    :param n_examples: number of examples to write
+    :param height_range: range of the heights of the images
+    :param width_range: range of the widths of the images
+    :param num_corpora: corpus ids are drawn in [0, num_corpora)
+    :param characters: characters of the labels
+    :param seed: seed of the random generator
+    """
+    rng = np.random.RandomState(seed)
+
+    with tf.Graph().as_default():
+        image_placeholder = tf.placeholder(tf.uint8, shape=[None, None, 1])
+        encoded_png = tf.image.encode_png(image_placeholder)
+
+        with tf.Session() as session, tf.python_io.TFRecordWriter(filename) as writer:
+            for _ in range(n_examples):
+                height, width = rng.randint(*height_range), rng.randint(*width_range)
+                # White background with dark noise
+                image = np.full([height, width, 1], 255, dtype=np.uint8)
+                noise = rng.rand(height, width) < 0.1
+                image[noise, 0] = rng.randint(0, 128, size=np.sum(noise))
+
+                # Keep the label decodable from a 32 pixels high image
+                max_label_length = max(1, int(width * 32 / height) // 8)
+                label = ''.join(rng.choice(list(characters), size=rng.randint(1, max_label_length + 1)))
+
+                example = tf.train.Example(features=tf.train.Features(feature={
+                    'image_raw': _bytes_feature(session.run(encoded_png, feed_dict={image_placeholder: image})),
+                    'label': _bytes_feature(label.encode('latin1')),
+                    'corpus': _int64_feature(int(rng.randint(num_corpora)))
+                }))
+                writer.write(example.SerializeToString())
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+
+import os
+import json
+import time
+import argparse
+import tempfile
+from glob import glob
+from functools import partial
+import numpy as np
+import tensorflow as tf
+from ..config import Params, CONST, import_params_from_json
+from ..data_handler import feature_spec, parse_example, augment_data, padding_inputs_width, make_input_fn
+from ..elastic_helpers import tf_distortion_maps
+from ..autotune import autotune_input_pipeline
+from .helpers import write_synthetic_tfrecords
+
+STAGES = ['read', 'parse_example', 'augment_data', 'padding_inputs_width', 'tf_distortion_maps', 'batching']
+
+
+def _decode(serialized_example):
+    image_raw = tf.parse_single_example(serialized_example, feature_spec)['image_raw']
+    return tf.image.decode_png(image_raw, channels=1)
+
+
+def _parse_and_decode(serialized_example):
+    """First step of `parse_example` only : parsing of the record, pop of the label and decoding of the image"""
+    features = tf.parse_single_example(serialized_example, feature_spec)
+    label = features.pop('label')
+    image = tf.image.decode_png(features.pop('image_raw'), channels=1)
+    # Images have different sizes, only their shape is batched (it depends on the decoding)
+    return label, tf.shape(image)
+
+
+def _time_runs(fetches, n_runs: int, n_warmup: int) -> dict:
+    """
+    Times `n_runs` runs of `fetches`, whose first element is batched along its first dimension (to count the examples)
+    :return: dict with the throughput in examples/sec, the latency percentiles of a run and the examples per run
+    """
+    times, counts = list(), list()
+    with tf.Session() as session:
+        session.run(tf.global_variables_initializer())
+        for i in range(n_warmup + n_runs):
+            start = time.perf_counter()
+            outputs = session.run(fetches)
+            duration = time.perf_counter() - start
+            if i >= n_warmup:
+                times.append(duration)
+                counts.append(outputs[0].shape[0])
+
+    times_ms = 1000 * np.asarray(times)
+    return {'examples_per_sec': float(np.sum(counts) / np.sum(times)),
+            'examples_per_run': float(np.mean(counts)),
+            'latency_ms': {'mean': float(np.mean(times_ms)),
+                           'p50': float(np.percentile(times_ms, 50)),
+                           'p90': float(np.percentile(times_ms, 90)),
+                           'p99': float(np.percentile(times_ms, 99))}}
+
+
+def benchmark_stage(stage: str, filenames: list, params: Params, probe_batch: int, n_cached: int,
+                    n_runs: int) -> dict:
+    """
+    Measures one stage of the input pipeline in isolation. Stages working on decoded or padded images read them
+    from an in-memory cache of `n_cached` examples, filled during the warm up runs
+    :param stage: one of STAGES
+    :param filenames: tfrecords files
+    :param params: parameters of the experiment (input shape, batch size, input pipeline parameters)
+    :param probe_batch: number of examples per timed run (except 'tf_distortion_maps' and 'batching' which use
+        training batches)
+    :param n_cached: number of examples cached in memory
+    :param n_runs: number of timed runs
+    :return: see `_time_runs`
+    """
+    pipeline_params = params.input_pipeline_params
+    num_parallel_calls = pipeline_params['num_parallel_calls']
+    output_shape = tuple(params.input_shape)
+    increment = CONST.DIMENSION_REDUCTION_W_POOLING
+    n_warmup_cached = int(np.ceil(n_cached / probe_batch)) + 1
+
+    with tf.Graph().as_default():
+        if stage == 'read':
+            files = tf.data.Dataset.from_tensor_slices(filenames).repeat()
+            ds = files.apply(tf.contrib.data.parallel_interleave(
+                tf.data.TFRecordDataset,
+                cycle_length=pipeline_params['cycle_length'], block_length=pipeline_params['block_length'],
+                sloppy=True))
+            fetches = [ds.batch(probe_batch).make_one_shot_iterator().get_next()]
+            n_warmup = 2
+
+        elif stage == 'parse_example':
+            # Without the augmentation and the resizing, measured by their own stages
+            records = tf.data.TFRecordDataset(filenames).take(n_cached).cache().repeat()
+            ds = records.map(_parse_and_decode, num_parallel_calls=num_parallel_calls)
+            fetches = list(ds.batch(probe_batch).make_one_shot_iterator().get_next())
+            n_warmup = n_warmup_cached
+
+        elif stage == 'augment_data':
+            images = tf.data.TFRecordDataset(filenames).take(n_cached).map(_decode).cache().repeat()
+            # Images have different sizes, reduce them to be able to batch them (and to keep the computation)
+            ds = images.map(lambda image: tf.reduce_sum(augment_data(image)), num_parallel_calls=num_parallel_calls)
+            fetches = [ds.batch(probe_batch).make_one_shot_iterator().get_next()]
+            n_warmup = n_warmup_cached
+
+        elif stage == 'padding_inputs_width':
+            images = tf.data.TFRecordDataset(filenames).take(n_cached).map(_decode).cache().repeat()
+            ds = images.map(lambda image: padding_inputs_width(tf.cast(image, tf.float32), output_shape, increment),
+                            num_parallel_calls=num_parallel_calls)
+            fetches = list(ds.batch(probe_batch).make_one_shot_iterator().get_next())
+            n_warmup = n_warmup_cached
+
+        elif stage == 'tf_distortion_maps':
+            # A single batch of padded images is kept in memory
+            padded = tf.data.TFRecordDataset(filenames).take(params.train_batch_size).repeat()
+            padded = padded.map(partial(parse_example, output_shape=output_shape))
+            padded = padded.apply(tf.contrib.data.batch_and_drop_remainder(params.train_batch_size))
+            images = tf.Variable(padded.make_one_shot_iterator().get_next()[0]['image'], trainable=False)
+            fetches = [tf_distortion_maps(images)]
+            n_warmup = 2
+
+        elif stage == 'batching':
+            input_fn = make_input_fn(filenames, params.train_batch_size, output_shape,
+                                     dynamic_distortion=params.dynamic_distortion,
+                                     bucket_width_step=params.bucket_width_step,
+                                     pixel_budget=params.batch_pixel_budget,
+                                     data_augmentation=params.data_augmentation,
+                                     vectorized=params.vectorized_input,
+                                     encoded_labels=params.encoded_labels,
+                                     uint8_images=params.uint8_images,
+                                     packed=params.packed_input,
+                                     record_index=params.use_record_index,
+                                     drop_infeasible=params.drop_ctc_infeasible,
+                                     global_shuffle=params.shuffle_mode == 'global',
+                                     seed=params.shuffle_seed,
+                                     **pipeline_params)
+            features, labels = input_fn()
+            # The labels are a SparseTensor with encoded labels, the examples are counted on the images
+            fetches = [features['image'], labels, features]
+            n_warmup = 2
+
+        else:
+            raise ValueError('Unknown stage {}'.format(stage))
+
+        return _time_runs(fetches, n_runs, n_warmup)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measures the throughput and latency of each stage of the input '
+                                                 'pipeline, independently of the model, and writes a JSON report')
+    parser.add_argument('-t', '--tfrecords', type=str, help='Glob of tfrecords files (synthetic data if not given)')
+    parser.add_argument('-p', '--params_file', type=str, help='Parameters of the experiment (JSON). Input shape, '
+                                                               'batch size and input pipeline parameters are used')
+    parser.add_argument('-o', '--output', type=str, default='input_benchmark_{}.json'.format(round(time.time())),
+                        help='Filename of the JSON report')
+    parser.add_argument('-s', '--stages', type=str, nargs='*', default=STAGES, choices=STAGES, help='Stages to run')
+    parser.add_argument('--n_synthetic', type=int, default=2000, help='Number of synthetic examples')
+    parser.add_argument('--probe_batch', type=int, default=64, help='Examples per timed run of the isolated stages')
+    parser.add_argument('--n_cached', type=int, default=512, help='Examples cached in memory for the isolated stages')
+    parser.add_argument('-n', '--n_runs', type=int, default=50, help='Number of timed runs per stage')
+    args = parser.parse_args()
+
+    if args.params_file:
+        dict_params = import_params_from_json(json_filename=args.params_file)
+    else:
+        dict_params = {'alphabet': 'letters_digits_extended', 'input_shape': [32, 256], 'train_batch_size': 128}
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if args.tfrecords:
+            filenames = sorted(glob(args.tfrecords))
+        else:
+            filenames = [os.path.join(tmp_dir, 'synthetic_{}.tfrecords'.format(i)) for i in range(4)]
+            for i, filename in enumerate(filenames):
+                write_synthetic_tfrecords(filename, args.n_synthetic // len(filenames), seed=i)
+
+        dict_params['tfrecords_train'] = args.tfrecords or os.path.join(tmp_dir, '*.tfrecords')
+        params = Params(**dict_params)
+        if params.autotune_required:
+            params.input_pipeline_autotune = autotune_input_pipeline(params)
+
+        report = {'timestamp': round(time.time()),
+                  'tfrecords': args.tfrecords or 'synthetic',
+                  'n_files': len(filenames),
+                  'input_shape': list(params.input_shape),
+                  'train_batch_size': params.train_batch_size,
+                  'probe_batch': args.probe_batch,
+                  'data_augmentation': params.data_augmentation,
+                  'input_pipeline': params.input_pipeline_params,
+                  'stages': dict()}
+
+        for stage in args.stages:
+            report['stages'][stage] = benchmark_stage(stage, filenames, params, args.probe_batch, args.n_cached,
+                                                      args.n_runs)
+            print('{:<21}: {:>10.1f} examples/sec, p50 {:>8.2f} ms, p99 {:>8.2f} ms per run'.format(
+                stage, report['stages'][stage]['examples_per_sec'],
+                report['stages'][stage]['latency_ms']['p50'], report['stages'][stage]['latency_ms']['p99']))
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('Report written to {}'.format(args.output))
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+import argparse
+import numpy as np
+import tensorflow as tf
+from ..model import deep_bidirectional_lstm
+from ..config import Params, CONST, RNN_IMPLEMENTATIONS
+from .helpers import time_fetches, summarize_times
+
+
+def lstm_step_time(widths: np.ndarray, padded_width: int, n_features: int, params: Params,
+                   use_sequence_length: bool, n_steps: int) -> dict:
+    """
+    Measures the time of a forward and backward pass of the recurrent layers on a batch of images with the given
+    widths, all padded to `padded_width`. With the sequence lengths, the recurrent loop stops at the longest
+    sequence of the batch instead of running over the padded width
+    :param widths: widths (in pixels) of the images of the batch
+    :param padded_width: width (in pixels) of the batch
+    :param n_features: number of features given by the CNN at each time step
+    :param params: parameters of the model
+    :param use_sequence_length: pass the real sequence lengths to the recurrent layers
+    :param n_steps: number of timed steps
+    :return: summary of the step times (see `summarize_times`)
+    """
+    batch_size = len(widths)
+    seq_lengths = widths // CONST.DIMENSION_REDUCTION_W_POOLING - 1
+    max_time = padded_width // CONST.DIMENSION_REDUCTION_W_POOLING - 1
+
+    with tf.Graph().as_default():
+        inputs = tf.random_normal([batch_size, max_time, n_features])
+        corpora = tf.zeros([batch_size], dtype=tf.int64)
+        sequence_length = tf.constant(seq_lengths, dtype=tf.int32) if use_sequence_length else None
+
+        logprob, _ = deep_bidirectional_lstm(inputs, corpora, params, sequence_length=sequence_length,
+                                             summaries=False)
+        loss = tf.reduce_mean(tf.square(logprob))
+        train_op = tf.train.GradientDescentOptimizer(1e-3).minimize(loss)
+
+        with tf.Session() as session:
+            session.run(tf.global_variables_initializer())
+            times = time_fetches(session, train_op, n_steps)
+
+    return summarize_times(times, n_examples_per_run=batch_size)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compares the step time of the recurrent layers with and without '
+                                                 'the real sequence lengths, on batches of images of mixed widths')
+    parser.add_argument('-b', '--batch_size', type=int, default=64, help='Number of images per batch')
+    parser.add_argument('--min_width', type=int, default=32, help='Minimum width of the images')
+    parser.add_argument('--max_width', type=int, default=160, help='Maximum width of the images')
+    parser.add_argument('--padded_width', type=int, default=256, help='Width of the batch (input_shape[1])')
+    parser.add_argument('-n', '--n_steps', type=int, default=20, help='Number of timed steps')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the widths of the images')
+    parser.add_argument('-r', '--rnn_implementations', type=str, nargs='*', default=['cell'],
+                        choices=RNN_IMPLEMENTATIONS, help='Implementations of the recurrent layers to compare')
+    args = parser.parse_args()
+
+    n_features = 512  # output of deep_cnn: height 1 x 512 channels
+
+    rng = np.random.RandomState(args.seed)
+    widths = rng.randint(args.min_width // CONST.DIMENSION_REDUCTION_W_POOLING,
+                         args.max_width // CONST.DIMENSION_REDUCTION_W_POOLING + 1,
+                         size=args.batch_size) * CONST.DIMENSION_REDUCTION_W_POOLING
+
+    print('Mean width {:.0f} px, max width {} px, padded width {} px'.format(np.mean(widths), np.max(widths),
+                                                                            args.padded_width))
+    for rnn_implementation in args.rnn_implementations:
+        params = Params(alphabet='letters_digits_extended', num_corpora=10, rnn_implementation=rnn_implementation)
+        padded = lstm_step_time(widths, args.padded_width, n_features, params,
+                                use_sequence_length=False, n_steps=args.n_steps)
+        with_lengths = lstm_step_time(widths, args.padded_width, n_features, params,
+                                      use_sequence_length=True, n_steps=args.n_steps)
+
+        print('[{}]'.format(rnn_implementation))
+        print('Without sequence_length :', padded)
+        print('With sequence_length    :', with_lengths)
+        print('Speedup (mean step time): {:.2f}x'.format(padded['mean_ms'] / with_lengths['mean_ms']))
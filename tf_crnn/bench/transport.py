@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+import os
+import json
+import time
+import resource
+import argparse
+import tempfile
+from glob import glob
+import multiprocessing
+import tensorflow as tf
+from ..data_handler import make_input_fn
+from .helpers import time_fetches, summarize_times, write_synthetic_tfrecords
+
+
+def transport_benchmark(filenames: list, output_shape: tuple, batch_size: int, uint8_images: bool,
+                        data_augmentation: bool, num_parallel_calls: int, prefetch_buffer_size: int,
+                        n_steps: int) -> dict:
+    """
+    Measures the input pipeline feeding batches of images to a consumer casting them to float32 (as `deep_cnn`)
+    :param filenames: tfrecords files
+    :param output_shape: (height, width) of the images
+    :param batch_size: number of examples per batch
+    :param uint8_images: the pipeline gives uint8 images instead of float32
+    :param data_augmentation: apply the data augmentation
+    :param num_parallel_calls: number of examples parsed in parallel
+    :param prefetch_buffer_size: number of batches prefetched
+    :param n_steps: number of timed batches
+    :return: bytes of a batch of images and of the prefetch buffer, times (see `summarize_times`) and peak memory
+    """
+    with tf.Graph().as_default():
+        input_fn = make_input_fn(filenames, batch_size, output_shape, data_augmentation=data_augmentation,
+                                 num_parallel_calls=num_parallel_calls, prefetch_buffer_size=prefetch_buffer_size,
+                                 uint8_images=uint8_images)
+        features, labels = input_fn()
+        model_input = tf.reduce_sum(tf.cast(features['image'], tf.float32))
+
+        with tf.Session() as session:
+            image_batch = session.run(features['image'])
+            times = time_fetches(session, model_input, n_steps)
+
+    results = summarize_times(times, n_examples_per_run=batch_size)
+    results['batch_image_bytes'] = int(image_batch.nbytes)
+    results['prefetch_buffer_bytes'] = int(image_batch.nbytes * prefetch_buffer_size)
+    results['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # kilobytes on linux
+    return results
+
+
+def _run_in_process(queue: multiprocessing.Queue, **kwargs):
+    queue.put(transport_benchmark(**kwargs))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compares the memory and throughput of the input pipeline giving '
+                                                 'float32 and uint8 images, each run in its own process')
+    parser.add_argument('-t', '--tfrecords', type=str, help='Glob of tfrecords files (synthetic data if not given)')
+    parser.add_argument('--n_synthetic', type=int, default=2000, help='Number of synthetic examples')
+    parser.add_argument('--input_shape', type=int, nargs=2, default=[32, 256], help='Height and width of the images')
+    parser.add_argument('-b', '--batch_size', type=int, default=512, help='Number of examples per batch')
+    parser.add_argument('-a', '--data_augmentation', action='store_true', help='Apply the data augmentation')
+    parser.add_argument('-p', '--num_parallel_calls', type=int, default=4, help='Examples parsed in parallel')
+    parser.add_argument('--prefetch_buffer_size', type=int, default=2, help='Number of batches prefetched')
+    parser.add_argument('-n', '--n_steps', type=int, default=30, help='Number of timed batches')
+    parser.add_argument('-o', '--output', type=str, default='transport_benchmark_{}.json'.format(round(time.time())),
+                        help='Filename of the JSON report')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if args.tfrecords:
+            filenames = sorted(glob(args.tfrecords))
+        else:
+            filenames = [os.path.join(tmp_dir, 'synthetic.tfrecords')]
+            write_synthetic_tfrecords(filenames[0], args.n_synthetic)
+
+        report = {'input_shape': args.input_shape, 'batch_size': args.batch_size,
+                  'data_augmentation': args.data_augmentation, 'prefetch_buffer_size': args.prefetch_buffer_size}
+        # Separate processes, so that the peak memory of one run does not hide the other. They are spawned and not
+        # forked : TensorFlow has already run in this process to write the synthetic records
+        context = multiprocessing.get_context('spawn')
+        for name, uint8_images in [('float32', False), ('uint8', True)]:
+            queue = context.Queue()
+            process = context.Process(target=_run_in_process, args=(queue,),
+                                      kwargs={'filenames': filenames, 'output_shape': tuple(args.input_shape),
+                                              'batch_size': args.batch_size, 'uint8_images': uint8_images,
+                                              'data_augmentation': args.data_augmentation,
+                                              'num_parallel_calls': args.num_parallel_calls,
+                                              'prefetch_buffer_size': args.prefetch_buffer_size,
+                                              'n_steps': args.n_steps})
+            process.start()
+            report[name] = queue.get()
+            process.join()
+            print('{:<8}: {:>9.1f} examples/sec, {:>8.1f} MB per batch, peak RSS {:>8.1f} MB'.format(
+                name, report[name]['examples_per_sec'], report[name]['batch_image_bytes'] / 2**20,
+                report[name]['peak_rss_mb']))
+
+    print('Throughput ratio uint8 / float32: {:.2f}x, batch size ratio: {:.2f}x'.format(
+        report['uint8']['examples_per_sec'] / report['float32']['examples_per_sec'],
+        report['float32']['batch_image_bytes'] / report['uint8']['batch_image_bytes']))
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('Report written to {}'.format(args.output))
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+
+import argparse
+import numpy as np
+import tensorflow as tf
+from ..elastic_helpers import bilinear_sample
+from .helpers import time_fetches, summarize_times
+
+
+def _gather_sample(img, coords):
+    # one gather_nd per neighbour, as the previous implementation of `ImageSample`
+    shape = tf.shape(img)[1:3]
+    batch = tf.shape(img)[0]
+    shape2 = tf.shape(coords)[1:3]
+
+    coords_y, coords_x = tf.split(coords, 2, axis=3)
+    coords_y = tf.clip_by_value(coords_y, 0., tf.cast(shape[0] - 1, tf.float32))
+    coords_x = tf.clip_by_value(coords_x, 0., tf.cast(shape[1] - 1, tf.float32))
+    coords = tf.to_int32(tf.concat([coords_y, coords_x], axis=3))
+
+    batch_index = tf.reshape(tf.range(batch, dtype=tf.int32), [-1, 1, 1, 1])
+    batch_index = tf.tile(batch_index, [1, shape2[0], shape2[1], 1])
+    return tf.cast(tf.gather_nd(img, tf.concat([batch_index, coords], axis=3)), tf.float32)
+
+
+def reference_bilinear_sample(image: tf.Tensor, mapping: tf.Tensor, border_mode: str='repeat') -> tf.Tensor:
+    """
+    Bilinear sampling with four separate gathers, kept as the reference of `bilinear_sample`
+    :param image: N x H x W x C tensor
+    :param mapping: N x H' x W' x 2 (y, x) coordinates
+    :param border_mode: 'repeat' or 'constant'
+    :return: N x H' x W' x C float32 tensor
+    """
+    input_shape = tf.shape(image)[1:3]
+    orig_mapping = mapping
+    mapping = tf.maximum(mapping, 0.0)
+    lcoor = tf.floor(mapping)
+    ucoor = lcoor + 1.0
+
+    diff = mapping - lcoor
+    neg_diff = 1.0 - diff
+
+    lcoory, lcoorx = tf.split(lcoor, 2, 3)
+    ucoory, ucoorx = tf.split(ucoor, 2, 3)
+    lyux = tf.concat([lcoory, ucoorx], 3)
+    uylx = tf.concat([ucoory, lcoorx], 3)
+
+    diffy, diffx = tf.split(diff, 2, 3)
+    neg_diffy, neg_diffx = tf.split(neg_diff, 2, 3)
+
+    ret = tf.add_n([_gather_sample(image, lcoor) * neg_diffx * neg_diffy,
+                    _gather_sample(image, ucoor) * diffx * diffy,
+                    _gather_sample(image, lyux) * neg_diffy * diffx,
+                    _gather_sample(image, uylx) * diffy * neg_diffx])
+
+    if border_mode == 'constant':
+        max_coor = tf.cast(tf.stack([input_shape[0] - 1, input_shape[1] - 1]), tf.float32)
+        mask = tf.logical_and(tf.greater_equal(orig_mapping, 0.0), tf.less_equal(orig_mapping, max_coor))
+        mask = tf.expand_dims(tf.reduce_all(mask, [3]), 3)
+        ret = ret * tf.cast(mask, tf.float32)
+
+    return ret
+
+
+def _sampler_inputs(batch_size: int, height: int, width: int, max_displacement: float=None) -> (tf.Tensor, tf.Tensor):
+    """
+    :param max_displacement: maximum displacement of the coordinates (defaults to the height),
+        large enough to go out of the image
+    :return: random images and coordinates displaced from the grid of the images, as variables
+    """
+    max_displacement = height if max_displacement is None else max_displacement
+    images = tf.Variable(tf.random_uniform([batch_size, height, width, 1], 0, 255), trainable=False)
+    grid = tf.stack(tf.meshgrid(tf.range(height, dtype=tf.float32), tf.range(width, dtype=tf.float32),
+                                indexing='ij'), axis=2)
+    coords = tf.Variable(grid + tf.random_uniform([batch_size, height, width, 2],
+                                                  -max_displacement, max_displacement), trainable=False)
+    return images, coords
+
+
+def check_bilinear_sample(batch_size: int=8, height: int=32, width: int=64, tolerance: float=1e-3,
+                          max_displacement: float=None) -> dict:
+    """
+    Checks that `bilinear_sample` gives the output of the reference implementation in both border modes,
+    raises an AssertionError otherwise
+    :param tolerance: maximum absolute difference accepted between the outputs (pixel values in [0, 255])
+    :param max_displacement: see `_sampler_inputs`
+    :return: dict {border mode: maximum absolute difference}
+    """
+    max_abs_diffs = dict()
+    for border_mode in ['repeat', 'constant']:
+        with tf.Graph().as_default():
+            images, coords = _sampler_inputs(batch_size, height, width, max_displacement)
+            fused = bilinear_sample(images, coords, border_mode)
+            reference = reference_bilinear_sample(images, coords, border_mode)
+            with tf.Session() as session:
+                session.run(tf.global_variables_initializer())
+                fused_output, reference_output = session.run([fused, reference])
+        max_abs_diffs[border_mode] = float(np.max(np.abs(fused_output - reference_output)))
+
+    assert all(diff <= tolerance for diff in max_abs_diffs.values()), \
+        'The fused sampler differs from the reference implementation : {}'.format(max_abs_diffs)
+    return max_abs_diffs
+
+
+def compare_samplers(batch_size: int, height: int, width: int, border_mode: str, n_steps: int,
+                     max_displacement: float=None) -> dict:
+    """
+    Measures the step times of the fused sampler and of the reference one (see `check_bilinear_sample` for their
+    equivalence)
+    :param batch_size: number of images per batch
+    :param height: height of the images
+    :param width: width of the images
+    :param border_mode: 'repeat' or 'constant'
+    :param n_steps: number of timed steps
+    :param max_displacement: see `_sampler_inputs`
+    :return: dict with the step times of both samplers
+    """
+    with tf.Graph().as_default():
+        images, coords = _sampler_inputs(batch_size, height, width, max_displacement)
+        fused = bilinear_sample(images, coords, border_mode)
+        reference = reference_bilinear_sample(images, coords, border_mode)
+
+        with tf.Session() as session:
+            session.run(tf.global_variables_initializer())
+            fused_times = time_fetches(session, fused.op, n_steps)
+            reference_times = time_fetches(session, reference.op, n_steps)
+
+    return {'fused': summarize_times(fused_times, n_examples_per_run=batch_size),
+            'reference': summarize_times(reference_times, n_examples_per_run=batch_size)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Checks the fused bilinear sampler against the four-gather '
+                                                 'implementation and compares their step times')
+    parser.add_argument('-b', '--batch_size', type=int, default=128, help='Number of images per batch')
+    parser.add_argument('--input_shape', type=int, nargs=2, default=[32, 256], help='Height and width of the images')
+    parser.add_argument('-n', '--n_steps', type=int, default=20, help='Number of timed steps')
+    parser.add_argument('--tolerance', type=float, default=1e-3,
+                        help='Maximum absolute difference accepted between the outputs (pixel values in [0, 255])')
+    args = parser.parse_args()
+
+    max_abs_diffs = check_bilinear_sample(args.batch_size, *args.input_shape, tolerance=args.tolerance)
+    for border_mode, max_abs_diff in max_abs_diffs.items():
+        results = compare_samplers(args.batch_size, *args.input_shape, border_mode, args.n_steps)
+        print('[{}] max abs diff : {:.2e}'.format(border_mode, max_abs_diff))
+        print('[{}] fused     :'.format(border_mode), results['fused'])
+        print('[{}] reference :'.format(border_mode), results['reference'])
+        print('[{}] speedup (mean step time): {:.2f}x'.format(
+            border_mode, results['reference']['mean_ms'] / results['fused']['mean_ms']))
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+import os
+import json
+import shutil
+import threading
+from glob import glob
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List
+import tensorflow as tf
+from .config import CONST
+
+# Metrics which are better when lower, the other ones are better when higher
+LOWER_IS_BETTER = ['eval/CER', 'loss']
+
+
+class BestCheckpointKeeper:
+    """
+    Keeps copies of the k best checkpoints according to an evaluation metric in `model_dir/best`
+    (the training saver only needs to keep the most recent checkpoint). Each new best checkpoint is exported
+    by `export_fn` in a background thread, pending exports of checkpoints which are no longer the best are skipped.
+    The `checkpoint` file of the best directory points to the best checkpoint, and `best_checkpoints.json`
+    holds the metrics of the kept ones
+    """
+    def __init__(self, model_dir: str, k: int=3, metric: str='eval/CER', export_fn: Callable[[str], str]=None):
+        """
+        :param model_dir: directory of the model (checkpoints are copied to its `best` subdirectory)
+        :param k: number of checkpoints kept
+        :param metric: name of the metric to rank the checkpoints ('eval/CER', 'eval/accuracy')
+        :param export_fn: function exporting the model from a checkpoint path, returning the export directory
+        """
+        self.best_dir = os.path.join(model_dir, 'best')
+        self.k = k
+        self.metric = metric
+        self.export_fn = export_fn
+        self._lower_is_better = metric in LOWER_IS_BETTER
+        self._lock = threading.Lock()
+        self._exporting = None
+        self._evicted_while_exporting = set()
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self.exports = list()  # futures of the exports
+
+        os.makedirs(self.best_dir, exist_ok=True)
+        self._state_filename = os.path.join(self.best_dir, 'best_checkpoints.json')
+        if os.path.isfile(self._state_filename):
+            with open(self._state_filename, 'r') as f:
+                self.kept = json.load(f)  # list of {'checkpoint', 'metrics'} from the best one
+        else:
+            self.kept = list()
+
+    @property
+    def best_checkpoint(self) -> str:
+        return self.kept[0]['checkpoint'] if self.kept else None
+
+    @staticmethod
+    def _checkpoint_files(checkpoint_path: str) -> List[str]:
+        return glob(checkpoint_path + '.*')
+
+    def _copy(self, checkpoint_path: str) -> str:
+        for filename in self._checkpoint_files(checkpoint_path):
+            shutil.copy2(filename, self.best_dir)
+        return os.path.join(self.best_dir, os.path.basename(checkpoint_path))
+
+    def _delete(self, checkpoint_path: str) -> None:
+        for filename in self._checkpoint_files(checkpoint_path):
+            os.remove(filename)
+
+    def stage(self, checkpoint_path: str) -> str:
+        """
+        Copies a checkpoint to the best directory before evaluating it, when the training may delete it
+        during the evaluation (evaluation in a side process). Pass the returned path to `update`.
+        Raises a FileNotFoundError if the checkpoint is deleted before being completely copied
+        """
+        copied = list()
+        try:
+            filenames = self._checkpoint_files(checkpoint_path)
+            if not any(filename.endswith('.index') for filename in filenames) or \
+                    not any('.data-' in filename for filename in filenames):
+                raise FileNotFoundError('Incomplete checkpoint {} : {}'.format(checkpoint_path, filenames))
+            for filename in filenames:
+                copied.append(shutil.copy2(filename, self.best_dir))
+        except FileNotFoundError:
+            # Deleted by the training before or while being copied, remove the partial copy
+            for filename in copied:
+                os.remove(filename)
+            raise
+        return os.path.join(self.best_dir, os.path.basename(checkpoint_path))
+
+    def _sort_key(self, entry: dict) -> float:
+        value = entry['metrics'][self.metric]
+        return value if self._lower_is_better else -value
+
+    def update(self, checkpoint_path: str, metrics: dict) -> bool:
+        """
+        Ranks a new evaluated checkpoint, keeps a copy of it if it is among the k best and evicts the worst one.
+        If it is the new best checkpoint, its export is started in the background
+        :param checkpoint_path: evaluated checkpoint (in the model directory, or staged in the best directory)
+        :param metrics: evaluation results containing the metric
+        :return: True if the checkpoint is the new best one
+        """
+        metrics = {key: float(value) for key, value in metrics.items()}
+        staged = os.path.dirname(os.path.abspath(checkpoint_path)) == os.path.abspath(self.best_dir)
+        entry = {'checkpoint': os.path.join(self.best_dir, os.path.basename(checkpoint_path)), 'metrics': metrics}
+
+        candidates = sorted([kept for kept in self.kept if kept['checkpoint'] != entry['checkpoint']] + [entry],
+                            key=self._sort_key)
+        if entry not in candidates[:self.k]:
+            if staged:
+                self._delete(checkpoint_path)
+            return False
+
+        if not staged:
+            self._copy(checkpoint_path)
+        with self._lock:
+            self.kept, evicted = candidates[:self.k], candidates[self.k:]
+            for old in evicted:
+                if old['checkpoint'] == self._exporting:
+                    self._evicted_while_exporting.add(old['checkpoint'])
+                else:
+                    self._delete(old['checkpoint'])
+
+        tf.train.update_checkpoint_state(self.best_dir, self.best_checkpoint,
+                                         all_model_checkpoint_paths=[kept['checkpoint'] for kept in self.kept])
+        with open(self._state_filename, 'w') as f:
+            json.dump(self.kept, f, indent=2)
+
+        is_best = self.best_checkpoint == entry['checkpoint']
+        if is_best:
+            print('New best checkpoint ({} = {}) : {}'.format(self.metric, metrics[self.metric], entry['checkpoint']))
+            if self.export_fn is not None:
+                self.exports.append(self._executor.submit(self._export, entry['checkpoint']))
+        return is_best
+
+    def _export(self, checkpoint_path: str) -> str:
+        with self._lock:
+            if checkpoint_path != self.best_checkpoint:
+                return None  # superseded by a newer best checkpoint before its export started
+            self._exporting = checkpoint_path
+        try:
+            export_dir = self.export_fn(checkpoint_path)
+            print('Exported model of {} to {}'.format(checkpoint_path, export_dir))
+            return export_dir
+        finally:
+            with self._lock:
+                self._exporting = None
+                if checkpoint_path in self._evicted_while_exporting:
+                    self._evicted_while_exporting.remove(checkpoint_path)
+                    self._delete(checkpoint_path)
+
+    def close(self) -> None:
+        """Waits for the pending exports"""
+        self._executor.shutdown(wait=True)
+        for future in self.exports:
+            if future.exception() is not None:
+                print('Export failed : {}'.format(future.exception()))
+
+
+class InputStateListener(tf.train.CheckpointSaverListener):
+    """
+    Writes the state of the globally shuffled training input (see `record_index.ShuffledRecords`) saved with each
+    checkpoint to `model_dir/input_state.json` : position, epoch, seed, file and offset of the next record.
+    The training resumes from the `CONST.INPUT_POSITION` variable of the checkpoint, the file is for information
+    """
+    def __init__(self, model_dir: str, shuffled_records):
+        self.model_dir = model_dir
+        self.shuffled_records = shuffled_records
+        self._position = None
+
+    def begin(self):
+        self._position = [variable for variable in tf.global_variables()
+                          if variable.op.name == CONST.INPUT_POSITION][0]
+
+    def after_save(self, session, global_step_value):
+        state = self.shuffled_records.locate(session.run(self._position))
+        state.update({'global_step': int(global_step_value),
+                      'checkpoint': tf.train.latest_checkpoint(self.model_dir)})
+        filename = os.path.join(self.model_dir, 'input_state.json')
+        with open(filename + '.tmp', 'w') as f:
+            json.dump(state, f, indent=2)
+        os.rename(filename + '.tmp', filename)
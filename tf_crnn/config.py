@@ -5,10 +5,13 @@ import os
 import json
 import time
 from glob import glob
+from typing import List
 
 
 class CONST:
     DIMENSION_REDUCTION_W_POOLING = 2*2  # 2x2 pooling in dimension W on layer 1 and 2
+    INPUT_INITIALIZERS = 'input_initializers'  # graph collection of the initializable input iterators
+    INPUT_POSITION = 'input_position'  # variable of the checkpoints holding the position of the training input
 
 
 class Alphabet:
@@ -74,6 +77,16 @@ class Alphabet:
                                                          len(Digits) + len(LettersLowercase) +
                                                          len(Symbols) + 1))
 
+# Parallelism parameters of the input pipeline (see data_handler.make_input_fn), they can be set to 'auto'
+INPUT_PIPELINE_KEYS = ['cycle_length', 'block_length', 'shuffle_buffer_size', 'num_parallel_calls',
+                       'prefetch_buffer_size']
+# Implementations of the recurrent layers (see model.deep_bidirectional_lstm)
+RNN_IMPLEMENTATIONS = ['cell', 'block', 'fused', 'cudnn_compatible']
+# Default number of channels of the 7 convolution layers and units of the recurrent layers (see model.deep_cnn)
+CNN_CHANNELS = [64, 128, 256, 256, 512, 512, 512]
+LSTM_HIDDEN = [256, 256]
+
+
 class ConfigError(Exception):
     pass
 
@@ -95,10 +108,38 @@ class Params:
         self.n_epochs = kwargs.get('n_epochs', 50)
         self.epoch_size = kwargs.get('epoch_size', None) # in steps
         self.save_interval = kwargs.get('save_interval', 1e3)
+        # Checkpoints every save_interval_secs seconds instead of every save_interval steps (continuous training)
+        self.save_interval_secs = kwargs.get('save_interval_secs')
+        # Copies of the keep_best_checkpoints best checkpoints according to best_checkpoint_metric
+        # ('eval/CER' or 'eval/accuracy') are kept in output_model_dir/best, and only new best ones are exported.
+        # The training itself only keeps its most recent checkpoint
+        self.keep_best_checkpoints = kwargs.get('keep_best_checkpoints', 3)
+        self.best_checkpoint_metric = kwargs.get('best_checkpoint_metric', 'eval/CER')
+        # Continuous training (train_continuous.py) : evaluate each new checkpoint in the training process
+        # ('in_process') or leave it to an evaluator run in another process ('side_process')
+        self.eval_mode = kwargs.get('eval_mode', 'in_process')
 
         # Shape of the image to be processed. The original with either be
         # resized or pad depending on its original size
         self.input_shape = kwargs.get('input_shape', (32, 100))
+        # Width-bucketed batching: if set, images are only resized to the input height (their width is
+        # clipped to input_shape[1]) and grouped in buckets of this width step instead of being padded
+        self.bucket_width_step = kwargs.get('bucket_width_step')
+        # Maximum number of pixels (batch x height x width) in a bucketed batch.
+        # Defaults to the number of pixels of a fixed size batch
+        self.batch_pixel_budget = kwargs.get('batch_pixel_budget')
+        # Batch-first input pipeline : serialized examples are batched, then parsed and augmented batch by batch
+        self.vectorized_input = kwargs.get('vectorized_input', False)
+        # Input pipeline parallelism : number of files read in parallel, consecutive records read from each file,
+        # records in the shuffle buffer, examples parsed in parallel and prefetched batches.
+        # Each one is either a number or 'auto' to be chosen by probing the host (see autotune.py)
+        self.cycle_length = kwargs.get('cycle_length', 4)
+        self.block_length = kwargs.get('block_length', 16)
+        self.shuffle_buffer_size = kwargs.get('shuffle_buffer_size', 128)
+        self.num_parallel_calls = kwargs.get('num_parallel_calls', 4)
+        self.prefetch_buffer_size = kwargs.get('prefetch_buffer_size', 2)
+        # Chosen values and host measurements of the autotuning (not read from kwargs : probed at every run)
+        self.input_pipeline_autotune = None
         # Either decode with the same alphabet or map capitals and lowercase
         # letters to the same symbol (lowercase)
         self.alphabet_decoding = kwargs.get('alphabet_decoding', 'same')
@@ -112,18 +153,120 @@ class Params:
         self._keep_prob_dropout = kwargs.get('keep_prob', 1)
 
         self.tfrecords_train = kwargs.get('tfrecords_train')
+        # Delimiter of the csv files (image path, label[, corpus]) converted to tfrecords (hlp/csv_to_tfrecords.py)
+        self.csv_delimiter = kwargs.get('csv_delimiter', ' ')
         self.tfrecords_eval = kwargs.get('tfrecords_eval')
+        # The tfrecords hold the label codes of the alphabet (written with Params.encode_label, see
+        # hlp/tfrecords_encode_labels.py) instead of latin1 label strings to be converted in the graph
+        self.encoded_labels = kwargs.get('encoded_labels', False)
+        # tfrecords_train and tfrecords_eval are glob expressions of packed datasets (.packed.npz index files,
+        # see hlp/pack_tfrecords.py) of images already resized to the input height, read without decoding.
+        # The random padding of the data augmentation is scaled to the packed height (datasets packed before the
+        # source heights were stored get the padding in pixels of the resized image, a much stronger augmentation)
+        self.packed_input = kwargs.get('packed_input', False)
+        # Use the indices of the tfrecords files (python -m tf_crnn.record_index) to skip corrupt records and
+        # labels too long for the CTC without parsing them, and to choose the bucket widths
+        self.use_record_index = kwargs.get('use_record_index', False)
+        # Drop the training examples whose label cannot be aligned by the CTC with their image in the input pipeline,
+        # instead of computing the model on them for a zero gradient (see data_handler.ctc_feasible)
+        self.drop_ctc_infeasible = kwargs.get('drop_ctc_infeasible', False)
+        # Shuffling of the training records : 'buffer' (files shuffled and mixed in a buffer of shuffle_buffer_size
+        # records) or 'global' (all the records permuted at each epoch, the tfrecords files must be indexed with
+        # python -m tf_crnn.record_index). The permutations are given by shuffle_seed and the epoch
+        self.shuffle_mode = kwargs.get('shuffle_mode', 'buffer')
+        # Cache of the evaluation batches, replayed at each evaluation : null (none), 'memory' or a directory.
+        # It is computed again when the eval files or the input shape change
+        self.eval_cache = kwargs.get('eval_cache')
+        # Images leave the input pipeline as uint8 and are cast by the model, instead of float32 (4x the bytes)
+        self.uint8_images = kwargs.get('uint8_images', False)
+        # Implementation of the recurrent layers : 'cell' (LSTMCell), 'block' (LSTMBlockCell, fused op per time step),
+        # 'fused' (LSTMBlockFusedCell, one op for all the time steps, fastest on CPU) or 'cudnn_compatible'
+        # (CudnnCompatibleLSTMCell, variables of CudnnLSTM). The first three share their checkpoints,
+        # hlp/convert_rnn_checkpoint.py converts checkpoints from and to 'cudnn_compatible'
+        self.rnn_implementation = kwargs.get('rnn_implementation', 'cell')
+        # Architecture : channels of the 7 convolution layers, depthwise separable convolutions (compact models)
+        # and number of units of each bidirectional recurrent layer (its length is the depth)
+        self.cnn_channels = kwargs.get('cnn_channels', CNN_CHANNELS)
+        self.separable_convolutions = kwargs.get('separable_convolutions', False)
+        self.lstm_hidden = kwargs.get('lstm_hidden', LSTM_HIDDEN)
+        # Distillation : the model is trained against the logits of a teacher, exported model (export_savedmodel
+        # directory) trained with the parameters of distillation_teacher_params (JSON), with the same alphabet and
+        # input height. The loss is (1 - distillation_weight) x CTC loss + distillation_weight x cross entropy with
+        # the teacher predictions softened by distillation_temperature
+        self.distillation_teacher = kwargs.get('distillation_teacher')
+        self.distillation_teacher_params = kwargs.get('distillation_teacher_params')
+        self.distillation_temperature = kwargs.get('distillation_temperature', 2.0)
+        self.distillation_weight = kwargs.get('distillation_weight', 0.5)
+        # Read at the first use of distillation_teacher_parameters only, to export a student without its teacher
+        self._distillation_teacher_json = None
+        self.shuffle_seed = kwargs.get('shuffle_seed', 0)
         self.train_cnn = kwargs.get('train_cnn')
         self.top_paths = kwargs.get('top_paths')
         self.nb_logprob = kwargs.get('nb_logprob')
-        self.dynamic_distortion = kwargs.get('dynamic_distortion')
-        try:
-            if self.dynamic_distortion and int(self.gpu) < 0:
-                raise ConfigError('Using dynamic_distortion requires GPU.'
-                                  ' Otherwise learning would be even slower.')
-        except ValueError:
-            # self.gpu is not convertible to int
-            pass
+        # CTC decoding : 'none' or 'greedy' during training (only used for summaries),
+        # 'greedy' or 'beam' for evaluation and prediction
+        self.train_decoder = kwargs.get('train_decoder', 'greedy')
+        self.eval_decoder = kwargs.get('eval_decoder', 'beam')
+        # Width of the beam search decoder, which returns nb_logprob paths (top_paths of them are converted to words)
+        self.beam_width = kwargs.get('beam_width', 100)
+        # Random padding, rotation, brightness and contrast of the training examples (never applied for evaluation)
+        self.data_augmentation = kwargs.get('data_augmentation', True)
+        # Elastic distortion of the training images : false, 'batch' (applied to the batches given by the
+        # input pipeline, true is the same) or 'pipeline' (applied to each example in the input pipeline workers)
+        self.dynamic_distortion = kwargs.get('dynamic_distortion', False)
+        if self.dynamic_distortion is True:
+            self.dynamic_distortion = 'batch'
+        if self.dynamic_distortion not in [False, None, 'batch', 'pipeline']:
+            raise ConfigError(f'Unknown dynamic_distortion {self.dynamic_distortion}')
+        # Number of precomputed displacement fields sampled for the elastic distortion (0 : generated at each step)
+        # and interval in seconds between the replacement of one field of the bank by a new one (None : never)
+        self.distortion_bank_size = kwargs.get('distortion_bank_size', 0)
+        self.distortion_bank_refresh_secs = kwargs.get('distortion_bank_refresh_secs')
+
+        if self.bucket_width_step is not None and self.bucket_width_step <= 0:
+            raise ConfigError('bucket_width_step should be a positive number of pixels')
+        if self.bucket_width_step is not None and self.vectorized_input:
+            raise ConfigError('vectorized_input cannot be used with bucket_width_step')
+        if self.packed_input and self.vectorized_input:
+            raise ConfigError('vectorized_input cannot be used with packed_input')
+        if self.drop_ctc_infeasible and self.vectorized_input:
+            raise ConfigError('vectorized_input cannot be used with drop_ctc_infeasible')
+        if self.rnn_implementation not in RNN_IMPLEMENTATIONS:
+            raise ConfigError(f'rnn_implementation should be one of {RNN_IMPLEMENTATIONS}, got {self.rnn_implementation}')
+        if len(self.cnn_channels) != len(CNN_CHANNELS) or not all(isinstance(c, int) and c > 0
+                                                                 for c in self.cnn_channels):
+            raise ConfigError(f'cnn_channels should be {len(CNN_CHANNELS)} positive integers, got {self.cnn_channels}')
+        if len(self.lstm_hidden) == 0 or not all(isinstance(n, int) and n > 0 for n in self.lstm_hidden):
+            raise ConfigError(f'lstm_hidden should be a list of positive integers, got {self.lstm_hidden}')
+        if self.distillation_teacher is not None and self.distillation_teacher_params is None:
+            raise ConfigError('distillation_teacher_params is needed to build the distillation_teacher')
+        if not 0 <= self.distillation_weight <= 1:
+            raise ConfigError(f'distillation_weight should be in [0, 1], got {self.distillation_weight}')
+        if self.shuffle_mode not in ['buffer', 'global']:
+            raise ConfigError(f"shuffle_mode should be 'buffer' or 'global', got {self.shuffle_mode}")
+        if self.shuffle_mode == 'global' and self.packed_input:
+            raise ConfigError("Packed datasets are always shuffled globally, use shuffle_mode 'buffer'")
+        if not (isinstance(self.shuffle_seed, int) and self.shuffle_seed >= 0):
+            raise ConfigError(f'shuffle_seed should be a non negative integer, got {self.shuffle_seed}')
+        if self.packed_input and self.use_record_index:
+            raise ConfigError('use_record_index cannot be used with packed_input')
+
+        for key in INPUT_PIPELINE_KEYS:
+            value = getattr(self, key)
+            if value != 'auto' and not (isinstance(value, int) and value > 0):
+                raise ConfigError(f"{key} should be a positive integer or 'auto', got {value}")
+
+        if self.train_decoder not in ['none', 'greedy', 'beam']:
+            raise ConfigError(f'Unknown train_decoder {self.train_decoder}')
+        if self.eval_decoder not in ['greedy', 'beam']:
+            raise ConfigError(f'Unknown eval_decoder {self.eval_decoder}')
+
+        if not (isinstance(self.keep_best_checkpoints, int) and self.keep_best_checkpoints > 0):
+            raise ConfigError('keep_best_checkpoints should be a positive integer')
+        if self.best_checkpoint_metric not in ['eval/CER', 'eval/accuracy']:
+            raise ConfigError(f'Unknown best_checkpoint_metric {self.best_checkpoint_metric}')
+        if self.eval_mode not in ['in_process', 'side_process']:
+            raise ConfigError(f'Unknown eval_mode {self.eval_mode}')
 
         if self.optimizer not in ['adam', 'rms', 'ada']:
             raise ConfigError(f'Unknown optimizer {self.optimizer}')
@@ -181,8 +324,39 @@ class Params:
             self._alphabet_decoding_codes = self._alphabet_codes
 
         self._nclasses = self._alphabet_codes[-1] + 1
+        # The blank symbol cannot be part of a label
+        self._char_to_code = dict(zip(self.alphabet[:-1], self._alphabet_codes[:-1]))
         self._blank_label_symbol = Alphabet.BLANK_SYMBOL
 
+    def encode_label(self, label: str) -> List[int]:
+        """
+        Codes of the characters of a label, to be stored in the tfrecords (see `data_handler.make_example`).
+        Raises a KeyError for characters out of the alphabet
+        """
+        return [self._char_to_code[c] for c in label]
+
+    @property
+    def autotune_required(self) -> bool:
+        return any(getattr(self, key) == 'auto' for key in INPUT_PIPELINE_KEYS)
+
+    @property
+    def input_pipeline_params(self) -> dict:
+        """Parallelism parameters to pass to make_input_fn, where 'auto' is replaced by the autotuned value"""
+        input_params = {key: getattr(self, key) for key in INPUT_PIPELINE_KEYS}
+        for key, value in input_params.items():
+            if value == 'auto':
+                if self.input_pipeline_autotune is None:
+                    raise ConfigError(f"{key} is 'auto' but the input pipeline was not autotuned")
+                input_params[key] = self.input_pipeline_autotune['values'][key]
+        return input_params
+
+    @property
+    def distillation_teacher_parameters(self) -> 'Params':
+        """Parameters of the distillation teacher, whose JSON file is read once for all the calls of `crnn_fn`"""
+        if self._distillation_teacher_json is None:
+            self._distillation_teacher_json = import_params_from_json(json_filename=self.distillation_teacher_params)
+        return Params(**self._distillation_teacher_json)
+
     @property
     def keep_prob_dropout(self):
         return self._keep_prob_dropout
@@ -3,10 +3,17 @@ __author__ = 'cipri-tom'
 
 import tensorflow as tf
 import numpy as np
-from .elastic_helpers import gaussian_filter_tf, sample, ImageSample, tf_distortion_maps, normalize_text
+from .elastic_helpers import tf_distortion_maps, elastic_distortion, normalize_text
 from .config import Params, CONST
-from typing import Tuple
+from .packed_data import PackedDatasets
+from .record_index import load_record_index, usable_records, plan_bucket_widths, ShuffledRecords
+from typing import Tuple, List
+import os
+import json
 import time
+import hashlib
+import threading
+from glob import glob
 
 from functools import partial
 
@@ -15,54 +22,583 @@ feature_spec = {
     'label': tf.FixedLenFeature([], tf.string),
     'corpus': tf.FixedLenFeature([],tf.int64)
 }
-def parse_example(serialized_example, output_shape=None):
-    features = tf.parse_single_example(serialized_example, feature_spec)
+# Records with the labels encoded in the codes of the alphabet (see `make_example`)
+encoded_feature_spec = {
+    'image_raw': tf.FixedLenFeature([], tf.string),
+    'label_codes': tf.VarLenFeature(tf.int64),
+    'label_length': tf.FixedLenFeature([], tf.int64),
+    'corpus': tf.FixedLenFeature([], tf.int64)
+}
+
+
+def _bytes_feature(value: bytes) -> tf.train.Feature:
+    return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
+
+
+def _int64_feature(value) -> tf.train.Feature:
+    value = value if isinstance(value, (list, tuple)) else [value]
+    return tf.train.Feature(int64_list=tf.train.Int64List(value=value))
+
+
+def make_example(image_raw: bytes, label: str, corpus: int, label_codes: List[int]=None) -> tf.train.Example:
+    """
+    Builds the tf.train.Example of an image and its label. If `label_codes` are given (see `Params.encode_label`),
+    they are stored with their length so that the label needs no string processing during training
+    (records read with `encoded_labels=True`). The label string is stored in latin1 in any case, the encoding of the
+    labels read by `crnn_fn`, raises a UnicodeEncodeError if it has characters out of latin1
+    :param image_raw: encoded PNG image
+    :param label: transcription of the image
+    :param corpus: corpus id of the example
+    :param label_codes: codes of the characters of the label
+    :return: tf.train.Example
+    """
+    feature = {'image_raw': _bytes_feature(image_raw),
+               'label': _bytes_feature(label.encode('latin1')),
+               'corpus': _int64_feature(int(corpus))}
+    if label_codes is not None:
+        feature['label_codes'] = _int64_feature(list(label_codes))
+        feature['label_length'] = _int64_feature(len(label_codes))
+    return tf.train.Example(features=tf.train.Features(feature=feature))
+
+
+def sparse_label_codes(label_codes: tf.Tensor, label_lengths: tf.Tensor) -> tf.SparseTensor:
+    """
+    Converts a batch of label codes padded to the longest label into the sparse targets of the CTC loss
+    :param label_codes: [batch, max_length] int64 codes
+    :param label_lengths: [batch] length of each label
+    :return: SparseTensor of int32 codes with dense shape [batch, max_length]
+    """
+    indices = tf.where(tf.sequence_mask(label_lengths, tf.shape(label_codes)[1]))
+    return tf.SparseTensor(indices, tf.cast(tf.gather_nd(label_codes, indices), tf.int32),
+                           tf.shape(label_codes, out_type=tf.int64))
+
+
+def ctc_feasible(features: dict, label: tf.Tensor, encoded_labels: bool=False) -> tf.Tensor:
+    """
+    Checks that the CTC can align the label with the sequence of the image, i.e that the sequence (image_width / 4 - 1
+    steps, as computed in `crnn_fn`) holds the label and a blank between each pair of repeated characters
+    :param features: features of a parsed example (see `parse_example`)
+    :param label: label string (one character per byte, as converted in `crnn_fn`) or label codes
+    :param encoded_labels: `label` holds the label codes
+    :return: scalar bool
+    """
+    codes = label if encoded_labels else tf.decode_raw(label, tf.uint8)
+    n_repeats = tf.reduce_sum(tf.cast(tf.equal(codes[1:], codes[:-1]), tf.int32))
+    sequence_length = features['image_width'] // CONST.DIMENSION_REDUCTION_W_POOLING - 1
+    return tf.less_equal(tf.size(codes) + n_repeats, sequence_length)
+
+
+class DroppedExamplesCounter:
+    """Counts the examples dropped by a filter of the input pipeline, which runs in several threads"""
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def keep(self, keep_example: bool) -> bool:
+        if not keep_example:
+            with self._lock:
+                self.count += 1
+        return keep_example
+
+
+def to_uint8(images: tf.Tensor) -> tf.Tensor:
+    """Rounds images of float pixel values in [0, 255] to uint8, 4 times smaller to move and buffer"""
+    return tf.saturate_cast(tf.round(images), tf.uint8)
+
+
+def parse_example(serialized_example, output_shape=None, fixed_width=True, data_augmentation=False,
+                  distortion=False, distortion_bank=None, encoded_labels=False, uint8_images=False):
+    features = tf.parse_single_example(serialized_example, encoded_feature_spec if encoded_labels else feature_spec)
     # Important step: remove "label" from features!
     # Otherwise our classifier would simply learn to predict
     # label=features['label']...
-    label = features.pop('label')
+    if encoded_labels:
+        # Dense codes to be padded when batching, the length stays in the features
+        label = tf.sparse_tensor_to_dense(features.pop('label_codes'))
+    else:
+        label = features.pop('label')
 
     # Replace image_raw with the decoded & preprocessed version
     image = features.pop('image_raw')
     image = tf.image.decode_png(image, channels=1)
-    image = augment_data(image)
-    image, orig_width = padding_inputs_width(image, output_shape, increment=CONST.DIMENSION_REDUCTION_W_POOLING)
-    features['image'] = image
-    features['image_width'] = orig_width
+    features['image'], features['image_width'] = preprocess_image(image, output_shape, fixed_width, data_augmentation,
+                                                                  distortion, distortion_bank, uint8_images)
+
+    return features, label
+
+
+def preprocess_image(image, output_shape, fixed_width=True, data_augmentation=False, distortion=False,
+                     distortion_bank=None, uint8_images=False, padding_scale=1.0):
+    """
+    Augments, resizes (and pads if `fixed_width`) and distorts a decoded image (h x w x 1)
+    :param padding_scale: scale of the random padding of the augmentation (see `augment_data`)
+    :return: the preprocessed image (float32, or uint8 if `uint8_images`) and its width before padding
+    """
+    if data_augmentation:
+        image = augment_data(image, padding_scale)
+    if fixed_width:
+        image, orig_width = padding_inputs_width(image, output_shape, increment=CONST.DIMENSION_REDUCTION_W_POOLING)
+    else:
+        image, orig_width = resize_inputs_width(image, output_shape, increment=CONST.DIMENSION_REDUCTION_W_POOLING)
+    if distortion:
+        image = elastic_distortion(image, distortion_bank)
+    if uint8_images:
+        image = to_uint8(image)
+    return image, orig_width
+
+
+def parse_packed_example(index, packed_datasets: PackedDatasets, output_shape=None, fixed_width=True,
+                         data_augmentation=False, distortion=False, distortion_bank=None, encoded_labels=False,
+                         uint8_images=False):
+    """
+    Counterpart of `parse_example` for packed datasets : the image is read from the memory-mapped buffer,
+    already resized to the model height, so that no decoding is needed
+    :param index: index of the example in `packed_datasets`
+    :param packed_datasets: packed datasets to read from
+    (the other parameters are those of `parse_example`)
+    :return: features, label
+    """
+    output_types = [tf.uint8, tf.string, tf.int64] + ([tf.int64] if encoded_labels else [])
+    example = tf.py_func(packed_datasets.read, [index], output_types, stateful=False, name='read_packed_example')
+    image, label, corpus = example[:3]
+    image.set_shape([packed_datasets.height, None, 1])
+    label.set_shape([])
+    corpus.set_shape([])
+
+    features = {'corpus': corpus}
+    if encoded_labels:
+        label = example[3]
+        label.set_shape([None])
+        features['label_length'] = tf.size(label, out_type=tf.int64)
+    # The images were resized to the model height when packed, the random padding is scaled as if it was done
+    # before resizing
+    features['image'], features['image_width'] = preprocess_image(image, output_shape, fixed_width, data_augmentation,
+                                                                  distortion, distortion_bank, uint8_images,
+                                                                  padding_scale=packed_datasets.padding_scale)
 
     return features, label
 
 
-def make_input_fn(files_pattern, batch_size, output_shape, dynamic_distortion=False, repeat=True):
-    shaped_parse_example = partial(parse_example, output_shape=output_shape)
+def parse_batch(serialized_examples, output_shape=None, data_augmentation=False, distortion=False,
+                distortion_bank=None, parallel_iterations=4, encoded_labels=False, uint8_images=False):
+    """
+    Batched version of `parse_example` : parses a batch of serialized examples at once. Images are decoded and padded
+    in parallel and the data augmentation is applied to the whole batch (see `augment_batch`)
+    :param serialized_examples: batch of serialized examples
+    :param output_shape: (height, width) of the images
+    :param data_augmentation: apply random data augmentation to the batch
+    :param distortion: apply elastic distortion to the batch
+    :param distortion_bank: DistortionFieldBank to sample the distortions from (generated on the fly otherwise)
+    :param parallel_iterations: number of images decoded in parallel
+    :param encoded_labels: the records hold label codes (see `make_example`), labels are then the codes padded with 0
+        (see `sparse_label_codes`)
+    :param uint8_images: give the images as uint8 (see `to_uint8`)
+    :return: features, labels
+    """
+    if encoded_labels:
+        features = tf.parse_example(serialized_examples, encoded_feature_spec)
+        label = tf.sparse_tensor_to_dense(features.pop('label_codes'))
+    else:
+        features = tf.parse_example(serialized_examples, feature_spec)
+        label = features.pop('label')
+
+    def decode_and_pad_fn(image_raw):
+        image = tf.image.decode_png(image_raw, channels=1)
+        return padding_inputs_width(image, output_shape, increment=CONST.DIMENSION_REDUCTION_W_POOLING)
+
+    images, widths = tf.map_fn(decode_and_pad_fn, features.pop('image_raw'), dtype=(tf.float32, tf.int32),
+                               parallel_iterations=parallel_iterations, back_prop=False)
+    if data_augmentation:
+        images = augment_batch(images)
+    if distortion:
+        images = tf_distortion_maps(images, distortion_bank)
+    features['image'] = to_uint8(images) if uint8_images else images
+    features['image_width'] = widths
+
+    return features, label
+
+
+def make_input_fn(files_pattern, batch_size, output_shape, dynamic_distortion=False, repeat=True,
+                  bucket_width_step=None, pixel_budget=None, data_augmentation=False, shuffle=True,
+                  vectorized=False, cycle_length=4, block_length=16, shuffle_buffer_size=128, num_parallel_calls=4,
+                  prefetch_buffer_size=2, distortion_bank=None, initializable=False, encoded_labels=False,
+                  packed=False, record_index=False, keep_long_labels=False, drop_infeasible=False,
+                  global_shuffle=False, seed=0, first_epoch=0, resume_position=None, cache=None,
+                  uint8_images=False):
+    """
+    Creates the input function feeding the estimator
+    :param files_pattern: glob expression of the tfrecords files (of the `.packed.npz` index files if `packed`)
+    :param batch_size: number of examples per batch (when bucketing, used to derive the default `pixel_budget`)
+    :param output_shape: (height, width) of the images fed to the model. When bucketing, width is the maximum width
+    :param dynamic_distortion: elastic distortion, either False, 'batch' (or True) to distort the batches given by
+        the pipeline, or 'pipeline' to distort the examples in the parallel workers of the pipeline
+    :param repeat: repeat the dataset indefinitely (True) or the given number of times
+    :param bucket_width_step: if set, images are not padded to `output_shape` but only resized to its height and
+        grouped in buckets of widths multiple of this step. Batches then have a variable size and width
+    :param pixel_budget: maximum number of pixels (batch x height x width) in a bucketed batch.
+        Defaults to the number of pixels of a fixed batch, i.e batch_size x height x width
+    :param data_augmentation: apply random data augmentation to the examples (see `augment_data`). Otherwise
+        examples are only decoded, resized and padded, which is cheaper and deterministic (evaluation, inference)
+    :param shuffle: shuffle the files and the examples. Otherwise the examples are read in order and the last
+        incomplete batch is kept, so that all the examples are seen (evaluation)
+    :param vectorized: batch the serialized examples first and parse and augment whole batches (see `parse_batch`).
+        Cannot be used with bucketing
+    :param cycle_length: number of files read in parallel
+    :param block_length: number of consecutive records read from each file
+    :param shuffle_buffer_size: size (in records) of the shuffle buffer
+    :param num_parallel_calls: number of examples parsed in parallel
+    :param prefetch_buffer_size: number of batches prefetched
+    (see `Params.input_pipeline_params` for the autotuned values of the parallelism parameters)
+    :param distortion_bank: DistortionFieldBank to sample the elastic distortions from, instead of generating
+        a new displacement field for each image
+    :param initializable: use an initializable iterator, so that the same graph can go through the dataset
+        several times. Its initializer is added to the `CONST.INPUT_INITIALIZERS` collection
+    :param encoded_labels: the records hold the label codes (see `make_example`). Labels are then given as the
+        sparse CTC targets (int32 codes) and features have a 'label_length' entry
+    :param packed: read packed datasets of images already resized to the model height (see `PackedDatasets`)
+        instead of tfrecords. Examples are shuffled all together, cycle_length, block_length and
+        shuffle_buffer_size are not used. Cannot be used with vectorized parsing
+    :param drop_infeasible: drop the examples whose label is too long to be aligned by the CTC with the sequence of
+        their (augmented and resized) image (see `ctc_feasible`), before batching, instead of computing the model
+        on them for a zero gradient. Their number is counted by `input_fn.dropped_counter` and written to the
+        'input/ctc_infeasible_dropped' summary. Cannot be used with vectorized parsing
+    :param record_index: use the indices of the tfrecords files (see `record_index.py`) to skip the corrupt records
+        and those whose label does not fit in the CTC sequence before parsing them, and to choose the bucket
+        widths so that buckets hold the same number of examples
+    :param keep_long_labels: with record_index, only skip the corrupt records and keep the examples whose label does
+        not fit in the CTC sequence, so that the evaluation covers them (they count as errors)
+    :param global_shuffle: shuffle all the records of all the files together instead of shuffling the files and
+        mixing them in a small buffer (see `ShuffledRecords`). The tfrecords files must be indexed. The permutation
+        of each epoch is given by (seed, epoch), cycle_length, block_length and shuffle_buffer_size are not used
+    :param seed: seed of the permutations of global_shuffle
+    :param first_epoch: number of the first epoch read with global_shuffle (its permutation depends on it)
+    :param resume_position: with global_shuffle, position of the first record not yet used by the training
+        (see `saved_input_position`), the records before it are skipped without being read. The position of the
+        training is kept in the `CONST.INPUT_POSITION` variable, saved with the checkpoints. With bucketing,
+        the examples waiting in incomplete buckets when a checkpoint is saved are not seen again
+    :param cache: keep the batches once computed, to replay them instead of reading, decoding and padding the
+        examples again (evaluation) : 'memory' (the batches are computed when the first input_fn is called and kept
+        in the process) or a directory where they are written (see `tf.data.Dataset.cache`). The cache is specific
+        to the files (names, sizes and dates) and to the shapes and batching, it is not used if they change.
+        Cannot be used with shuffle or data_augmentation
+    :param uint8_images: give the images as uint8 (rounded once preprocessed, see `to_uint8`) instead of float32,
+        to divide by 4 the size of the batches buffered and fed to the model, which casts them (see `deep_cnn`).
+        The elastic distortion of the batches ('batch' dynamic_distortion) is applied to float32 images
+    :return: input_fn, with the `input_range` (start, end) positions and the `shuffled_records` of global_shuffle
+    """
+    bucketing = bucket_width_step is not None
+    assert not (bucketing and vectorized), 'Vectorized parsing needs fixed size images, it cannot be used with buckets'
+    distortion_in_pipeline = dynamic_distortion == 'pipeline'
+    shaped_parse_batch = partial(parse_batch, output_shape=output_shape, data_augmentation=data_augmentation,
+                                 distortion=distortion_in_pipeline, distortion_bank=distortion_bank,
+                                 parallel_iterations=num_parallel_calls, encoded_labels=encoded_labels,
+                                 uint8_images=uint8_images)
+    shaped_parse_example = partial(parse_example, output_shape=output_shape, fixed_width=not bucketing,
+                                   data_augmentation=data_augmentation, distortion=distortion_in_pipeline,
+                                   distortion_bank=distortion_bank, encoded_labels=encoded_labels,
+                                   uint8_images=uint8_images)
+    if pixel_budget is None:
+        pixel_budget = batch_size * output_shape[0] * output_shape[1]
+    assert not (drop_infeasible and vectorized), 'Infeasible examples are dropped one by one, not in parsed batches'
+    dropped_counter = DroppedExamplesCounter()
+    # Glob expression, or list of files (benchmarks)
+    filenames = sorted(glob(files_pattern)) if isinstance(files_pattern, str) else sorted(files_pattern)
+    if cache:
+        assert not (shuffle or data_augmentation), 'Only a deterministic input (evaluation) can be cached'
+        cache_key = input_cache_key(filenames, output_shape=output_shape, batch_size=batch_size,
+                                    bucket_width_step=bucket_width_step, pixel_budget=pixel_budget,
+                                    vectorized=vectorized, encoded_labels=encoded_labels, packed=packed,
+                                    record_index=record_index, keep_long_labels=keep_long_labels,
+                                    drop_infeasible=drop_infeasible,
+                                    uint8_images=uint8_images)
+        if cache != 'memory':
+            os.makedirs(cache, exist_ok=True)
+    if record_index:
+        assert not packed, 'Packed datasets are not indexed, they are filtered when packed'
+        indices = {os.path.abspath(filename): load_record_index(filename) for filename in filenames}
+        keep_masks = {filename: usable_records(index, output_shape, fixed_width=not bucketing,
+                                               keep_long_labels=keep_long_labels)
+                      for filename, index in indices.items()}
+        if bucketing:
+            bucket_widths = plan_bucket_widths(list(indices.values()), output_shape,
+                                               n_buckets=int(np.ceil(output_shape[1] / bucket_width_step)),
+                                               keep_long_labels=keep_long_labels)
+    if global_shuffle:
+        assert shuffle and not packed, 'Global shuffling is for shuffled tfrecords files'
+        shuffled_records = ShuffledRecords(filenames, seed, [keep_masks[os.path.abspath(filename)]
+                                                             for filename in filenames] if record_index else None)
+        start = first_epoch * len(shuffled_records)
+        if repeat is True:
+            end = np.iinfo(np.int64).max
+        else:
+            end = start + len(shuffled_records) * (repeat or 1)
+        if resume_position is not None:
+            start = min(max(start, resume_position), end)
+
+        # The position of each record goes with its features, to know which records the training has used
+        def parse_example_fn(record, position):
+            features, label = shaped_parse_example(record)
+            features[CONST.INPUT_POSITION] = position
+            return features, label
+
+        def parse_batch_fn(records, positions):
+            features, labels = shaped_parse_batch(records)
+            features[CONST.INPUT_POSITION] = positions
+            return features, labels
+    else:
+        parse_example_fn, parse_batch_fn = shaped_parse_example, shaped_parse_batch
+    if packed:
+        assert not vectorized, 'Packed datasets are read example by example, they cannot be used with vectorized parsing'
+        packed_datasets = PackedDatasets(filenames)
+        assert packed_datasets.has_label_codes or not encoded_labels, 'Packed datasets have no label codes'
+        shaped_parse_packed_example = partial(parse_packed_example, packed_datasets=packed_datasets,
+                                              output_shape=output_shape, fixed_width=not bucketing,
+                                              data_augmentation=data_augmentation, distortion=distortion_in_pipeline,
+                                              distortion_bank=distortion_bank, encoded_labels=encoded_labels,
+                                              uint8_images=uint8_images)
+
+    def batch_examples(ds):
+        if drop_infeasible:
+            def keep_fn(features, label):
+                keep = tf.py_func(dropped_counter.keep, [ctc_feasible(features, label, encoded_labels)], tf.bool,
+                                  name='count_dropped')
+                keep.set_shape([])
+                return keep
+            ds = ds.filter(keep_fn)
+        if bucketing:
+            ds = bucket_by_width(ds, output_shape, bucket_width_step, pixel_budget, encoded_labels,
+                                 bucket_widths=bucket_widths if record_index else None, with_position=global_shuffle,
+                                 uint8_images=uint8_images)
+        elif encoded_labels:
+            # Label codes have different lengths
+            padded_shapes, padding_values = _padded_batch_spec(output_shape, encoded_labels, fixed_width=True,
+                                                               with_position=global_shuffle,
+                                                               uint8_images=uint8_images)
+            if shuffle:
+                ds = ds.apply(tf.contrib.data.padded_batch_and_drop_remainder(batch_size, padded_shapes,
+                                                                              padding_values))
+            else:
+                ds = ds.padded_batch(batch_size, padded_shapes, padding_values)
+        elif shuffle:
+            ds = ds.apply(tf.contrib.data.batch_and_drop_remainder(batch_size))
+        else:
+            ds = ds.batch(batch_size)
+        return ds
+
+    def read_records(filename):
+        records = tf.data.TFRecordDataset(filename)
+        if record_index:
+            # The mask of the file is zipped with its records, filtered records are not parsed
+            keep = tf.py_func(lambda f: keep_masks[os.path.abspath(f.decode())], [filename], tf.bool,
+                              stateful=False)
+            keep.set_shape([None])
+            records = tf.data.Dataset.zip((records, tf.data.Dataset.from_tensor_slices(keep)))
+            records = records.filter(lambda record, keep_record: keep_record).map(lambda record, _: record)
+        return records
+
+    def make_batches():
+        if packed:
+            # Only the indices go through the shuffle buffer, it can hold the whole dataset
+            ds = tf.data.Dataset.range(len(packed_datasets))
+            if shuffle:
+                ds = ds.shuffle(buffer_size=len(packed_datasets))
+            ds = ds.map(shaped_parse_packed_example, num_parallel_calls=num_parallel_calls)
+            ds = batch_examples(ds)
+        else:
+            if global_shuffle:
+                # Positions in the sequence of the permuted epochs, each record is read at its offset
+                def read_record_fn(position):
+                    record = tf.py_func(shuffled_records.read, [position], tf.string, stateful=False,
+                                        name='read_shuffled_record')
+                    record.set_shape([])
+                    return record, position
+
+                ds = tf.data.Dataset.range(start, end).map(read_record_fn, num_parallel_calls=num_parallel_calls)
+            else:
+                files = tf.data.Dataset.list_files(files_pattern, shuffle=shuffle)
+                ds = files.apply(tf.contrib.data.parallel_interleave(
+                    read_records,
+                    cycle_length=cycle_length, block_length=block_length, sloppy=shuffle))
+
+                if shuffle:
+                    ds = ds.shuffle(buffer_size=shuffle_buffer_size) # small buffer since files were also shuffled
+            if vectorized:
+                # Batch the serialized examples, images of a batch are decoded by num_parallel_calls parallel
+                # iterations. Two batches are parsed at a time, so that one is ready when the other finishes
+                if shuffle:
+                    ds = ds.apply(tf.contrib.data.batch_and_drop_remainder(batch_size))
+                else:
+                    ds = ds.batch(batch_size)
+                ds = ds.map(parse_batch_fn, num_parallel_calls=2)
+            else:
+                # NOTE: using map_and_batch seems to decrease performance
+                ds = ds.map(parse_example_fn, num_parallel_calls=num_parallel_calls)
+                ds = batch_examples(ds)
+        return ds
 
     def input_fn():
-        files = tf.data.Dataset.list_files(files_pattern, shuffle=True)
-        ds = files.apply(tf.contrib.data.parallel_interleave(
-            tf.data.TFRecordDataset,
-            cycle_length=4, block_length=16, sloppy=True))
-
-        # NOTE: using map_and_batch seems to decrease performance
-        ds = (ds.shuffle(buffer_size=128) # small buffer since files were also shuffled
-                .map(shaped_parse_example, num_parallel_calls=4)
-                .apply(tf.contrib.data.batch_and_drop_remainder(batch_size))
-              )
-        if repeat:
+        if cache == 'memory':
+            ds = _materialized_dataset(make_batches, cache_key)
+        else:
+            ds = make_batches()
+            if cache:
+                ds = ds.cache(os.path.join(cache, 'input_cache_' + cache_key))
+        if encoded_labels:
+            ds = ds.map(lambda features, codes: (features, sparse_label_codes(codes, features['label_length'])),
+                        num_parallel_calls=2)
+        if global_shuffle:
+            pass  # the epochs are in the range of positions
+        elif repeat is True:
             ds = ds.repeat() # repeat indefinitely, and pass max_steps to the trainer
-        features, labels = ds.prefetch(2).make_one_shot_iterator().get_next()
-
-        if dynamic_distortion:
-            features['image'] = tf_distortion_maps(features.get('image'), batch_size)
+        elif repeat:
+            ds = ds.repeat(repeat)
+        ds = ds.prefetch(prefetch_buffer_size)
+        if initializable:
+            iterator = ds.make_initializable_iterator()
+            tf.add_to_collection(CONST.INPUT_INITIALIZERS, iterator.initializer)
+        else:
+            iterator = ds.make_one_shot_iterator()
+        features, labels = iterator.get_next()
+
+        if global_shuffle:
+            # The position advances when the batch is used by the training (not when it is prefetched)
+            position = input_position_variable()
+            update_position = tf.assign(position, tf.maximum(position,
+                                                             tf.reduce_max(features.pop(CONST.INPUT_POSITION)) + 1))
+            with tf.control_dependencies([update_position]):
+                features['image'] = tf.identity(features['image'])
+
+        if dynamic_distortion in [True, 'batch']:
+            features['image'] = tf_distortion_maps(tf.cast(features.get('image'), tf.float32), distortion_bank)
 
         tf.summary.image('input/image', features.get('image'), max_outputs=10)
-        tf.summary.text('input/labels', labels[:10])
+        if not encoded_labels:
+            tf.summary.text('input/labels', labels[:10])
         tf.summary.text('input/widths', tf.as_string(features.get('image_width')))
+        if drop_infeasible:
+            tf.summary.scalar('input/ctc_infeasible_dropped',
+                              tf.py_func(lambda: np.int64(dropped_counter.count), [], tf.int64))
 
         return features, labels
 
+    input_fn.dropped_counter = dropped_counter
+    input_fn.input_range = (start, end) if global_shuffle else None
+    input_fn.shuffled_records = shuffled_records if global_shuffle else None
     return input_fn
 
 
+def input_cache_key(filenames: List[str], **input_options) -> str:
+    """Hash of the files (names, sizes and modification times) and of the options giving the batches"""
+    files = [(os.path.abspath(filename), os.path.getsize(filename), os.path.getmtime(filename))
+             for filename in filenames]
+    description = json.dumps({'files': files, 'options': input_options}, sort_keys=True)
+    return hashlib.sha1(description.encode('utf8')).hexdigest()[:16]
+
+
+# Batches computed by `_materialized_dataset`, by cache key
+_materialized_batches = dict()
+
+
+def _materialized_dataset(make_batches, cache_key: str) -> tf.data.Dataset:
+    """
+    Dataset replaying the batches of the dataset given by `make_batches`, computed once in a separate graph
+    and kept in memory as numpy arrays
+    """
+    if cache_key not in _materialized_batches:
+        with tf.Graph().as_default():
+            ds = make_batches()
+            next_batch = ds.make_one_shot_iterator().get_next()
+            batches = list()
+            with tf.Session() as session:
+                while True:
+                    try:
+                        batches.append(session.run(next_batch))
+                    except tf.errors.OutOfRangeError:
+                        break
+        _materialized_batches[cache_key] = (batches, ds.output_types, ds.output_shapes)
+    batches, output_types, output_shapes = _materialized_batches[cache_key]
+    return tf.data.Dataset.from_generator(lambda: iter(batches), output_types, output_shapes)
+
+
+def input_position_variable() -> tf.Variable:
+    """Variable holding the position of the next record of the globally shuffled training input"""
+    return tf.get_variable(CONST.INPUT_POSITION, shape=[], dtype=tf.int64, initializer=tf.zeros_initializer(),
+                           trainable=False)
+
+
+def saved_input_position(model_dir: str) -> int:
+    """:return: position of the training input saved in the last checkpoint of model_dir, None if there is none"""
+    checkpoint = tf.train.latest_checkpoint(model_dir)
+    if checkpoint is None:
+        return None
+    try:
+        return int(tf.train.load_variable(checkpoint, CONST.INPUT_POSITION))
+    except tf.errors.NotFoundError:
+        return None
+
+
+def _padded_batch_spec(output_shape: Tuple[int, int], encoded_labels: bool, fixed_width: bool,
+                       with_position: bool=False, uint8_images: bool=False) -> tuple:
+    """Padded shapes and padding values of the (features, label) examples given by `parse_example`"""
+    padded_shapes = ({'image': [output_shape[0], output_shape[1] if fixed_width else None, 1],
+                      'image_width': [], 'corpus': []},
+                     [None] if encoded_labels else [])
+    # Images are padded with white (as in `padding_inputs_width`)
+    padding_values = ({'image': tf.constant(255, dtype=tf.uint8 if uint8_images else tf.float32),
+                       'image_width': tf.constant(0, dtype=tf.int32),
+                       'corpus': tf.constant(0, dtype=tf.int64)},
+                      tf.constant(0, dtype=tf.int64) if encoded_labels else tf.constant('', dtype=tf.string))
+    if encoded_labels:
+        padded_shapes[0]['label_length'] = []
+        padding_values[0]['label_length'] = tf.constant(0, dtype=tf.int64)
+    if with_position:
+        padded_shapes[0][CONST.INPUT_POSITION] = []
+        padding_values[0][CONST.INPUT_POSITION] = tf.constant(0, dtype=tf.int64)
+    return padded_shapes, padding_values
+
+
+def bucket_by_width(dataset: tf.data.Dataset, output_shape: Tuple[int, int], bucket_width_step: int,
+                    pixel_budget: int, encoded_labels: bool=False, bucket_widths: List[int]=None,
+                    with_position: bool=False, uint8_images: bool=False) -> tf.data.Dataset:
+    """
+    Groups the examples of `dataset` by image width and pads them to the upper width of their bucket.
+    The size of each batch is chosen so that it holds at most `pixel_budget` pixels
+    :param dataset: dataset of (features, label) with images of variable width (see `resize_inputs_width`)
+    :param output_shape: (height, max width) of the images
+    :param bucket_width_step: width range covered by each bucket
+    :param pixel_budget: maximum number of pixels (batch x height x width) in a batch
+    :param encoded_labels: labels are label codes of variable length (see `parse_example`)
+    :param bucket_widths: increasing upper widths of the buckets, the last one being the maximum width
+        (see `record_index.plan_bucket_widths`). Replaces the regular steps of bucket_width_step
+    :param with_position: features hold the position of the records of the global shuffle (see `make_input_fn`)
+    :param uint8_images: images are uint8 (see `to_uint8`)
+    :return: batched dataset
+    """
+    height, max_width = output_shape
+    if bucket_widths is None:
+        n_buckets = int(np.ceil(max_width / bucket_width_step))
+        bucket_widths = [min((i + 1) * bucket_width_step, max_width) for i in range(n_buckets)]
+
+        def key_fn(features, label):
+            return tf.cast((features['image_width'] - 1) // bucket_width_step, tf.int64)
+    else:
+        def key_fn(features, label):
+            # Index of the first bucket at least as wide as the image
+            smaller_widths = tf.less(tf.constant(bucket_widths[:-1], dtype=tf.int32), features['image_width'])
+            return tf.reduce_sum(tf.cast(smaller_widths, tf.int64))
+    bucket_batch_sizes = [max(1, pixel_budget // (height * w)) for w in bucket_widths]
+
+    def window_size_fn(key):
+        return tf.constant(bucket_batch_sizes, dtype=tf.int64)[key]
+
+    def reduce_fn(key, window):
+        padded_shapes, padding_values = _padded_batch_spec(output_shape, encoded_labels, fixed_width=False,
+                                                           with_position=with_position, uint8_images=uint8_images)
+        return window.padded_batch(window_size_fn(key), padded_shapes, padding_values)
+
+    return dataset.apply(tf.contrib.data.group_by_window(key_fn, reduce_fn, window_size_func=window_size_fn))
+
+
 def random_rotation(img: tf.Tensor, max_rotation: float=0.1, crop: bool=True) -> tf.Tensor:  # from SeguinBe
     with tf.name_scope('RandomRotation'):
         rotation = tf.random_uniform([], -max_rotation, max_rotation)
@@ -98,12 +634,15 @@ def random_padding(image: tf.Tensor, max_pad_w: int=5, max_pad_h: int=10) -> tf.
     return tf.pad(image, paddings, mode='CONSTANT', name='random_padding', constant_values=255)
 
 
-def augment_data(image: tf.Tensor) -> tf.Tensor:
-
+def augment_data(image: tf.Tensor, padding_scale: float=1.0) -> tf.Tensor:
+    """
+    :param padding_scale: scale of the maximum random padding, for images already resized (packed datasets)
+    """
     with tf.name_scope('DataAugmentation'):
 
         # Random padding
-        image = random_padding(image)
+        image = random_padding(image, max_pad_w=max(1, int(round(5 * padding_scale))),
+                               max_pad_h=max(1, int(round(10 * padding_scale))))
         image = random_rotation(image, 0.05, crop=True)
 
         image = tf.image.random_brightness(image, max_delta=0.1)
@@ -116,6 +655,52 @@ def augment_data(image: tf.Tensor) -> tf.Tensor:
 
         return image
 
+def augment_batch(images: tf.Tensor, max_rotation: float=0.05, max_zoom_out: float=0.15,
+                  max_delta_brightness: float=0.1, contrast_range: Tuple[float, float]=(0.5, 1.5)) -> tf.Tensor:
+    """
+    Vectorized data augmentation of a batch of images, each image gets its own random parameters.
+    Geometric augmentation (rotation and zoom out, which plays the role of the random padding of `augment_data`)
+    is done with a single projective transform per image, background is filled with white.
+    Photometric augmentation follows tf.image.random_brightness and tf.image.random_contrast
+    :param images: batch of images (N x h x w x c) with static height and width
+    :param max_rotation: maximum rotation angle (radians)
+    :param max_zoom_out: maximum zoom out factor (0.15 means the content can shrink to 1/1.15 of its size)
+    :param max_delta_brightness: maximum value added to the pixels, as a fraction of the pixel range [0, 255]
+    :param contrast_range: range of the contrast factor
+    :return: augmented images
+    """
+    with tf.name_scope('BatchDataAugmentation'):
+        batch_size = tf.shape(images)[0]
+        height, width = images.get_shape().as_list()[1:3]
+
+        # Geometric augmentation
+        angles = tf.random_uniform([batch_size], -max_rotation, max_rotation)
+        rotations = tf.contrib.image.angles_to_projective_transforms(angles, float(height), float(width))
+        # Output point (x, y) is sampled at (s*x + tx, s*y + ty) in the input image, with s > 1 the content shrinks.
+        # Offsets are chosen so that the whole input image stays in the output image
+        scales = tf.random_uniform([batch_size], 1.0, 1.0 + max_zoom_out)
+        offsets_x = tf.random_uniform([batch_size], 0.0, 1.0) * (1.0 - scales) * width
+        offsets_y = tf.random_uniform([batch_size], 0.0, 1.0) * (1.0 - scales) * height
+        zeros = tf.zeros([batch_size])
+        zooms = tf.stack([scales, zeros, offsets_x, zeros, scales, offsets_y, zeros, zeros], axis=1)
+        transforms = tf.contrib.image.compose_transforms(rotations, zooms)
+        # Pixels outside of the input image are set to 0, invert the images to have a white background
+        images = 255.0 - tf.contrib.image.transform(255.0 - images, transforms, interpolation='BILINEAR')
+
+        # Photometric augmentation. The pixels are in [0, 255] : as tf.image.random_brightness on uint8 images,
+        # the delta is a fraction of the pixel range, and the pixels are clipped to the range as when saturating
+        delta = 255.0 * tf.random_uniform([batch_size, 1, 1, 1], -max_delta_brightness, max_delta_brightness)
+        images = images + delta
+        contrast_factor = tf.random_uniform([batch_size, 1, 1, 1], contrast_range[0], contrast_range[1])
+        means = tf.reduce_mean(images, axis=[1, 2], keepdims=True)
+        images = (images - means) * contrast_factor + means
+        images = tf.clip_by_value(images, 0., 255.)
+
+        images.set_shape([None, height, width, None])
+
+        return images
+
+
 def padding_inputs_width(image: tf.Tensor, target_shape: Tuple[int, int], increment: int) -> Tuple[tf.Tensor, tf.Tensor]:
 
     target_shape = tuple(target_shape)
@@ -193,6 +778,28 @@ def padding_inputs_width(image: tf.Tensor, target_shape: Tuple[int, int], increm
     return pad_image, new_w  # new_w = image width used for computing sequence lengths
 
 
+def resize_inputs_width(image: tf.Tensor, target_shape: Tuple[int, int], increment: int) -> Tuple[tf.Tensor, tf.Tensor]:
+    """
+    Resizes the image to the target height keeping its ratio, without any padding.
+    The width is rounded to a multiple of `increment` and clipped to [2 x increment, target width]
+    :param image: image to resize (h x w x c)
+    :param target_shape: (height, max width) of the resized image
+    :param increment: the new width is a multiple of increment
+    :return: the resized image and its width
+    """
+    target_h, target_w = tuple(target_shape)
+    shape = tf.shape(image)
+    ratio = tf.divide(shape[1], shape[0], name='ratio')
+
+    new_w = tf.cast(tf.round((ratio * target_h) / increment) * increment, tf.int32)
+    new_w = tf.clip_by_value(new_w, 2 * increment, target_w)
+
+    img_resized = tf.image.resize_images(image, tf.stack([target_h, new_w]))
+    img_resized.set_shape([target_h, None, image.get_shape()[2]])
+
+    return img_resized, new_w
+
+
 def preprocess_image_for_prediction(fixed_height: int=32, min_width: int=8):
     """
     Input function to use when exporting the model for making predictions (see estimator.export_savedmodel)
@@ -218,6 +825,9 @@ def preprocess_image_for_prediction(fixed_height: int=32, min_width: int=8):
                                 false_fn=lambda: tf.image.resize_images(image, size=(fixed_height, new_width))
                                 )
 
+        # The image is at least min_width large, its sequence length should not be smaller
+        new_width = tf.maximum(new_width, min_width)
+
         # Features to serve (to send to the model)
         features = {'image': resized_image[None],  # cast to 1 x h x w x c
                     'image_width': new_width[None],  # cast to tensor
@@ -2,7 +2,7 @@
 __author__ = 'solivr'
 
 import tensorflow as tf
-from typing import List
+from typing import List, Tuple
 
 
 def get_words_from_chars(characters_list: List[str], sequence_lengths: List[int], name='chars_conversion'):
@@ -24,4 +24,33 @@ def get_words_from_chars(characters_list: List[str], sequence_lengths: List[int]
                         true_fn=lambda: coords_several_sequences(),
                         false_fn=lambda: coords_single_sequence())
 
-        return words
\ No newline at end of file
+        return words
+
+
+def ctc_decode(logits: tf.Tensor, sequence_length: tf.Tensor, decoder: str='beam', beam_width: int=100,
+               top_paths: int=1, name='ctc_decoding') -> Tuple[List[tf.SparseTensor], tf.Tensor]:
+    """
+    Decodes the output of the network with the chosen CTC decoder
+    :param logits: time major logits (max_time x batch x n_classes)
+    :param sequence_length: length of each sequence (batch,)
+    :param decoder: 'greedy' (best path) or 'beam' (beam search)
+    :param beam_width: width of the beam (only for 'beam')
+    :param top_paths: number of paths to return (only for 'beam', greedy decoding gives one path)
+    :return: list of decoded sparse tensors (one per path) and their log probability (batch x n_paths)
+    """
+    with tf.name_scope(name=name):
+        if decoder == 'greedy':
+            # Greedy decoder gives the sum of the best logit of each frame. With log probabilities
+            # this is the log probability of the best path, as given by the beam search decoder
+            decoded, neg_sum_logits = tf.nn.ctc_greedy_decoder(tf.nn.log_softmax(logits),
+                                                               sequence_length=sequence_length,
+                                                               merge_repeated=True)
+            return decoded, -neg_sum_logits
+        elif decoder == 'beam':
+            return tf.nn.ctc_beam_search_decoder(logits,
+                                                 sequence_length=sequence_length,
+                                                 merge_repeated=False,
+                                                 beam_width=beam_width,
+                                                 top_paths=top_paths)
+        else:
+            raise ValueError('Unknown decoder {}'.format(decoder))
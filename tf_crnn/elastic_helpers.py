@@ -1,32 +1,54 @@
+import threading
+import unicodedata
+import numpy as np
 import tensorflow as tf
 
-def sample(img, coords):
+def bilinear_sample(images: tf.Tensor, coords: tf.Tensor, border_mode: str='repeat',
+                    name: str='BilinearSample') -> tf.Tensor:
     """
-    Args:
-        img: bxhxwxc
-        coords: bxh2xw2x2. each coordinate is (y, x) integer.
-            Out of boundary coordinates will be clipped.
-    Return:
-        bxh2xw2xc image
+    Samples the images at real-valued coordinates by bilinear interpolation. The integer and fractional parts
+    of the coordinates are computed once and the four neighbours of every output pixel are fetched with
+    a single gather on the flattened images.
+    :param images: N x H x W x C tensor (any numeric type)
+    :param coords: N x H' x W' x 2 float32 tensor, each pair of the last dimension is a (y, x) coordinate
+    :param border_mode: 'repeat' (out of boundary coordinates are clipped) or 'constant' (zero-filled)
+    :return: N x H' x W' x C float32 tensor
     """
-    shape = tf.shape(img)[1:3]   # h, w, c
-    batch = tf.shape(img)[0]
-    shape2 = tf.shape(coords)[1:3]  # h2, w2
-
-    # clip each dimension individually
-    coords_y, coords_x = tf.split(coords, 2, axis=3)
-    coords_y = tf.clip_by_value(coords_y, 0., tf.cast(shape[0] - 1, tf.float32))
-    coords_x = tf.clip_by_value(coords_x, 0., tf.cast(shape[1] - 1, tf.float32))
-    coords = tf.concat([coords_y, coords_x], axis=3)
-    coords = tf.to_int32(coords)
-
-    batch_index = tf.range(batch, dtype=tf.int32)
-    batch_index = tf.reshape(batch_index, [-1, 1, 1, 1])
-    batch_index = tf.tile(batch_index, [1, shape2[0], shape2[1], 1])    # bxh2xw2x1
-    indices = tf.concat([batch_index, coords], axis=3) # bxh2xw2x3
-    sampled = tf.gather_nd(img, indices)
-
-    return tf.cast(sampled,tf.float32)
+    assert border_mode in ['repeat', 'constant']
+    with tf.name_scope(name):
+        shape = tf.shape(images)
+        batch, height, width, channels = shape[0], shape[1], shape[2], shape[3]
+        max_y, max_x = tf.cast(height - 1, tf.float32), tf.cast(width - 1, tf.float32)
+
+        coords_y, coords_x = tf.unstack(coords, axis=3)  # N x H' x W'
+        # negative coordinates are clamped before taking the fractional part, larger ones only when gathering
+        y, x = tf.maximum(coords_y, 0.), tf.maximum(coords_x, 0.)
+        y0, x0 = tf.floor(y), tf.floor(x)
+        frac_y, frac_x = y - y0, x - x0
+
+        y0_index = tf.to_int32(tf.minimum(y0, max_y))
+        y1_index = tf.to_int32(tf.minimum(y0 + 1., max_y))
+        x0_index = tf.to_int32(tf.minimum(x0, max_x))
+        x1_index = tf.to_int32(tf.minimum(x0 + 1., max_x))
+
+        # flat indices of the four neighbours in the (N*H*W) x C images
+        batch_offset = tf.reshape(tf.range(batch) * height * width, [-1, 1, 1])
+        row0 = batch_offset + y0_index * width
+        row1 = batch_offset + y1_index * width
+        indices = tf.stack([row0 + x0_index, row0 + x1_index, row1 + x0_index, row1 + x1_index])  # 4 x N x H' x W'
+        neighbours = tf.gather(tf.reshape(images, tf.stack([-1, channels])), indices)
+        neighbours = tf.cast(neighbours, tf.float32)  # 4 x N x H' x W' x C
+
+        weights = tf.stack([(1. - frac_y) * (1. - frac_x), (1. - frac_y) * frac_x,
+                            frac_y * (1. - frac_x), frac_y * frac_x])
+        sampled = tf.reduce_sum(neighbours * tf.expand_dims(weights, axis=4), axis=0)
+
+        if border_mode == 'constant':
+            inside = tf.logical_and(tf.logical_and(coords_y >= 0., coords_y <= max_y),
+                                    tf.logical_and(coords_x >= 0., coords_x <= max_x))
+            sampled *= tf.expand_dims(tf.cast(inside, tf.float32), axis=3)
+
+    return sampled
 
 def ImageSample(inputs, borderMode='repeat'):
     """
@@ -42,134 +64,168 @@ def ImageSample(inputs, borderMode='repeat'):
         tf.Tensor: a tensor named ``output`` of shape (N, H', W', C).
     """
     image, mapping = inputs
-
     assert image.get_shape().ndims == 4 and mapping.get_shape().ndims == 4
-    input_shape = tf.shape(image)[1:3]
-
-    print("input_image_Sample" ,image.get_shape().as_list())
-    print("input_mapping_Sample" ,mapping.get_shape().as_list())
-    #assert None not in input_shape
-
-    "Images in ImageSample layer must have fully-defined shape"
-    assert borderMode in ['repeat', 'constant']
-
-    orig_mapping = mapping
-    mapping = tf.maximum(mapping, 0.0)
-    lcoor = tf.floor(mapping)
-    ucoor = lcoor + 1.0
-
-    diff = mapping - lcoor
-    neg_diff = 1.0 - diff  # bxh2xw2x2
-
-    lcoory, lcoorx = tf.split(lcoor, 2, 3)
-    ucoory, ucoorx = tf.split(ucoor, 2, 3)
-
-    lyux = tf.concat([lcoory, ucoorx], 3)
-    uylx = tf.concat([ucoory, lcoorx], 3)
-
-    diffy, diffx = tf.split(diff, 2, 3)
-    neg_diffy, neg_diffx = tf.split(neg_diff, 2, 3)
 
-    ret = tf.add_n([sample(image, lcoor) * neg_diffx * neg_diffy,
-                    sample(image, ucoor) * diffx * diffy,
-                    sample(image, lyux) * neg_diffy * diffx,
-                    sample(image, uylx) * diffy * neg_diffx], name='sampled')
+    return tf.identity(bilinear_sample(image, mapping, borderMode), name='output')
 
-    print("ret:", ret.get_shape().as_list())
-
-    if borderMode == 'constant':
-        max_coor = tf.cast(tf.stack([input_shape[0] - 1, input_shape[1] - 1]),tf.float32)
-        mask = tf.greater_equal(orig_mapping, 0.0)
-        mask2 = tf.less_equal(orig_mapping, max_coor)
-        mask = tf.logical_and(mask, mask2)  # bxh2xw2x2
-        mask = tf.reduce_all(mask, [3])  # bxh2xw2 boolean
-        mask = tf.expand_dims(mask, 3)
-        ret = ret * tf.cast(mask, tf.float32)
-
-    return tf.identity(ret, name='output')
-
-
-def _gauss_kernel(sigma, channels=1):
-    """Return a gaussian kernel for the given sigma"""
-    # compute length according to https://stackoverflow.com/a/25217058/786559
 
+def _gauss_kernel_1d(sigma):
+    """Return a 1D gaussian kernel for the given sigma (truncated at 4 std dev, as scipy.ndimage.gaussian_filter)"""
     size = 2 * tf.to_int32(4 * sigma + 0.5) + 1  # truncate at 4 std dev
-    size = tf.squeeze(size)
 
-    # implement according to https://stackoverflow.com/a/46526319/786559
     from_to = tf.to_float(tf.floor_div(size, 2))
     x = tf.linspace(-from_to, from_to, size)
     x /= sigma * tf.sqrt(2.)
-    x2 = x**2
-    kernel = tf.exp(- x2[:, None] - x2[None, :])
+    kernel = tf.exp(- x**2)
     kernel /= tf.reduce_sum(kernel)
-    kernel = tf.stack([kernel] * channels, axis=2)
-    kernel = tf.expand_dims(kernel, axis=-1)
 
     return kernel
 
-def gaussian_filter_tf(image, sigma, name='Gaussian'):
-    """Perform a 2D smoothing with a gaussian filter.
+def separable_gaussian_filter(images, sigma, name='SeparableGaussian'):
+    """Perform a 2D smoothing with a gaussian filter, as a vertical then an horizontal 1D convolution.
 
-    This is a pure TensorFlow implementation of
-    scipy.ndimage.gaussian_filter, with default values
-    (truncate=4.0, order=0)
+    Same result as a 2D gaussian convolution (with 'SAME' padding) for a cost of 2 x size
+    instead of size x size multiplications per pixel
 
     Parameters:
-        image: [W x H x C] tensor
-        sigma: tensor of shape [1]
-
-    NOTE: It uses 'SAME' padding for the convolution. However, as
-    opposed to scipy, it does directly a 2D convolution, instead of
-    a series of 1D convolutions for each axis
+        images: [N x H x W x C] tensor, C must be known
+        sigma: scalar tensor
     """
-    assert len(image.shape.as_list()) == 3, 'Input image should be in WHC format'
+    n_channels = images.shape.as_list()[-1]
     with tf.name_scope(name):
         with tf.name_scope('kernel'):
-            kernel = _gauss_kernel(sigma, image.shape.as_list()[-1])
-        image = tf.expand_dims(image, 0) # add the batch component
-        output = tf.nn.depthwise_conv2d(image, kernel, [1,1,1,1], padding='SAME')
-        #print("gaussian shape before squeeze", tf.shape(output).eval())
-        #print("gaussian output:", output.get_shape().ndims)
-
-    return tf.squeeze((output), [0,-1]) #Specify first and last dimension to be removed
-
-def tf_distortion_maps(img: tf.Tensor, batch_size: int = 128) -> tf.Tensor:
-    """ Input image (N,h,w,1)"""
-    with tf.device("/device:GPU:0"):
-        orig_shape = img.shape.as_list()
-        height, width = orig_shape[1:3]
-
-        # the magnitute of the deformation, alpha, depends on the size of the img
-        # we found a good number is the height of the image
-        alpha = tf.cast(height,tf.float32)
-        sigma = tf.abs(tf.random_normal([1], 8, 2))
-        #sigma = tf.cond(sigma < 4 , lambda: 4 , lambda: sigma)
-
-        dispx = tf.random_uniform([height, width, 1], minval=-1, maxval=1)
-        dispy = tf.random_uniform([height, width, 1], minval=-1, maxval=1)
-
-        # TODO: since sigma comes from a random tensor, make sure it has the same
-        # value in both places (normally the tensor yields a new val at each eval)
-        dispx = alpha * gaussian_filter_tf(dispx, sigma)
-        dispy = alpha * gaussian_filter_tf(dispy, sigma)
+            kernel = _gauss_kernel_1d(sigma)
+            kernel = tf.tile(kernel[:, None, None], [1, n_channels, 1])  # size x C x 1
+            kernel_vertical = tf.expand_dims(kernel, axis=1)  # size x 1 x C x 1
+            kernel_horizontal = tf.expand_dims(kernel, axis=0)  # 1 x size x C x 1
+        output = tf.nn.depthwise_conv2d(images, kernel_vertical, [1, 1, 1, 1], padding='SAME')
+        output = tf.nn.depthwise_conv2d(output, kernel_horizontal, [1, 1, 1, 1], padding='SAME')
+
+    return output
+
+class DistortionFieldBank:
+    """
+    Bank of precomputed smoothed displacement fields, sampled to distort images instead of generating
+    a new field at each step (see `tf_distortion_maps`). Fields are generated with numpy as in
+    `tf_distortion_maps` (uniform noise, gaussian smoothing, magnitude alpha) and can be refreshed
+    in a background thread. Each sampled field is a random crop of a random field of the bank,
+    randomly flipped horizontally and vertically.
+    """
+    def __init__(self, size: int, height: int, width: int, alpha: float=None, sigma_mean: float=8.,
+                 sigma_std: float=2., seed: int=None):
+        """
+        :param size: number of fields in the bank
+        :param height: height of the images to distort
+        :param width: maximum width of the images to distort
+        :param alpha: magnitude of the displacements (defaults to the height)
+        :param sigma_mean: mean of the standard deviation of the gaussian smoothing
+        :param sigma_std: standard deviation of the standard deviation of the gaussian smoothing
+        :param seed: seed of the random generator
+        """
+        self.height, self.width = height, width
+        self.alpha = height if alpha is None else alpha
+        self.sigma_mean, self.sigma_std = sigma_mean, sigma_std
+        self._rng = np.random.RandomState(seed)
+        self._lock = threading.Lock()
+        self._stop_refresh = threading.Event()
+        self._refresh_thread = None
+        self._fields = np.stack([self._new_field() for _ in range(size)])  # size x h x w x 2
+
+    @staticmethod
+    def _smooth_axis(array, kernel, axis):
+        # 'SAME' convolution with zero padding, as separable_gaussian_filter (kernel can be longer than the array)
+        start = (len(kernel) - 1) // 2
+        return np.apply_along_axis(lambda v: np.convolve(v, kernel, mode='full')[start:start + len(v)], axis, array)
+
+    def _new_field(self) -> np.ndarray:
+        sigma = max(abs(self._rng.normal(self.sigma_mean, self.sigma_std)), 0.5)
+        half_size = int(4 * sigma + 0.5)  # truncate at 4 std dev
+        x = np.arange(-half_size, half_size + 1) / (sigma * np.sqrt(2.))
+        kernel = np.exp(- x**2)
+        kernel /= np.sum(kernel)
+
+        disp = self._rng.uniform(-1, 1, size=[self.height, self.width, 2])
+        disp = self._smooth_axis(self._smooth_axis(disp, kernel, axis=0), kernel, axis=1)
+        return (self.alpha * disp).astype(np.float32)
+
+    def refresh(self, n_fields: int=1) -> None:
+        """Replaces `n_fields` random fields of the bank by new ones"""
+        for _ in range(n_fields):
+            field = self._new_field()
+            with self._lock:
+                self._fields[self._rng.randint(len(self._fields))] = field
+
+    def start_refresh(self, interval_secs: float) -> None:
+        """Replaces one field of the bank every `interval_secs` seconds in a background thread"""
+        def refresh_loop():
+            while not self._stop_refresh.wait(interval_secs):
+                self.refresh()
+
+        self._refresh_thread = threading.Thread(target=refresh_loop, name='DistortionFieldBankRefresh', daemon=True)
+        self._refresh_thread.start()
+
+    def stop_refresh(self) -> None:
+        self._stop_refresh.set()
+        if self._refresh_thread is not None:
+            self._refresh_thread.join()
+
+    def sample(self, batch_size: int, width: int) -> np.ndarray:
+        """
+        Samples (y, x) displacement fields for a batch of images of the given width
+        :return: batch_size x height x width x 2 float32 array
+        """
+        fields = np.empty([batch_size, self.height, width, 2], dtype=np.float32)
+        for i in range(batch_size):
+            index, start = self._rng.randint(len(self._fields)), self._rng.randint(self.width - width + 1)
+            flip_x, flip_y = self._rng.rand(2) < 0.5
+            with self._lock:
+                fields[i] = self._fields[index, :, start:start + width]
+            # Flipping a field also flips the sign of the displacements along this axis
+            if flip_x:
+                fields[i] = fields[i, :, ::-1] * np.array([1, -1], dtype=np.float32)
+            if flip_y:
+                fields[i] = fields[i, ::-1] * np.array([-1, 1], dtype=np.float32)
+        return fields
+
+def tf_distortion_maps(img: tf.Tensor, field_bank: DistortionFieldBank=None) -> tf.Tensor:
+    """ Elastic distortion of the images (N,h,w,c), batch size and width can be dynamic.
+    Each image gets its own random displacement field. It runs on any device and can be used
+    in the input pipeline (see `elastic_distortion`). If `field_bank` is given, the displacement
+    fields are sampled from it instead of being generated"""
+    with tf.name_scope('ElasticDistortion'):
+        shape = tf.shape(img)
+        batch_size, height, width = shape[0], shape[1], shape[2]
+
+        if field_bank is not None:
+            disp = tf.py_func(lambda n, w: field_bank.sample(int(n), int(w)), [batch_size, width], tf.float32,
+                              stateful=True, name='sample_distortion_fields')
+        else:
+            # the magnitute of the deformation, alpha, depends on the size of the img
+            # we found a good number is the height of the image
+            alpha = tf.cast(height,tf.float32)
+            # same sigma for the x and y displacements, kept away from 0 (kernel computation)
+            sigma = tf.maximum(tf.abs(tf.random_normal([], 8, 2)), 0.5)
+
+            # (y, x) displacements, one field per image
+            disp = tf.random_uniform(tf.stack([batch_size, height, width, 2]), minval=-1, maxval=1)
+            disp.set_shape([None, None, None, 2])
+            disp = alpha * separable_gaussian_filter(disp, sigma)
+        disp.set_shape([None, None, None, 2])
 
         # get the real coordinates to which we add the displacements
-        xs = tf.range(0, tf.cast(width,tf.float32), dtype=tf.float32)
         ys = tf.range(0, tf.cast(height,tf.float32), dtype=tf.float32)
-        # use the broadcasting to achieve the same as meshgrid
-        ys = tf.expand_dims(ys, axis=1)
-
-        dispx += xs
-        dispy += ys
-        coords = tf.stack([dispy, dispx], axis=2)
+        xs = tf.range(0, tf.cast(width,tf.float32), dtype=tf.float32)
+        grid = tf.stack([tf.tile(tf.expand_dims(ys, axis=1), tf.stack([1, width])),
+                         tf.tile(tf.expand_dims(xs, axis=0), tf.stack([height, 1]))], axis=2)  # h x w x 2
+        coords = disp + grid
 
-        # stack coords to have dimension (B,H,W,2)
-        coords = [coords for i in range(batch_size)]
-        coords = tf.stack(coords)
+    distorted = ImageSample((img,coords))
+    distorted.set_shape(img.get_shape())
+    return distorted
 
-    img = ImageSample((img,coords))
-    return img
+def elastic_distortion(image: tf.Tensor, field_bank: DistortionFieldBank=None) -> tf.Tensor:
+    """ Elastic distortion of a single image (h,w,c), to use in the input pipeline workers"""
+    return tf.squeeze(tf_distortion_maps(tf.expand_dims(image, axis=0), field_bank), axis=[0])
 
 def normalize_text(text):
     """Remove accents and other stuff from text"""
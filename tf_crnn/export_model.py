@@ -1,23 +1,151 @@
 #!/usr/bin/env python
 __author__ = 'solivr'
 
-from src.data_handler import preprocess_image_for_prediction, data_loader
-from src.model import crnn_fn
-import tensorflow as tf
 import os
+import json
+import time
 import argparse
+from glob import glob
+import numpy as np
+import tensorflow as tf
 try:
     import better_exceptions
 except ImportError:
     pass
-from src.config import Params, import_params_from_json
+from .config import Params, import_params_from_json
+from .frozen_graph import INPUT_NODES, OUTPUT_NODES, freeze_inference_graph, optimize_for_inference, \
+    load_frozen_graph, read_lines, predict_line, predict_line_logits, character_error_rate
+from .train_continuous import export_model
+from .bench.helpers import summarize_times
+
+FROZEN_GRAPH_FILENAME = 'frozen_inference_graph.pb'
+
+
+def verify_frozen_graph(graph_def: tf.GraphDef, reference_graph_def: tf.GraphDef, lines: list,
+                        logits_tolerance: float=1e-2) -> dict:
+    """
+    Checks that the optimized graph gives the logits of the graph frozen from the checkpoint without any change
+    (batch norms not folded, no transforms) up to `logits_tolerance`, raises a RuntimeError otherwise. The folded
+    batch norms round differently, so a few lines with close logits may be decoded differently
+    :return: number of lines checked, largest difference of the logits, number of lines decoded differently and
+        character error rates of both graphs on them
+    """
+    outputs = dict()
+    for name, graph in [('optimized', graph_def), ('reference', reference_graph_def)]:
+        with tf.Session(graph=load_frozen_graph(graph)) as session:
+            outputs[name] = [predict_line_logits(session, image, corpus) for image, corpus, _ in lines]
+
+    max_difference = max(float(np.max(np.abs(logits - reference_logits)))
+                         for (logits, _), (reference_logits, _) in zip(outputs['optimized'], outputs['reference']))
+    if max_difference > logits_tolerance:
+        raise RuntimeError('The logits of the optimized graph differ from those of the checkpoint by up to {:.2e} '
+                           '(tolerance {:.2e})'.format(max_difference, logits_tolerance))
+
+    targets = [codes for _, _, codes in lines]
+    predictions = [codes for _, codes in outputs['optimized']]
+    references = [codes for _, codes in outputs['reference']]
+    return {'n_lines': len(lines), 'max_logits_difference': max_difference,
+            'n_different_decodings': sum(p != r for p, r in zip(predictions, references)),
+            'CER': character_error_rate(predictions, targets),
+            'reference_CER': character_error_rate(references, targets)}
+
+
+def export_frozen_graph(params: Params, checkpoint: str, output_dir: str, check_lines: list=None,
+                        logits_tolerance: float=1e-2) -> (str, dict):
+    """
+    Writes the inference graph of the checkpoint, frozen and optimized (batch norms folded, see
+    `frozen_graph.INFERENCE_TRANSFORMS`), with the parameters of the model to decode its codes
+    :param check_lines: lines (see `frozen_graph.read_lines`) to verify the optimized graph before writing it
+    :param logits_tolerance: largest difference of the logits accepted by the verification
+    :return: filename of the frozen graph and results of the verification (see `verify_frozen_graph`)
+    """
+    graph_def = optimize_for_inference(freeze_inference_graph(params, checkpoint))
+    verification = dict()
+    if check_lines:
+        verification = verify_frozen_graph(graph_def, freeze_inference_graph(params, checkpoint,
+                                                                             fold_batch_norms=False), check_lines,
+                                           logits_tolerance)
+
+    os.makedirs(output_dir, exist_ok=True)
+    filename = os.path.join(output_dir, FROZEN_GRAPH_FILENAME)
+    with tf.gfile.GFile(filename, 'wb') as f:
+        f.write(graph_def.SerializeToString())
+    with open(os.path.join(output_dir, 'model_params.json'), 'w') as f:
+        json.dump(vars(params), f)
+    return filename, verification
+
+
+def _directory_size(directory: str) -> int:
+    return sum(os.path.getsize(os.path.join(root, filename))
+               for root, _, filenames in os.walk(directory) for filename in filenames)
+
+
+def benchmark_frozen_graph(filename: str, lines: list) -> dict:
+    """:return: time to load the graph until its first prediction, latency per line and size of the frozen graph"""
+    start = time.perf_counter()
+    graph_def = tf.GraphDef()
+    with tf.gfile.GFile(filename, 'rb') as f:
+        graph_def.ParseFromString(f.read())
+    session = tf.Session(graph=load_frozen_graph(graph_def))
+    load_time = time.perf_counter() - start
+    # The graph is optimized and the memory allocated at the first run
+    predict_line(session, *lines[0][:2])
+    first_prediction_time = time.perf_counter() - start
+
+    times = list()
+    for image, corpus, _ in lines:
+        start = time.perf_counter()
+        predict_line(session, image, corpus)
+        times.append(time.perf_counter() - start)
+    session.close()
+
+    return {'load_s': load_time, 'first_prediction_s': first_prediction_time, 'latency': summarize_times(times),
+            'n_nodes': len(graph_def.node), 'size_mb': os.path.getsize(filename) / 2**20}
+
+
+def benchmark_saved_model(export_dir: str, lines: list) -> dict:
+    """Counterpart of `benchmark_frozen_graph` for the SavedModel export (see `train_continuous.export_model`)"""
+    start = time.perf_counter()
+    session = tf.Session(graph=tf.Graph())
+    with session.graph.as_default():
+        meta_graph = tf.saved_model.loader.load(session, [tf.saved_model.tag_constants.SERVING], export_dir)
+    signature = meta_graph.signature_def['predictions']
+    load_time = time.perf_counter() - start
+
+    def predict_fn(image, corpus):
+        return session.run(signature.outputs['words'].name,
+                           feed_dict={signature.inputs['images'].name: image,
+                                      signature.inputs['corpora'].name: [corpus]})
+
+    predict_fn(*lines[0][:2])
+    first_prediction_time = time.perf_counter() - start
+
+    times = list()
+    for image, corpus, _ in lines:
+        start = time.perf_counter()
+        predict_fn(image, corpus)
+        times.append(time.perf_counter() - start)
+    session.close()
+
+    return {'load_s': load_time, 'first_prediction_s': first_prediction_time, 'latency': summarize_times(times),
+            'n_nodes': len(meta_graph.graph_def.node), 'size_mb': _directory_size(export_dir) / 2**20}
 
 
 if __name__ == '__main__':
-    parser = argparse.ArgumentParser()
+    parser = argparse.ArgumentParser(description='Exports a trained model as a frozen inference graph (network and '
+                                                 'greedy decoding only, batch norms and constants folded) and '
+                                                 'compares its load time and latency per line with the SavedModel')
     parser.add_argument('-m', '--model_dir', type=str, help='Directory of model to be exported', default='./model')
     parser.add_argument('-e', '--output_dir', type=str, help='Output directory (for exported model)', default='./exported_model')
+    parser.add_argument('-c', '--checkpoint', type=str, help='Checkpoint to export (latest one if not given)')
     parser.add_argument('-g', '--gpu', type=str, help='GPU 1, 0 or '' for CPU', default='')
+    parser.add_argument('-s', '--saved_model', type=str,
+                        help='SavedModel to compare with (exported from the checkpoint if not given)')
+    parser.add_argument('-n', '--n_lines', type=int, default=200,
+                        help='Number of lines of tfrecords_eval to verify the optimized graph and measure the latency, '
+                             '0 to skip the verification and the comparison')
+    parser.add_argument('--logits_tolerance', type=float, default=1e-2,
+                        help='Largest difference of the logits between the optimized graph and the checkpoint')
     args = vars(parser.parse_args())
 
     os.environ['CUDA_VISIBLE_DEVICES'] = args.get('gpu')
@@ -29,42 +157,35 @@ if __name__ == '__main__':
     params = Params(**params_json)
     print(params)
 
-    # Config
-    est_config = tf.estimator.RunConfig()
-    est_config.replace(keep_checkpoint_max=10,
-                       save_checkpoints_steps=params.save_interval,
-                       session_config=config_sess,
-                       save_checkpoints_secs=None,
-                       save_summary_steps=1000)
-
-    model_params = {
-        'Params': params,
-    }
-
-    estimator = tf.estimator.Estimator(model_fn=crnn_fn, params=model_params,
-                                       model_dir=args.get('model_dir'),
-                                       config=est_config,
-                                       )
-    estimator.train(input_fn=data_loader(csv_filename=params.csv_files_train,
-                                         params=params,
-                                         batch_size=1,
-                                         num_epochs=1,
-                                         data_augmentation=True,
-                                         image_summaries=True))
-
-    estimator.export_savedmodel(args.get('export_dir'),
-                                serving_input_receiver_fn=preprocess_image_for_prediction(min_width=10))
-
-
-#
-# def _signature_def_to_tensors(signature_def):
-#     g = tf.get_default_graph()
-#     return {k: g.get_tensor_by_name(v.name) for k,v in signature_def.inputs.items()}, \
-#            {k: g.get_tensor_by_name(v.name) for k,v in signature_def.outputs.items()}
-#
-# with tf.Session(graph=tf.Graph()) as sess:
-#     loaded_model = tf.saved_model.loader.load(sess, ["serve"], './exported_models/1499264748/')
-#     input_dict, output_dict =_signature_def_to_tensors(loaded_model.signature_def['predictions'])
-#     out = sess.run(output_dict, feed_dict={input_dict['images']: img_test[:,:,None]})
-
-# to see all : saved_model_cli show --dir . --all
+    checkpoint = args.get('checkpoint') or tf.train.latest_checkpoint(args.get('model_dir'))
+    lines = read_lines(sorted(glob(params.tfrecords_eval)), params, args.get('n_lines')) \
+        if args.get('n_lines') > 0 else list()
+    frozen_graph_filename, verification = export_frozen_graph(params, checkpoint, args.get('output_dir'),
+                                                               check_lines=lines,
+                                                               logits_tolerance=args.get('logits_tolerance'))
+    print('Frozen inference graph : {} (inputs {}, outputs {})'.format(frozen_graph_filename, INPUT_NODES,
+                                                                      OUTPUT_NODES))
+
+    if lines:
+        print('Logits within {:.2e} of the checkpoint on {} lines ({} decoded differently), CER {:.4f} '
+              '(checkpoint {:.4f})'.format(verification['max_logits_difference'], verification['n_lines'],
+                                          verification['n_different_decodings'], verification['CER'],
+                                          verification['reference_CER']))
+        saved_model_dir = args.get('saved_model')
+        if saved_model_dir is None:
+            saved_model_dir = export_model(params, config_sess, checkpoint_path=checkpoint).decode()
+
+        report = {'checkpoint': checkpoint, 'n_lines': len(lines), 'verification': verification,
+                  'frozen_graph': benchmark_frozen_graph(frozen_graph_filename, lines),
+                  'saved_model': benchmark_saved_model(saved_model_dir, lines)}
+        report['saved_model']['export_dir'] = saved_model_dir
+        report['saved_model']['decoder'] = params.eval_decoder
+        report['frozen_graph']['decoder'] = 'greedy'
+        for name in ['saved_model', 'frozen_graph']:
+            print('{:<12}: {:>6} nodes, {:>7.2f} MB, loaded in {:.2f} s (first prediction {:.2f} s), '
+                  'p50 {:>8.2f} ms per line'.format(name, report[name]['n_nodes'], report[name]['size_mb'],
+                                                    report[name]['load_s'], report[name]['first_prediction_s'],
+                                                    report[name]['latency']['p50_ms']))
+
+        with open(os.path.join(args.get('output_dir'), 'export_report.json'), 'w') as f:
+            json.dump(report, f, indent=2)
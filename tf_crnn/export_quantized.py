@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+import os
+import json
+import time
+import argparse
+import tempfile
+from glob import glob
+import tensorflow as tf
+from .config import Params, import_params_from_json
+from .frozen_graph import INPUT_NODES, OUTPUT_NODES, freeze_inference_graph, optimize_for_inference, \
+    load_frozen_graph, read_lines, predict_line, character_error_rate
+from .bench.helpers import summarize_times
+
+# The float graph has its batch norms already folded into the convolutions (see `frozen_graph.folded_batch_norms`),
+# so that they are quantized with them
+PREPARE_TRANSFORMS = ['add_default_attributes', 'fold_constants(ignore_errors=true)']
+# Weights stored in 8 bits, dequantized to float32 when the graph is loaded
+WEIGHTS_TRANSFORMS = PREPARE_TRANSFORMS + ['quantize_weights', 'sort_by_execution_order']
+# Weights and activations in 8 bits : the supported ops (convolutions, matmuls, relus, poolings...) are replaced
+# by their quantized kernels, with the ranges of their outputs computed at each run until they are calibrated
+NODES_TRANSFORMS = PREPARE_TRANSFORMS + ['quantize_weights', 'quantize_nodes', 'sort_by_execution_order']
+REQUANTIZATION_LOG_PREFIX = '__requant_min_max:'
+
+
+def transform_graph(graph_def: tf.GraphDef, transforms: list) -> tf.GraphDef:
+    return optimize_for_inference(graph_def, transforms)
+
+
+def calibrate_requantization_ranges(graph_def: tf.GraphDef, lines: list) -> tf.GraphDef:
+    """
+    Replaces the ranges of the activations computed at each run by those observed on calibration lines :
+    the graph is run with the ranges logged (on stderr), then frozen to their extremes
+    :param graph_def: graph with quantized nodes (see `NODES_TRANSFORMS`)
+    :param lines: calibration lines (see `frozen_graph.read_lines`)
+    :return: the calibrated graph
+    """
+    logging_graph_def = transform_graph(graph_def, [
+        'insert_logging(op=RequantizationRange, show_name=true, message="{}")'.format(REQUANTIZATION_LOG_PREFIX)])
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        log_filename = os.path.join(tmp_dir, 'requantization_ranges.log')
+        # The Print ops write to the stderr of the process, not to sys.stderr
+        stderr_fd = os.dup(2)
+        with open(log_filename, 'w') as log_file:
+            os.dup2(log_file.fileno(), 2)
+            try:
+                with tf.Session(graph=load_frozen_graph(logging_graph_def)) as session:
+                    for image, corpus, _ in lines:
+                        predict_line(session, image, corpus)
+            finally:
+                os.dup2(stderr_fd, 2)
+                os.close(stderr_fd)
+
+        return transform_graph(graph_def, ['freeze_requantization_ranges(min_max_log_file="{}")'.format(log_filename),
+                                           'fold_constants(ignore_errors=true)', 'sort_by_execution_order'])
+
+
+def evaluate_graph(graph_def: tf.GraphDef, lines: list, n_warmup: int=5) -> dict:
+    """
+    Decodes the lines one at a time with the frozen graph
+    :return: size of the graph, character error rate and latency per line (see `summarize_times`)
+    """
+    predictions, times = list(), list()
+    with tf.Session(graph=load_frozen_graph(graph_def)) as session:
+        for image, corpus, _ in lines[:n_warmup]:
+            predict_line(session, image, corpus)
+        for image, corpus, _ in lines:
+            start = time.perf_counter()
+            predictions.append(predict_line(session, image, corpus))
+            times.append(time.perf_counter() - start)
+
+    results = {'size_mb': graph_def.ByteSize() / 2**20,
+               'CER': character_error_rate(predictions, [codes for _, _, codes in lines]),
+               'latency': summarize_times(times)}
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Exports a trained model as frozen graphs with 8 bits weights, '
+                                                 'and with 8 bits weights and activations calibrated on lines of '
+                                                 'tfrecords_eval, and compares their CER, size and latency per '
+                                                 'line on CPU with the float model')
+    parser.add_argument('params_file', type=str, help='Parameters filename (JSON) of the model')
+    parser.add_argument('-o', '--output_dir', type=str, required=True, help='Directory of the exported graphs')
+    parser.add_argument('-c', '--checkpoint', type=str, help='Checkpoint to export (latest one if not given)')
+    parser.add_argument('--n_calibration', type=int, default=100, help='Number of lines to calibrate the ranges')
+    parser.add_argument('--n_eval', type=int, default=500,
+                        help='Number of lines for the CER and latency (after the calibration lines)')
+    parser.add_argument('-e', '--label_encoding', type=str, default='latin1', help='Encoding of the labels')
+    args = parser.parse_args()
+
+    # Quantized kernels are CPU kernels, all the graphs are compared on CPU
+    os.environ['CUDA_VISIBLE_DEVICES'] = ''
+
+    parameters = Params(**import_params_from_json(json_filename=args.params_file))
+    checkpoint = args.checkpoint if args.checkpoint else tf.train.latest_checkpoint(parameters.output_model_dir)
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    lines = read_lines(sorted(glob(parameters.tfrecords_eval)), parameters, args.n_calibration + args.n_eval,
+                       label_encoding=args.label_encoding)
+    calibration_lines, eval_lines = lines[:args.n_calibration], lines[args.n_calibration:]
+    assert len(eval_lines) > 0, 'Not enough lines in {}'.format(parameters.tfrecords_eval)
+
+    float_graph_def = freeze_inference_graph(parameters, checkpoint, fold_batch_norms=True)
+    graph_defs = {'float': float_graph_def,
+                  'int8_weights': transform_graph(float_graph_def, WEIGHTS_TRANSFORMS),
+                  'int8': calibrate_requantization_ranges(transform_graph(float_graph_def, NODES_TRANSFORMS),
+                                                          calibration_lines)}
+
+    report = {'checkpoint': checkpoint, 'n_calibration_lines': len(calibration_lines),
+              'n_eval_lines': len(eval_lines), 'inputs': INPUT_NODES, 'outputs': OUTPUT_NODES}
+    for name, graph_def in graph_defs.items():
+        filename = os.path.join(args.output_dir, 'crnn_{}.pb'.format(name))
+        with tf.gfile.GFile(filename, 'wb') as f:
+            f.write(graph_def.SerializeToString())
+        report[name] = evaluate_graph(graph_def, eval_lines)
+        report[name]['filename'] = filename
+        print('{:<12}: {:>7.2f} MB, CER {:.4f}, p50 {:>8.2f} ms per line'.format(
+            name, report[name]['size_mb'], report[name]['CER'], report[name]['latency']['p50_ms']))
+
+    with open(os.path.join(args.output_dir, 'quantization_report.json'), 'w') as f:
+        json.dump(report, f, indent=2)
+    print('Report written to {}'.format(os.path.join(args.output_dir, 'quantization_report.json')))
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.tools.graph_transforms import TransformGraph
+from functools import partial
+from typing import List, Tuple
+from .config import Params, CONST
+from .data_handler import parse_example
+from .model import deep_cnn, deep_bidirectional_lstm
+
+# Names of the inputs and outputs of the inference graph (see `build_inference_graph`)
+INPUT_IMAGES = 'input_images'
+INPUT_WIDTHS = 'input_widths'
+INPUT_CORPORA = 'input_corpora'
+OUTPUT_LOGITS = 'output_logits'
+OUTPUT_CODES = 'output_codes'
+INPUT_NODES = [INPUT_IMAGES, INPUT_WIDTHS, INPUT_CORPORA]
+OUTPUT_NODES = [OUTPUT_LOGITS, OUTPUT_CODES]
+# Layers of `deep_cnn` with a batch norm after the bias of the convolution, and epsilon of their batch norms
+# (default of tf.layers.batch_normalization)
+BATCH_NORM_LAYERS = ['deep_cnn/layer3', 'deep_cnn/layer5', 'deep_cnn/layer7']
+BATCH_NORM_EPSILON = 1e-3
+# Constants folded and nodes not needed by the outputs removed (the types of the placeholders are given,
+# strip_unused_nodes would otherwise recreate them as float). The batch norms are folded before freezing
+# (see `folded_batch_norms`) : the fold transforms of the tool do not match a bias between convolution and batch norm
+INFERENCE_TRANSFORMS = ['add_default_attributes',
+                        'remove_nodes(op=Identity, op=CheckNumerics)',
+                        'fold_constants(ignore_errors=true)',
+                        'strip_unused_nodes(type=float, name={}, type_for_name=int32, '
+                        'name={}, type_for_name=int64)'.format(INPUT_WIDTHS, INPUT_CORPORA),
+                        'sort_by_execution_order']
+
+
+def build_inference_graph(params: Params, batch_norm: bool=True):
+    """
+    Builds the network in inference mode in the default graph, with the variables of `crnn_fn`, fed by placeholders
+    (images resized to the input height, batch x h x w x 1 float32, their widths and corpora) and giving the time
+    major logits and the codes of the greedy decoding (batch x max length, padded with -1)
+    :param params: parameters of the model
+    :param batch_norm: False to build the convolutions without batch norms, for folded weights (see `deep_cnn`)
+    """
+    params.keep_prob_dropout = 1.0
+    images = tf.placeholder(tf.float32, shape=[None, params.input_shape[0], None, 1], name=INPUT_IMAGES)
+    widths = tf.placeholder(tf.int32, shape=[None], name=INPUT_WIDTHS)
+    corpora = tf.placeholder(tf.int64, shape=[None], name=INPUT_CORPORA)
+
+    conv = deep_cnn(images, is_training=False, summaries=False, channels=params.cnn_channels,
+                    separable=params.separable_convolutions, batch_norm=batch_norm)
+    sequence_length = widths // CONST.DIMENSION_REDUCTION_W_POOLING - 1
+    logits, _ = deep_bidirectional_lstm(conv, corpora, params=params, sequence_length=sequence_length,
+                                        summaries=False)
+    tf.identity(logits, name=OUTPUT_LOGITS)
+
+    decoded, _ = tf.nn.ctc_greedy_decoder(logits, sequence_length=sequence_length, merge_repeated=True)
+    tf.sparse_tensor_to_dense(decoded[0], default_value=-1, name=OUTPUT_CODES)
+
+
+def folded_batch_norms(checkpoint: str) -> dict:
+    """
+    Folds the batch norms of the checkpoint into the convolutions before them :
+    W' = W.gamma / sqrt(variance + epsilon) and b' = (b - mean).gamma / sqrt(variance + epsilon) + beta
+    (for separable convolutions W is the pointwise kernel, the scale applies to the output channels in any case)
+    :return: dict {variable name: folded value} of the weights and biases of the convolutions with a batch norm
+    """
+    reader = tf.train.NewCheckpointReader(checkpoint)
+    values = dict()
+    for layer in BATCH_NORM_LAYERS:
+        batch_norm = layer + '/batch-norm/'
+        scale = reader.get_tensor(batch_norm + 'gamma') / \
+            np.sqrt(reader.get_tensor(batch_norm + 'moving_variance') + BATCH_NORM_EPSILON)
+        values[layer + '/weights'] = reader.get_tensor(layer + '/weights') * scale
+        values[layer + '/bias'] = (reader.get_tensor(layer + '/bias') - reader.get_tensor(batch_norm + 'moving_mean')) \
+            * scale + reader.get_tensor(batch_norm + 'beta')
+    return values
+
+
+def freeze_inference_graph(params: Params, checkpoint: str, fold_batch_norms: bool=True) -> tf.GraphDef:
+    """
+    :param params: parameters of the model
+    :param checkpoint: checkpoint to restore the variables from
+    :param fold_batch_norms: fold the batch norms into the convolutions (see `folded_batch_norms`)
+    :return: the inference graph (see `build_inference_graph`) with its variables converted to constants
+    """
+    with tf.Graph().as_default() as graph:
+        build_inference_graph(params, batch_norm=not fold_batch_norms)
+        with tf.Session() as session:
+            tf.train.Saver(tf.global_variables()).restore(session, checkpoint)
+            if fold_batch_norms:
+                folded_values = folded_batch_norms(checkpoint)
+                for variable in tf.global_variables():
+                    if variable.op.name in folded_values:
+                        variable.load(folded_values[variable.op.name], session)
+            graph_def = tf.graph_util.convert_variables_to_constants(session, graph.as_graph_def(), OUTPUT_NODES)
+
+    if fold_batch_norms:
+        assert not any(node.op.startswith('FusedBatchNorm') for node in graph_def.node), \
+            'Batch norms left in the frozen graph'
+    return graph_def
+
+
+def optimize_for_inference(graph_def: tf.GraphDef, transforms: list=None) -> tf.GraphDef:
+    """:return: the frozen graph with the `INFERENCE_TRANSFORMS` (or the given ones) applied"""
+    return TransformGraph(graph_def, INPUT_NODES, OUTPUT_NODES,
+                          INFERENCE_TRANSFORMS if transforms is None else transforms)
+
+
+def load_frozen_graph(graph_def: tf.GraphDef) -> tf.Graph:
+    """:return: a new graph with the nodes of `graph_def`, keeping their names"""
+    with tf.Graph().as_default() as graph:
+        tf.import_graph_def(graph_def, name='')
+    return graph
+
+
+def read_lines(filenames: List[str], params: Params, n_lines: int, label_encoding: str='latin1') \
+        -> List[Tuple[np.ndarray, int, List[int]]]:
+    """
+    Reads lines of tfrecords files, resized to the input height without padding as they are fed to the frozen graph
+    :param filenames: tfrecords files
+    :param params: parameters of the model
+    :param n_lines: maximum number of lines read
+    :param label_encoding: encoding of the labels of the tfrecords (records without encoded labels)
+    :return: list of (image h x w x 1, corpus, label codes), lines with characters out of the alphabet are skipped
+    """
+    with tf.Graph().as_default():
+        dataset = tf.data.TFRecordDataset(filenames)
+        dataset = dataset.map(partial(parse_example, output_shape=params.input_shape, fixed_width=False,
+                                      encoded_labels=params.encoded_labels))
+        next_line = dataset.make_one_shot_iterator().get_next()
+
+        lines = list()
+        with tf.Session() as session:
+            while len(lines) < n_lines:
+                try:
+                    features, label = session.run(next_line)
+                except tf.errors.OutOfRangeError:
+                    break
+                if params.encoded_labels:
+                    codes = [int(code) for code in label]
+                else:
+                    try:
+                        codes = params.encode_label(label.decode(label_encoding))
+                    except KeyError:
+                        continue
+                lines.append((features['image'], int(features['corpus']), codes))
+    return lines
+
+
+def predict_line(session: tf.Session, image: np.ndarray, corpus: int) -> List[int]:
+    """:return: codes of the greedy decoding of a line (h x w x 1) by the frozen graph loaded in the session"""
+    codes = session.run(OUTPUT_CODES + ':0', feed_dict={INPUT_IMAGES + ':0': image[None],
+                                                        INPUT_WIDTHS + ':0': [image.shape[1]],
+                                                        INPUT_CORPORA + ':0': [corpus]})
+    return [int(code) for code in codes[0] if code >= 0]
+
+
+def predict_line_logits(session: tf.Session, image: np.ndarray, corpus: int) -> Tuple[np.ndarray, List[int]]:
+    """:return: logits (time x n_classes) and codes of the greedy decoding of a line, see `predict_line`"""
+    logits, codes = session.run([OUTPUT_LOGITS + ':0', OUTPUT_CODES + ':0'],
+                                feed_dict={INPUT_IMAGES + ':0': image[None],
+                                           INPUT_WIDTHS + ':0': [image.shape[1]],
+                                           INPUT_CORPORA + ':0': [corpus]})
+    return logits[:, 0], [int(code) for code in codes[0] if code >= 0]
+
+
+def predict_lines(graph_def: tf.GraphDef, lines: List[Tuple[np.ndarray, int, List[int]]]) -> List[List[int]]:
+    """:return: codes of the greedy decoding of each line (see `read_lines`) by the frozen graph"""
+    with tf.Session(graph=load_frozen_graph(graph_def)) as session:
+        return [predict_line(session, image, corpus) for image, corpus, _ in lines]
+
+
+def edit_distance(prediction: List[int], target: List[int]) -> int:
+    """:return: Levenshtein distance between two sequences of codes"""
+    previous = list(range(len(target) + 1))
+    for i, p in enumerate(prediction, 1):
+        current = [i]
+        for j, t in enumerate(target, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (p != t)))
+        previous = current
+    return previous[-1]
+
+
+def character_error_rate(predictions: List[List[int]], targets: List[List[int]]) -> float:
+    """:return: mean of the edit distances normalized by the target lengths, as the 'eval/CER' metric of `crnn_fn`"""
+    return float(np.mean([edit_distance(p, t) / max(len(t), 1) for p, t in zip(predictions, targets)]))
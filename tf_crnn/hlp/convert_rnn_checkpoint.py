@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+import os
+import argparse
+import numpy as np
+import tensorflow as tf
+from ..config import RNN_IMPLEMENTATIONS
+
+# Scope of the variables of the cells, for each rnn implementation (see model.lstm_cell)
+CELL_SCOPES = {'cell': 'lstm_cell', 'block': 'lstm_cell', 'fused': 'lstm_cell',
+               'cudnn_compatible': 'cudnn_compatible_lstm_cell'}
+# Forget bias added by the cells at each step, which is stored in the bias variable when the cell has none
+FORGET_BIASES = {'cell': 1.0, 'block': 1.0, 'fused': 1.0, 'cudnn_compatible': 0.0}
+
+
+def convert_variable(name: str, value: np.ndarray, source: str, target: str) -> (str, np.ndarray):
+    """
+    Converts a variable of a checkpoint of the `source` rnn implementation to the `target` one. The kernels of all
+    the implementations have the same layout ([inputs + hidden, 4 x hidden], gates i, c, f, o), only the scope
+    of the cells and the forget bias differ
+    :return: new name and value of the variable
+    """
+    source_scope, target_scope = '/{}/'.format(CELL_SCOPES[source]), '/{}/'.format(CELL_SCOPES[target])
+    if source_scope not in name:
+        return name, value
+    new_name = name.replace(source_scope, target_scope)
+    # Only the bias itself, not its optimizer slots (bias/Adam...)
+    if name.endswith(source_scope + 'bias') and FORGET_BIASES[source] != FORGET_BIASES[target]:
+        n_hidden = value.shape[0] // 4
+        value = value.copy()
+        value[2 * n_hidden:3 * n_hidden] += FORGET_BIASES[source] - FORGET_BIASES[target]
+    return new_name, value
+
+
+def convert_rnn_checkpoint(checkpoint_path: str, output_dir: str, source: str, target: str) -> str:
+    """
+    Writes a copy of a checkpoint with the variables of the recurrent layers converted from the `source`
+    implementation (`Params.rnn_implementation`) to the `target` one
+    :param checkpoint_path: checkpoint to convert
+    :param output_dir: directory of the converted checkpoint
+    :param source: rnn implementation of the checkpoint
+    :param target: rnn implementation of the converted checkpoint
+    :return: path of the converted checkpoint
+    """
+    reader = tf.train.NewCheckpointReader(checkpoint_path)
+    os.makedirs(output_dir, exist_ok=True)
+
+    with tf.Graph().as_default():
+        variables = list()
+        for name in sorted(reader.get_variable_to_shape_map()):
+            new_name, value = convert_variable(name, reader.get_tensor(name), source, target)
+            variables.append(tf.Variable(value, name=new_name, trainable=False))
+            if new_name != name:
+                print('{} -> {}'.format(name, new_name))
+
+        saver = tf.train.Saver(variables)
+        with tf.Session() as session:
+            session.run(tf.global_variables_initializer())
+            return saver.save(session, os.path.join(output_dir, os.path.basename(checkpoint_path)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Converts the recurrent layers of a checkpoint between the '
+                                                 'rnn implementations of the model (rnn_implementation)')
+    parser.add_argument('-c', '--checkpoint', type=str, required=True,
+                        help='Checkpoint path, or model directory to convert its latest checkpoint')
+    parser.add_argument('-o', '--output_dir', type=str, required=True, help='Directory of the converted checkpoint')
+    parser.add_argument('-s', '--source', type=str, required=True, choices=RNN_IMPLEMENTATIONS,
+                        help='rnn_implementation the checkpoint was written with')
+    parser.add_argument('-t', '--target', type=str, required=True, choices=RNN_IMPLEMENTATIONS,
+                        help='rnn_implementation to convert to')
+    args = parser.parse_args()
+
+    checkpoint = tf.train.latest_checkpoint(args.checkpoint) if os.path.isdir(args.checkpoint) else args.checkpoint
+    print('Converted checkpoint : {}'.format(convert_rnn_checkpoint(checkpoint, args.output_dir,
+                                                                    args.source, args.target)))
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+
+import io
+import os
+import csv
+import json
+import argparse
+from multiprocessing import Pool
+from functools import partial
+from typing import List, Iterator, Tuple
+import tensorflow as tf
+from tqdm import tqdm
+from ..config import Params, import_params_from_json
+from ..data_handler import make_example
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+def shard_filename(output_dir: str, prefix: str, shard: int, n_shards: int) -> str:
+    return os.path.join(output_dir, '{}-{:05d}-of-{:05d}.tfrecords'.format(prefix, shard, n_shards))
+
+
+def shard_lines_filename(output_dir: str, prefix: str, shard: int, n_shards: int) -> str:
+    """Temporary file of the csv lines of a shard (see `split_csv_lines`)"""
+    return shard_filename(output_dir, prefix, shard, n_shards) + '.lines'
+
+
+def read_csv_lines(csv_filenames: List[str], delimiter: str=' ', encoding: str='utf8', with_corpus: bool=False) \
+        -> Iterator[Tuple[Tuple[str, str, int], str]]:
+    """
+    Reads the (image path, label[, corpus]) lines of the csv files one by one. The label spans all the columns
+    between the image path and the corpus, so that labels with the delimiter (e.g spaces) do not need to be quoted.
+    Relative image paths are relative to the directory of their csv file
+    :param with_corpus: the last column is the corpus, otherwise the corpus is 0
+    :return: iterator of ((image path, label, corpus), None), or of (None, location (file:line) and error)
+        for the malformed lines
+    """
+    n_columns = 3 if with_corpus else 2
+    for filename in csv_filenames:
+        csv_dir = os.path.dirname(os.path.abspath(filename))
+        with open(filename, 'r', encoding=encoding) as f:
+            reader = csv.reader(f, delimiter=delimiter)
+            for row in reader:
+                if not row:
+                    continue
+                if len(row) < n_columns:
+                    yield None, '{}:{} : {} columns, expected at least {}'.format(filename, reader.line_num,
+                                                                                 len(row), n_columns)
+                    continue
+                if with_corpus:
+                    try:
+                        corpus = int(row[-1])
+                    except ValueError:
+                        yield None, '{}:{} : invalid corpus {}'.format(filename, reader.line_num, repr(row[-1]))
+                        continue
+                    label = delimiter.join(row[1:-1])
+                else:
+                    corpus = 0
+                    label = delimiter.join(row[1:])
+                yield (os.path.join(csv_dir, row[0]), label, corpus), None
+
+
+def split_csv_lines(csv_filenames: List[str], output_dir: str, prefix: str, shards: List[int], n_shards: int,
+                    delimiter: str=' ', encoding: str='utf8', with_corpus: bool=False) -> int:
+    """
+    Streams the lines of the csv files once into a temporary file per shard to write (see `shard_lines_filename`),
+    the shard i getting the valid lines j such that j % n_shards == i. Every malformed line is reported and skipped
+    :param shards: indices of the shards to write
+    :return: number of malformed lines
+    """
+    shard_files = {shard: open(shard_lines_filename(output_dir, prefix, shard, n_shards), 'w', encoding='utf8')
+                   for shard in shards}
+    n_valid, n_malformed = 0, 0
+    try:
+        for line, error in read_csv_lines(csv_filenames, delimiter, encoding, with_corpus):
+            if line is None:
+                print('Malformed line {}'.format(error))
+                n_malformed += 1
+                continue
+            shard = n_valid % n_shards
+            n_valid += 1
+            if shard in shard_files:
+                shard_files[shard].write(json.dumps(line) + '\n')
+    finally:
+        for f in shard_files.values():
+            f.close()
+    return n_malformed
+
+
+def read_png(image_path: str) -> bytes:
+    """Encoded PNG of an image file, other formats are converted to grayscale PNG (needs PIL)"""
+    with open(image_path, 'rb') as f:
+        image_raw = f.read()
+    if image_raw.startswith(PNG_SIGNATURE):
+        return image_raw
+
+    if Image is None:
+        raise ImportError('PIL is needed to convert {} to PNG'.format(image_path))
+    buffer = io.BytesIO()
+    Image.open(io.BytesIO(image_raw)).convert('L').save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def write_shard(shard: int, output_dir: str, prefix: str, n_shards: int, params: Params=None) -> Tuple[int, int, int]:
+    """
+    Writes a shard from its temporary file of csv lines (see `split_csv_lines`), streamed so that only one example
+    is in memory at a time. The shard is written to a temporary file renamed once complete, so that an interrupted
+    conversion can be resumed
+    :param shard: index of the shard
+    :param output_dir: output directory
+    :param prefix: prefix of the shard filenames
+    :param n_shards: total number of shards
+    :param params: if given, the label codes of its alphabet are also written (see `data_handler.make_example`)
+        and examples with characters out of the alphabet are skipped (as those out of latin1 in any case)
+    :return: index of the shard, number of written and skipped examples
+    """
+    filename = shard_filename(output_dir, prefix, shard, n_shards)
+    lines_filename = shard_lines_filename(output_dir, prefix, shard, n_shards)
+    n_written, n_skipped = 0, 0
+    with tf.python_io.TFRecordWriter(filename + '.tmp') as writer, open(lines_filename, 'r', encoding='utf8') as f:
+        for line in f:
+            image_path, label, corpus = json.loads(line)
+            try:
+                label_codes = params.encode_label(label) if params is not None else None
+                example = make_example(read_png(image_path), label, corpus, label_codes)
+            except (KeyError, OSError, UnicodeEncodeError) as e:
+                print('Skipped {} : {}'.format(image_path, repr(e)))
+                n_skipped += 1
+                continue
+            writer.write(example.SerializeToString())
+            n_written += 1
+
+    os.rename(filename + '.tmp', filename)
+    os.remove(lines_filename)
+    return shard, n_written, n_skipped
+
+
+def csv_to_tfrecords(csv_filenames: List[str], output_dir: str, n_shards: int, prefix: str='data',
+                     delimiter: str=' ', encoding: str='utf8', with_corpus: bool=False, params: Params=None,
+                     n_processes: int=None) -> dict:
+    """
+    Converts csv files of images and labels into n_shards balanced tfrecords files, written in parallel by
+    n_processes processes (see `write_shard`). The csv files are streamed once and split into a temporary file
+    per shard (see `split_csv_lines`), so that the memory does not depend on the number of lines.
+    Shards which already exist are not written again
+    :return: dict with the number of written and skipped examples, of the malformed lines and of the shards
+        already existing
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    todo = [shard for shard in range(n_shards) if not os.path.isfile(shard_filename(output_dir, prefix, shard,
+                                                                                   n_shards))]
+    n_malformed = split_csv_lines(csv_filenames, output_dir, prefix, todo, n_shards, delimiter, encoding,
+                                  with_corpus)
+    summary = {'written': 0, 'skipped': 0, 'malformed': n_malformed, 'existing_shards': n_shards - len(todo)}
+
+    worker = partial(write_shard, output_dir=output_dir, prefix=prefix, n_shards=n_shards, params=params)
+    with Pool(n_processes) as pool:
+        for _, n_written, n_skipped in tqdm(pool.imap_unordered(worker, todo), total=len(todo), unit='shard'):
+            summary['written'] += n_written
+            summary['skipped'] += n_skipped
+
+    return summary
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Converts csv files (image path, label[, corpus]) '
+                                                 'into sharded tfrecords files')
+    parser.add_argument('-i', '--input_files', type=str, required=True, nargs='*', help='CSV filenames')
+    parser.add_argument('-o', '--output_dir', type=str, required=True, help='Directory of the tfrecords files')
+    parser.add_argument('-n', '--n_shards', type=int, default=16, help='Number of tfrecords files')
+    parser.add_argument('--prefix', type=str, default='data', help='Prefix of the tfrecords filenames')
+    parser.add_argument('-p', '--params_file', type=str,
+                        help='Parameters filename (JSON). If given, its csv_delimiter is used and the label codes '
+                             'of its alphabet are written (to train with "encoded_labels": true)')
+    parser.add_argument('-d', '--delimiter_char', type=str, help="CSV delimiter character (default ' ')")
+    parser.add_argument('-e', '--encoding', type=str, default='utf8', help='Encoding of the csv files')
+    parser.add_argument('-c', '--with_corpus', action='store_true',
+                        help='The last column is the corpus (otherwise the label spans all the columns after '
+                             'the image path and the corpus is 0)')
+    parser.add_argument('-j', '--n_processes', type=int, help='Number of processes (default : number of cpus)')
+    args = parser.parse_args()
+
+    parameters = Params(**import_params_from_json(json_filename=args.params_file)) if args.params_file else None
+    delimiter = args.delimiter_char or (parameters.csv_delimiter if parameters is not None else ' ')
+
+    results = csv_to_tfrecords(args.input_files, args.output_dir, args.n_shards, prefix=args.prefix,
+                               delimiter=delimiter, encoding=args.encoding, with_corpus=args.with_corpus,
+                               params=parameters, n_processes=args.n_processes)
+    print('{written} examples written, {skipped} skipped, {malformed} malformed lines, '
+          '{existing_shards} shards already existing'.format(**results))
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+
+import os
+import argparse
+from glob import glob
+import numpy as np
+import tensorflow as tf
+from tqdm import tqdm
+from ..config import Params, CONST, import_params_from_json
+from ..data_handler import feature_spec, resize_inputs_width
+from ..packed_data import PACKED_INDEX_SUFFIX, PACKED_DATA_SUFFIX
+
+
+def pack_tfrecords(tfrecords_filenames: list, output_prefix: str, height: int, params: Params=None,
+                   label_encoding: str='latin1', num_parallel_calls: int=4) -> (int, int):
+    """
+    Decodes the images of tfrecords files once, resizes them to the model height as `padding_inputs_width` does
+    before padding, and writes them as raw uint8 in a single buffer `<output_prefix>.packed.bin` with its index
+    `<output_prefix>.packed.npz` (see `packed_data.PackedDataset`)
+    :param tfrecords_filenames: tfrecords files with the `data_handler.feature_spec` schema
+    :param output_prefix: prefix of the output files
+    :param height: height of the images of the model
+    :param params: if given, the label codes of its alphabet are also written (to train with encoded_labels)
+        and examples with characters out of the alphabet are skipped
+    :param label_encoding: encoding of the labels of the tfrecords, to compute their codes
+    :param num_parallel_calls: number of images decoded in parallel
+    :return: number of packed and skipped examples
+    """
+    def decode_and_resize_fn(serialized_example):
+        features = tf.parse_single_example(serialized_example, feature_spec)
+        image = tf.image.decode_png(features['image_raw'], channels=1)
+        source_height = tf.shape(image)[0]
+        # No maximum width, images are only clipped or padded when read
+        image, _ = resize_inputs_width(image, (height, np.iinfo(np.int32).max),
+                                       increment=CONST.DIMENSION_REDUCTION_W_POOLING)
+        image = tf.cast(tf.round(tf.clip_by_value(image, 0., 255.)), tf.uint8)
+        return image, features['label'], features['corpus'], source_height
+
+    offsets, widths, corpora, source_heights, label_offsets, code_offsets = list(), list(), list(), list(), [0], [0]
+    label_bytes, label_codes = bytearray(), list()
+    n_skipped, offset = 0, 0
+
+    with tf.Graph().as_default():
+        ds = tf.data.TFRecordDataset(tfrecords_filenames)
+        ds = ds.map(decode_and_resize_fn, num_parallel_calls=num_parallel_calls).prefetch(2 * num_parallel_calls)
+        next_example = ds.make_one_shot_iterator().get_next()
+
+        with tf.Session() as session, open(output_prefix + PACKED_DATA_SUFFIX + '.tmp', 'wb') as data_file, \
+                tqdm(unit='example') as progress:
+            while True:
+                try:
+                    image, label, corpus, source_height = session.run(next_example)
+                except tf.errors.OutOfRangeError:
+                    break
+                progress.update()
+
+                if params is not None:
+                    try:
+                        label_codes.extend(params.encode_label(label.decode(label_encoding)))
+                    except KeyError:
+                        n_skipped += 1
+                        continue
+                    code_offsets.append(len(label_codes))
+
+                data_file.write(image.tobytes())
+                offsets.append(offset)
+                offset += image.size
+                widths.append(image.shape[1])
+                corpora.append(corpus)
+                source_heights.append(source_height)
+                label_bytes.extend(label)
+                label_offsets.append(len(label_bytes))
+
+    index = {'height': np.int64(height),
+             'offsets': np.array(offsets, dtype=np.int64),
+             'widths': np.array(widths, dtype=np.int32),
+             'corpora': np.array(corpora, dtype=np.int64),
+             'source_heights': np.array(source_heights, dtype=np.int32),
+             'label_bytes': np.frombuffer(bytes(label_bytes), dtype=np.uint8),
+             'label_offsets': np.array(label_offsets, dtype=np.int64)}
+    if params is not None:
+        index['label_codes'] = np.array(label_codes, dtype=np.int64)
+        index['code_offsets'] = np.array(code_offsets, dtype=np.int64)
+
+    # np.savez adds the .npz extension to filenames but not to file objects
+    with open(output_prefix + PACKED_INDEX_SUFFIX + '.tmp', 'wb') as f:
+        np.savez(f, **index)
+    os.rename(output_prefix + PACKED_DATA_SUFFIX + '.tmp', output_prefix + PACKED_DATA_SUFFIX)
+    os.rename(output_prefix + PACKED_INDEX_SUFFIX + '.tmp', output_prefix + PACKED_INDEX_SUFFIX)
+
+    return len(offsets), n_skipped
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Packs tfrecords files into a memory-mappable buffer of images '
+                                                 'resized to the model height, to train with "packed_input": true')
+    parser.add_argument('params_file', type=str, help='Parameters filename (JSON), giving the input height')
+    parser.add_argument('-i', '--input_files', type=str, required=True, help='Glob expression of the tfrecords files')
+    parser.add_argument('-o', '--output_prefix', type=str, required=True,
+                        help='Prefix of the packed files (<prefix>.packed.bin and <prefix>.packed.npz)')
+    parser.add_argument('-e', '--label_encoding', type=str, default='latin1', help='Encoding of the input labels')
+    parser.add_argument('-j', '--num_parallel_calls', type=int, default=4, help='Number of images decoded in parallel')
+    args = parser.parse_args()
+
+    parameters = Params(**import_params_from_json(json_filename=args.params_file))
+    n_packed, n_skipped = pack_tfrecords(sorted(glob(args.input_files)), args.output_prefix,
+                                         parameters.input_shape[0],
+                                         params=parameters if parameters.encoded_labels else None,
+                                         label_encoding=args.label_encoding,
+                                         num_parallel_calls=args.num_parallel_calls)
+    print('{} examples packed, {} skipped (characters out of the alphabet)'.format(n_packed, n_skipped))
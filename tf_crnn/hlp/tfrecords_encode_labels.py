@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+import os
+import argparse
+from glob import glob
+import tensorflow as tf
+from tqdm import tqdm
+from ..config import Params, import_params_from_json
+from ..data_handler import make_example
+
+
+def encode_tfrecords_labels(input_filename: str, output_filename: str, params: Params,
+                            label_encoding: str='latin1') -> (int, int):
+    """
+    Rewrites a tfrecords file with string labels (see `data_handler.feature_spec`) so that it also holds
+    the codes of the labels in the alphabet of `params` and their lengths (see `data_handler.make_example`).
+    Examples with characters out of the alphabet (or out of latin1, see `data_handler.make_example`) are skipped
+    :param input_filename: tfrecords file with string labels
+    :param output_filename: output tfrecords file
+    :param params: parameters giving the alphabet (the records must be encoded again if it changes)
+    :param label_encoding: encoding of the label strings of the input file
+    :return: number of written and skipped examples
+    """
+    n_written, n_skipped = 0, 0
+    with tf.python_io.TFRecordWriter(output_filename) as writer:
+        for record in tf.python_io.tf_record_iterator(input_filename):
+            example = tf.train.Example.FromString(record)
+            feature = example.features.feature
+            label = feature['label'].bytes_list.value[0].decode(label_encoding)
+            try:
+                label_codes = params.encode_label(label)
+                encoded_example = make_example(feature['image_raw'].bytes_list.value[0], label,
+                                               feature['corpus'].int64_list.value[0], label_codes)
+            except (KeyError, UnicodeEncodeError):
+                n_skipped += 1
+                continue
+            writer.write(encoded_example.SerializeToString())
+            n_written += 1
+
+    return n_written, n_skipped
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Adds the label codes of the alphabet of the parameters to '
+                                                 'tfrecords files, to train with "encoded_labels": true')
+    parser.add_argument('params_file', type=str, help='Parameters filename (JSON), giving the alphabet')
+    parser.add_argument('-i', '--input_files', type=str, required=True, help='Glob expression of the tfrecords files')
+    parser.add_argument('-o', '--output_dir', type=str, required=True, help='Directory of the encoded files')
+    parser.add_argument('-e', '--label_encoding', type=str, default='latin1', help='Encoding of the input labels')
+    args = parser.parse_args()
+
+    parameters = Params(**import_params_from_json(json_filename=args.params_file))
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    total_written, total_skipped = 0, 0
+    for filename in tqdm(sorted(glob(args.input_files))):
+        written, skipped = encode_tfrecords_labels(filename, os.path.join(args.output_dir, os.path.basename(filename)),
+                                                   parameters, label_encoding=args.label_encoding)
+        total_written += written
+        total_skipped += skipped
+
+    print('{} examples written, {} skipped (characters out of the alphabet)'.format(total_written, total_skipped))
@@ -2,11 +2,12 @@
 __author__ = 'solivr'
 
 
+import os
 import tensorflow as tf
-from tensorflow.contrib.rnn import BasicLSTMCell, LSTMCell
-from tensorflow.contrib.cudnn_rnn import CudnnLSTM
-from .decoding import get_words_from_chars
-from .config import  Params, CONST
+from tensorflow.contrib.rnn import BasicLSTMCell, LSTMCell, LSTMBlockCell, LSTMBlockFusedCell
+from tensorflow.contrib.cudnn_rnn import CudnnCompatibleLSTMCell
+from .decoding import get_words_from_chars, ctc_decode
+from .config import  Params, CONST, CNN_CHANNELS
 
 
 def weightVar(shape, mean=0.0, stddev=0.02, name='weights'):
@@ -23,8 +24,36 @@ def conv2d(input, filter, strides=[1, 1, 1, 1], padding='SAME', name=None):
     return tf.nn.conv2d(input, filter, strides=strides, padding=padding, name=name)
 
 
-def deep_cnn(input_imgs: tf.Tensor, is_training: bool, summaries: bool=True) -> tf.Tensor:
-    input_tensor = input_imgs
+def conv_layer(inputs: tf.Tensor, kernel_size: int, n_in: int, n_out: int, separable: bool=False,
+               padding: str='SAME') -> tf.Tensor:
+    """
+    Convolution and bias of a layer of `deep_cnn`. A separable layer is a depthwise convolution followed by
+    a 1x1 convolution, with about kernel_size x kernel_size times fewer weights and operations
+    (not used on the input image, which has too few channels)
+    """
+    if separable and n_in > 3:
+        W_depthwise = weightVar([kernel_size, kernel_size, n_in, 1], name='depthwise_weights')
+        W = weightVar([1, 1, n_in, n_out])
+        conv = tf.nn.separable_conv2d(inputs, W_depthwise, W, strides=[1, 1, 1, 1], padding=padding)
+    else:
+        W = weightVar([kernel_size, kernel_size, n_in, n_out])
+        conv = conv2d(inputs, W, padding=padding)
+    b = biasVar([n_out])
+    return tf.nn.bias_add(conv, b)
+
+
+def deep_cnn(input_imgs: tf.Tensor, is_training: bool, summaries: bool=True, channels: list=None,
+             separable: bool=False, batch_norm: bool=True) -> tf.Tensor:
+    """
+    :param channels: number of channels of the 7 convolution layers (see `Params.cnn_channels`)
+    :param separable: use depthwise separable convolutions (see `conv_layer`)
+    :param batch_norm: False to build the layers 3, 5 and 7 without their batch norms, once they are folded
+        into the weights and biases of the convolutions (see `frozen_graph.folded_batch_norms`)
+    """
+    if channels is None:
+        channels = CNN_CHANNELS
+    # Images can come as uint8 from the input pipeline (uint8_images), pixel values stay in [0, 255]
+    input_tensor = tf.cast(input_imgs, tf.float32) if input_imgs.dtype != tf.float32 else input_imgs
     if input_tensor.shape[-1] == 1:
         input_channels = 1
     elif input_tensor.shape[-1] == 3:
@@ -37,10 +66,7 @@ def deep_cnn(input_imgs: tf.Tensor, is_training: bool, summaries: bool=True) ->
     with tf.variable_scope('deep_cnn'):
         # - conv1 - maxPool2x2
         with tf.variable_scope('layer1'):
-            W = weightVar([3, 3, input_channels, 64])
-            b = biasVar([64])
-            conv = conv2d(input_tensor, W, name='conv')
-            out = tf.nn.bias_add(conv, b)
+            out = conv_layer(input_tensor, 3, input_channels, channels[0], separable)
             conv1 = tf.nn.relu(out)
             pool1 = tf.nn.max_pool(conv1, [1, 2, 2, 1], strides=[1, 2, 2, 1],
                                    padding='SAME', name='pool')
@@ -54,10 +80,7 @@ def deep_cnn(input_imgs: tf.Tensor, is_training: bool, summaries: bool=True) ->
 
         # - conv2 - maxPool 2x2
         with tf.variable_scope('layer2'):
-            W = weightVar([3, 3, 64, 128])
-            b = biasVar([128])
-            conv = conv2d(pool1, W)
-            out = tf.nn.bias_add(conv, b)
+            out = conv_layer(pool1, 3, channels[0], channels[1], separable)
             conv2 = tf.nn.relu(out)
             pool2 = tf.nn.max_pool(conv2, [1, 2, 2, 1], strides=[1, 2, 2, 1],
                                    padding='SAME', name='pool1')
@@ -70,12 +93,9 @@ def deep_cnn(input_imgs: tf.Tensor, is_training: bool, summaries: bool=True) ->
 
         # - conv3 - w/batch-norm (as source code, not paper)
         with tf.variable_scope('layer3'):
-            W = weightVar([3, 3, 128, 256])
-            b = biasVar([256])
-            conv = conv2d(pool2, W)
-            out = tf.nn.bias_add(conv, b)
+            out = conv_layer(pool2, 3, channels[1], channels[2], separable)
             b_norm = tf.layers.batch_normalization(out, axis=-1,
-                                                   training=is_training, name='batch-norm')
+                                                   training=is_training, name='batch-norm') if batch_norm else out
             conv3 = tf.nn.relu(b_norm, name='ReLU')
 
             if summaries:
@@ -86,10 +106,7 @@ def deep_cnn(input_imgs: tf.Tensor, is_training: bool, summaries: bool=True) ->
 
         # - conv4 - maxPool 2x1
         with tf.variable_scope('layer4'):
-            W = weightVar([3, 3, 256, 256])
-            b = biasVar([256])
-            conv = conv2d(conv3, W)
-            out = tf.nn.bias_add(conv, b)
+            out = conv_layer(conv3, 3, channels[2], channels[3], separable)
             conv4 = tf.nn.relu(out)
             pool4 = tf.nn.max_pool(conv4, [1, 2, 2, 1], strides=[1, 2, 1, 1],
                                    padding='SAME', name='pool4')
@@ -102,12 +119,9 @@ def deep_cnn(input_imgs: tf.Tensor, is_training: bool, summaries: bool=True) ->
 
         # - conv5 - w/batch-norm
         with tf.variable_scope('layer5'):
-            W = weightVar([3, 3, 256, 512])
-            b = biasVar([512])
-            conv = conv2d(pool4, W)
-            out = tf.nn.bias_add(conv, b)
+            out = conv_layer(pool4, 3, channels[3], channels[4], separable)
             b_norm = tf.layers.batch_normalization(out, axis=-1,
-                                                   training=is_training, name='batch-norm')
+                                                   training=is_training, name='batch-norm') if batch_norm else out
             conv5 = tf.nn.relu(b_norm)
 
             if summaries:
@@ -118,10 +132,7 @@ def deep_cnn(input_imgs: tf.Tensor, is_training: bool, summaries: bool=True) ->
 
         # - conv6 - maxPool 2x1 (as source code, not paper)
         with tf.variable_scope('layer6'):
-            W = weightVar([3, 3, 512, 512])
-            b = biasVar([512])
-            conv = conv2d(conv5, W)
-            out = tf.nn.bias_add(conv, b)
+            out = conv_layer(conv5, 3, channels[4], channels[5], separable)
             conv6 = tf.nn.relu(out)
             pool6 = tf.nn.max_pool(conv6, [1, 2, 2, 1], strides=[1, 2, 1, 1],
                                    padding='SAME', name='pool6')
@@ -134,12 +145,9 @@ def deep_cnn(input_imgs: tf.Tensor, is_training: bool, summaries: bool=True) ->
 
         # - conv 7 - w/batch-norm (as source code, not paper)
         with tf.variable_scope('layer7'):
-            W = weightVar([2, 2, 512, 512])
-            b = biasVar([512])
-            conv = conv2d(pool6, W, padding='VALID')
-            out = tf.nn.bias_add(conv, b)
+            out = conv_layer(pool6, 2, channels[5], channels[6], separable, padding='VALID')
             b_norm = tf.layers.batch_normalization(out, axis=-1,
-                                                   training=is_training, name='batch-norm')
+                                                   training=is_training, name='batch-norm') if batch_norm else out
             conv7 = tf.nn.relu(b_norm)
 
             if summaries:
@@ -152,19 +160,72 @@ def deep_cnn(input_imgs: tf.Tensor, is_training: bool, summaries: bool=True) ->
 
         with tf.variable_scope('Reshaping_cnn'):
             shape = cnn_net.get_shape().as_list()  # [batch, height, width, features]
+            batch_size = tf.shape(cnn_net)[0]  # batch (and width) can be dynamic
             transposed = tf.transpose(cnn_net, perm=[0, 2, 1, 3],
                                       name='transposed')  # [batch, width, height, features]
-            conv_reshaped = tf.reshape(transposed, [shape[0], -1, shape[1] * shape[3]],
+            conv_reshaped = tf.reshape(transposed, [batch_size, -1, shape[1] * shape[3]],
                                        name='reshaped')  # [batch, width, height x features]
 
     return conv_reshaped
 
 
-def deep_bidirectional_lstm(inputs: tf.Tensor, corpora: tf.Tensor, params: Params, summaries: bool=True) -> tf.Tensor:
+def lstm_cell(n_hidden: int, implementation: str='cell') -> tf.contrib.rnn.RNNCell:
+    """
+    LSTM cell of the recurrent stack (see `Params.rnn_implementation`). LSTMCell and LSTMBlockCell have the same
+    variables, CudnnCompatibleLSTMCell has no forget bias and its variables are named as in CudnnLSTM checkpoints
+    (see hlp/convert_rnn_checkpoint.py)
+    """
+    if implementation == 'cell':
+        return LSTMCell(n_hidden, forget_bias=1.0)
+    elif implementation == 'block':
+        return LSTMBlockCell(n_hidden, forget_bias=1.0)
+    elif implementation == 'cudnn_compatible':
+        return CudnnCompatibleLSTMCell(n_hidden)
+    elif implementation == 'fused':
+        raise ValueError("The 'fused' rnn implementation has no cell, "
+                         "its layers are built by stack_bidirectional_fused_lstm")
+    else:
+        raise ValueError('Unknown rnn implementation {}'.format(implementation))
+
+
+def stack_bidirectional_fused_lstm(inputs: tf.Tensor, list_n_hidden: list, sequence_length: tf.Tensor=None) -> tf.Tensor:
+    """
+    Counterpart of `stack_bidirectional_dynamic_rnn` with LSTMCell made of LSTMBlockFusedCell, which runs all
+    the time steps of a layer in a single op. The variables have the same names and layouts
+    :param inputs: [batch, time, features] tensor
+    :param list_n_hidden: number of units of each layer
+    :param sequence_length: [batch] number of valid time steps of each sample
+    :return: [batch, time, 2 x n_hidden of the last layer] outputs, concatenation of both directions
+    """
+    outputs = tf.transpose(inputs, [1, 0, 2])  # the fused op is time major
+
+    def reverse(sequences):
+        if sequence_length is None:
+            return tf.reverse(sequences, axis=[0])
+        return tf.reverse_sequence(sequences, sequence_length, seq_axis=0, batch_axis=1)
+
+    with tf.variable_scope('stack_bidirectional_rnn'):
+        for i, n_hidden in enumerate(list_n_hidden):
+            with tf.variable_scope('cell_{}'.format(i)), tf.variable_scope('bidirectional_rnn'):
+                with tf.variable_scope('fw'):
+                    outputs_fw, _ = LSTMBlockFusedCell(n_hidden, forget_bias=1.0, name='lstm_cell')(
+                        outputs, dtype=tf.float32, sequence_length=sequence_length)
+                with tf.variable_scope('bw'):
+                    outputs_bw, _ = LSTMBlockFusedCell(n_hidden, forget_bias=1.0, name='lstm_cell')(
+                        reverse(outputs), dtype=tf.float32, sequence_length=sequence_length)
+                outputs = tf.concat([outputs_fw, reverse(outputs_bw)], axis=2)
+
+    return tf.transpose(outputs, [1, 0, 2])
+
+
+def deep_bidirectional_lstm(inputs: tf.Tensor, corpora: tf.Tensor, params: Params, sequence_length: tf.Tensor=None,
+                            summaries: bool=True) -> tf.Tensor:
     # Prepare data shape to match `bidirectional_rnn` function requirements
     # Current data input shape: (batch_size, n_steps, n_input) "(batch, time, height)"
+    # `sequence_length` (batch_size,) is the number of valid time steps of each sample. When given, the recurrent
+    # layers stop at each sample's length (outputs are zero after it) and the backward cells start at its end
 
-    list_n_hidden = [256, 256]
+    list_n_hidden = params.lstm_hidden
 
     # add the corpora to all input times; TODO: what values should we use for one-hot? (0,1) ?
 
@@ -177,16 +238,20 @@ def deep_bidirectional_lstm(inputs: tf.Tensor, corpora: tf.Tensor, params: Param
         inputs = tf.concat((corpora, inputs), axis=2, name='concat_corpus')
 
     with tf.name_scope('deep_bidirectional_lstm'):
-        # Forward direction cells
-        fw_cell_list = [LSTMCell(nh, forget_bias=1.0) for nh in list_n_hidden]
-        # Backward direction cells
-        bw_cell_list = [LSTMCell(nh, forget_bias=1.0) for nh in list_n_hidden]
-
-        lstm_net, _, _ = tf.contrib.rnn.stack_bidirectional_dynamic_rnn(fw_cell_list,
-                                                                        bw_cell_list,
-                                                                        inputs,
-                                                                        dtype=tf.float32
-                                                                        )
+        if params.rnn_implementation == 'fused':
+            lstm_net = stack_bidirectional_fused_lstm(inputs, list_n_hidden, sequence_length=sequence_length)
+        else:
+            # Forward direction cells
+            fw_cell_list = [lstm_cell(nh, params.rnn_implementation) for nh in list_n_hidden]
+            # Backward direction cells
+            bw_cell_list = [lstm_cell(nh, params.rnn_implementation) for nh in list_n_hidden]
+
+            lstm_net, _, _ = tf.contrib.rnn.stack_bidirectional_dynamic_rnn(fw_cell_list,
+                                                                            bw_cell_list,
+                                                                            inputs,
+                                                                            sequence_length=sequence_length,
+                                                                            dtype=tf.float32
+                                                                            )
 
         # Dropout layer
         print('Using dropout', params.keep_prob_dropout)
@@ -194,6 +259,7 @@ def deep_bidirectional_lstm(inputs: tf.Tensor, corpora: tf.Tensor, params: Param
 
         with tf.variable_scope('Reshaping_rnn'):
             shape = lstm_net.get_shape().as_list()  # [batch, width, 2*n_hidden]
+            batch_size = tf.shape(lstm_net)[0]
             rnn_reshaped = tf.reshape(lstm_net, [-1, shape[-1]])  # [batch x width, 2*n_hidden]
 
         with tf.variable_scope('fully_connected'):
@@ -209,7 +275,7 @@ def deep_bidirectional_lstm(inputs: tf.Tensor, corpora: tf.Tensor, params: Param
                         if var.name == 'deep_bidirectional_lstm/fully_connected/bias:0'][0]
                 tf.summary.histogram('bias', bias)
 
-        lstm_out = tf.reshape(fc_out, [shape[0], -1, params.n_classes], name='reshape_out')  # [batch, width, n_classes]
+        lstm_out = tf.reshape(fc_out, [batch_size, -1, params.n_classes], name='reshape_out')  # [batch, width, n_classes]
 
         raw_pred = tf.argmax(tf.nn.softmax(lstm_out), axis=2, name='raw_prediction')
 
@@ -219,14 +285,62 @@ def deep_bidirectional_lstm(inputs: tf.Tensor, corpora: tf.Tensor, params: Param
         return lstm_out, raw_pred
 
 
+def teacher_logits(images: tf.Tensor, corpora: tf.Tensor, sequence_length: tf.Tensor, teacher_params: Params,
+                   export_dir: str) -> tf.Tensor:
+    """
+    Builds the network of a teacher model in the 'teacher' scope, initialized from the variables of its export
+    (see `Params.distillation_teacher`) and not trained
+    :param images: input images
+    :param corpora: corpus of each image
+    :param sequence_length: number of valid time steps of each image
+    :param teacher_params: parameters the teacher was trained with
+    :param export_dir: directory of the exported teacher (export_savedmodel)
+    :return: [time, batch, n_classes] logits of the teacher
+    """
+    teacher_params.keep_prob_dropout = 1.0
+    with tf.variable_scope('teacher'):
+        conv = deep_cnn(images, is_training=False, summaries=False, channels=teacher_params.cnn_channels,
+                        separable=teacher_params.separable_convolutions)
+        logits, _ = deep_bidirectional_lstm(conv, corpora, params=teacher_params, sequence_length=sequence_length,
+                                            summaries=False)
+
+    teacher_variables = [var for var in tf.global_variables() if var.op.name.startswith('teacher/')]
+    trainable_variables = tf.get_collection_ref(tf.GraphKeys.TRAINABLE_VARIABLES)
+    for var in teacher_variables:
+        if var in trainable_variables:
+            trainable_variables.remove(var)
+    # The variables of a SavedModel are a checkpoint
+    tf.train.init_from_checkpoint(os.path.join(export_dir, 'variables', 'variables'),
+                                  {var.op.name[len('teacher/'):]: var for var in teacher_variables})
+    return tf.stop_gradient(logits)
+
+
+def distillation_loss(student_logits: tf.Tensor, teacher_logits: tf.Tensor, sequence_length: tf.Tensor,
+                      temperature: float=2.0) -> tf.Tensor:
+    """
+    Cross entropy between the predictions of the teacher and of the student at each valid time step, both softened
+    by the temperature. It is multiplied by temperature^2 so that its gradients keep the scale of the CTC loss
+    :param student_logits: [time, batch, n_classes] logits of the student
+    :param teacher_logits: [time, batch, n_classes] logits of the teacher
+    :param sequence_length: [batch] number of valid time steps
+    :param temperature: temperature of the softmax
+    :return: scalar loss
+    """
+    soft_targets = tf.nn.softmax(teacher_logits / temperature)
+    cross_entropy = -tf.reduce_sum(soft_targets * tf.nn.log_softmax(student_logits / temperature), axis=2)
+    mask = tf.transpose(tf.sequence_mask(sequence_length, tf.shape(student_logits)[0], dtype=tf.float32))
+    return temperature ** 2 * tf.reduce_sum(cross_entropy * mask) / tf.maximum(tf.reduce_sum(mask), 1.0)
+
+
 def crnn_fn(features, labels, mode, params):
     """
     :param features: dict {
                             'image'
                             'images_width'
                             'corpora'
+                            'label_length' (records with encoded labels only)
                             }
-    :param labels: labels. flattend (1D) array with encoded label (one code per character)
+    :param labels: label strings, or the sparse CTC targets (int32 codes) when the records hold the label codes
     :param mode:
     :param params: dict {
                             'Params'
@@ -240,40 +354,49 @@ def crnn_fn(features, labels, mode, params):
     if mode != tf.estimator.ModeKeys.TRAIN:
         parameters.keep_prob_dropout = 1.0
 
-    conv = deep_cnn(features['image'], (mode == tf.estimator.ModeKeys.TRAIN), summaries=False)
+    conv = deep_cnn(features['image'], (mode == tf.estimator.ModeKeys.TRAIN), summaries=False,
+                    channels=parameters.cnn_channels, separable=parameters.separable_convolutions)
 
 
-    logprob, raw_pred = deep_bidirectional_lstm(conv, features['corpus'], params=parameters, summaries=False)
-
     # Compute seq_len from image width
     n_pools = CONST.DIMENSION_REDUCTION_W_POOLING  # 2x2 pooling in dimension W on layer 1 and 2
     seq_len_inputs = tf.divide(features['image_width'], n_pools, name='seq_len_input_op') - 1
 
+    logprob, raw_pred = deep_bidirectional_lstm(conv, features['corpus'], params=parameters,
+                                                sequence_length=tf.cast(seq_len_inputs, tf.int32), summaries=False)
+
     predictions_dict = {'prob': logprob,
                         'raw_predictions': raw_pred
                         }
 
     if not mode == tf.estimator.ModeKeys.PREDICT:
-        # Alphabet and codes
-        keys = [c for c in parameters.alphabet.encode('latin1')]
-        values = parameters.alphabet_codes
-
-        # Convert string label to code label
-        with tf.name_scope('str2code_conversion'):
-            table_str2int = tf.contrib.lookup.HashTable(
-                tf.contrib.lookup.KeyValueTensorInitializer(keys, values, key_dtype=tf.int64, value_dtype=tf.int64), -1)
-            splitted = tf.string_split(labels, delimiter='')
-            values_int = tf.cast(tf.squeeze(tf.decode_raw(splitted.values, tf.uint8)), tf.int64)
-            codes = table_str2int.lookup(values_int)
-            codes = tf.cast(codes, tf.int32)
-            sparse_code_target = tf.SparseTensor(splitted.indices, codes, splitted.dense_shape)
-
-        seq_lengths_labels = tf.bincount(tf.cast(sparse_code_target.indices[:, 0], tf.int32), #array of labels length
-                                         minlength= tf.shape(predictions_dict['prob'])[1])
+        if isinstance(labels, tf.SparseTensor):
+            # Labels encoded in the records, the input pipeline gives the sparse targets and their lengths
+            sparse_code_target = labels
+            seq_lengths_labels = tf.cast(features['label_length'], tf.int32)
+        else:
+            # Alphabet and codes
+            keys = [c for c in parameters.alphabet.encode('latin1')]
+            values = parameters.alphabet_codes
+
+            # Convert string label to code label
+            with tf.name_scope('str2code_conversion'):
+                table_str2int = tf.contrib.lookup.HashTable(
+                    tf.contrib.lookup.KeyValueTensorInitializer(keys, values, key_dtype=tf.int64, value_dtype=tf.int64), -1)
+                splitted = tf.string_split(labels, delimiter='')
+                values_int = tf.cast(tf.squeeze(tf.decode_raw(splitted.values, tf.uint8)), tf.int64)
+                codes = table_str2int.lookup(values_int)
+                codes = tf.cast(codes, tf.int32)
+                sparse_code_target = tf.SparseTensor(splitted.indices, codes, splitted.dense_shape)
+
+            seq_lengths_labels = tf.bincount(tf.cast(sparse_code_target.indices[:, 0], tf.int32), #array of labels length
+                                             minlength= tf.shape(predictions_dict['prob'])[1])
 
         # Loss
         # ----
         # >>> Cannot have longer labels than predictions -> error
+        # Such examples get a zero gradient, they can be dropped by the input pipeline beforehand
+        # (drop_ctc_infeasible, see data_handler.ctc_feasible)
 
         with tf.control_dependencies([tf.less_equal(sparse_code_target.dense_shape[1], tf.reduce_max(tf.cast(seq_len_inputs, tf.int64)))]):
             loss_ctc = tf.nn.ctc_loss(labels=sparse_code_target,
@@ -287,6 +410,19 @@ def crnn_fn(features, labels, mode, params):
             loss_ctc = tf.Print(loss_ctc, [loss_ctc], message='* Loss : ')
 
 
+        loss = loss_ctc
+        if mode == tf.estimator.ModeKeys.TRAIN and parameters.distillation_teacher is not None:
+            teacher_parameters = parameters.distillation_teacher_parameters
+            assert teacher_parameters.n_classes == parameters.n_classes, 'The teacher has another alphabet'
+            assert teacher_parameters.input_shape[0] == parameters.input_shape[0], 'The teacher has another height'
+            logits_teacher = teacher_logits(features['image'], features['corpus'], tf.cast(seq_len_inputs, tf.int32),
+                                            teacher_parameters, parameters.distillation_teacher)
+            loss_distillation = distillation_loss(predictions_dict['prob'], logits_teacher,
+                                                  tf.cast(seq_len_inputs, tf.int32),
+                                                  temperature=parameters.distillation_temperature)
+            tf.summary.scalar('losses/distillation_loss', loss_distillation)
+            loss = (1 - parameters.distillation_weight) * loss_ctc + parameters.distillation_weight * loss_distillation
+
         global_step = tf.train.get_or_create_global_step()
         # # Create an ExponentialMovingAverage object
         ema = tf.train.ExponentialMovingAverage(decay=0.99, num_updates=global_step, zero_debias=True)
@@ -319,7 +455,7 @@ def crnn_fn(features, labels, mode, params):
             trainable = tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES)
 
         update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
-        opt_op = optimizer.minimize(loss_ctc, global_step=global_step, var_list=trainable)
+        opt_op = optimizer.minimize(loss, global_step=global_step, var_list=trainable)
 
         with tf.control_dependencies(update_ops + [opt_op]):
             train_op = tf.group(maintain_averages_op)
@@ -329,30 +465,36 @@ def crnn_fn(features, labels, mode, params):
         tf.summary.scalar('learning_rate', learning_rate)
         tf.summary.scalar('losses/ctc_loss', loss_ctc)
     else:
-        loss_ctc, train_op = None, None
+        loss_ctc, loss, train_op = None, None, None
 
-    if mode in [tf.estimator.ModeKeys.EVAL, tf.estimator.ModeKeys.PREDICT, tf.estimator.ModeKeys.TRAIN]:
+    # Decoding strategy depends on the mode : in TRAIN the predictions are only used for summaries
+    decoder = parameters.train_decoder if mode == tf.estimator.ModeKeys.TRAIN else parameters.eval_decoder
+
+    if decoder != 'none':
         with tf.name_scope('code2str_conversion'):
             keys = tf.cast(parameters.alphabet_decoding_codes, tf.int64)
             values = [c for c in parameters.alphabet_decoding]
             table_int2str = tf.contrib.lookup.HashTable(tf.contrib.lookup.KeyValueTensorInitializer(keys, values), '?')
 
-            sparse_code_pred, log_probability = tf.nn.ctc_beam_search_decoder(predictions_dict['prob'],
-                                                                              sequence_length=tf.cast(seq_len_inputs, tf.int32),
-                                                                              merge_repeated=False,
-                                                                              beam_width=100,
-                                                                              top_paths=parameters.nb_logprob)
+            sparse_code_pred, log_probability = ctc_decode(predictions_dict['prob'],
+                                                           sequence_length=tf.cast(seq_len_inputs, tf.int32),
+                                                           decoder=decoder,
+                                                           beam_width=parameters.beam_width,
+                                                           top_paths=parameters.nb_logprob)
             # confidence value
 
             predictions_dict['score'] = log_probability
 
+            # Greedy decoding gives a single path
+            n_paths = min(parameters.top_paths, len(sparse_code_pred))
+
             sequence_lengths_pred = [tf.bincount(tf.cast(sparse_code_pred[i].indices[:, 0], tf.int32),
-                                                minlength=tf.shape(predictions_dict['prob'])[1]) for i in range(parameters.top_paths)]
+                                                minlength=tf.shape(predictions_dict['prob'])[1]) for i in range(n_paths)]
 
-            pred_chars = [table_int2str.lookup(sparse_code_pred[i]) for i in range(parameters.top_paths)]
+            pred_chars = [table_int2str.lookup(sparse_code_pred[i]) for i in range(n_paths)]
 
             list_preds = [get_words_from_chars(pred_chars[i].values, sequence_lengths=sequence_lengths_pred[i])
-                          for i in range(parameters.top_paths)]
+                          for i in range(n_paths)]
 
             predictions_dict['words'] = tf.stack(list_preds)
 
@@ -384,7 +526,7 @@ def crnn_fn(features, labels, mode, params):
     return tf.estimator.EstimatorSpec(
         mode=mode,
         predictions=predictions_dict,
-        loss=loss_ctc,
+        loss=loss,
         train_op=train_op,
         eval_metric_ops=eval_metric_ops,
         export_outputs=export_outputs,
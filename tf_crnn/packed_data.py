@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+import numpy as np
+from typing import List
+
+PACKED_INDEX_SUFFIX = '.packed.npz'
+PACKED_DATA_SUFFIX = '.packed.bin'
+
+
+class PackedDataset:
+    """
+    Reader of a packed dataset (see hlp/pack_tfrecords.py) : images already resized to the model height are stored
+    as raw uint8 in a single buffer, memory-mapped and read without any decoding. The index file
+    `<prefix>.packed.npz` holds for each example the offset of its image in `<prefix>.packed.bin`, its width,
+    its corpus, its label (utf8 bytes, and optionally the codes of the alphabet it was packed with) and the height
+    of the image before resizing
+    """
+    def __init__(self, index_filename: str):
+        """
+        :param index_filename: `<prefix>.packed.npz` file
+        """
+        assert index_filename.endswith(PACKED_INDEX_SUFFIX), 'Packed index files end with ' + PACKED_INDEX_SUFFIX
+        index = np.load(index_filename)
+        self.height = int(index['height'])
+        self.offsets = index['offsets']
+        self.widths = index['widths']
+        self.corpora = index['corpora']
+        self.label_bytes = index['label_bytes']
+        self.label_offsets = index['label_offsets']
+        self.label_codes = index['label_codes'] if 'label_codes' in index else None
+        self.code_offsets = index['code_offsets'] if 'code_offsets' in index else None
+        # Heights of the images before resizing (not in datasets packed by older versions)
+        self.source_heights = index['source_heights'] if 'source_heights' in index else None
+        # Pages are only read when accessed
+        self.images = np.memmap(index_filename[:-len(PACKED_INDEX_SUFFIX)] + PACKED_DATA_SUFFIX,
+                                dtype=np.uint8, mode='r')
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    @property
+    def has_label_codes(self) -> bool:
+        return self.label_codes is not None
+
+    def image(self, i: int) -> np.ndarray:
+        """:return: height x width x 1 uint8 view of the buffer"""
+        width = int(self.widths[i])
+        return self.images[self.offsets[i]:self.offsets[i] + self.height * width].reshape([self.height, width, 1])
+
+    def label(self, i: int) -> bytes:
+        return self.label_bytes[self.label_offsets[i]:self.label_offsets[i + 1]].tobytes()
+
+    def codes(self, i: int) -> np.ndarray:
+        return self.label_codes[self.code_offsets[i]:self.code_offsets[i + 1]]
+
+
+class PackedDatasets:
+    """Several packed datasets read as one, examples are addressed by their index in the concatenated datasets"""
+    def __init__(self, index_filenames: List[str]):
+        self.datasets = [PackedDataset(filename) for filename in index_filenames]
+        assert len(self.datasets) > 0, 'No packed dataset'
+        assert len({dataset.height for dataset in self.datasets}) == 1, 'Packed datasets have different heights'
+        self.height = self.datasets[0].height
+        self.has_label_codes = all(dataset.has_label_codes for dataset in self.datasets)
+        self._starts = np.cumsum([0] + [len(dataset) for dataset in self.datasets])
+        # The random padding of the augmentation is in pixels of the images before resizing
+        # (see `data_handler.augment_data`), scale it by the ratio of the packed and source heights
+        if all(dataset.source_heights is not None for dataset in self.datasets):
+            self.padding_scale = float(self.height / np.median(np.concatenate([dataset.source_heights
+                                                                              for dataset in self.datasets])))
+        else:
+            self.padding_scale = 1.0
+
+    def __len__(self) -> int:
+        return int(self._starts[-1])
+
+    def read(self, index: int) -> tuple:
+        """:return: image (h x w x 1 uint8), label (bytes), corpus (int64) and label codes (int64) if packed"""
+        file_index = np.searchsorted(self._starts, index, side='right') - 1
+        dataset, example_index = self.datasets[file_index], index - self._starts[file_index]
+        example = (np.asarray(dataset.image(example_index)), dataset.label(example_index),
+                   np.int64(dataset.corpora[example_index]))
+        if self.has_label_codes:
+            example += (dataset.codes(example_index).astype(np.int64),)
+        return example
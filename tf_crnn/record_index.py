@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+import os
+import json
+import zlib
+import struct
+import argparse
+import threading
+from glob import glob
+from multiprocessing import Pool
+from typing import List, Tuple
+import numpy as np
+import tensorflow as tf
+from .config import Params, CONST, import_params_from_json
+
+INDEX_SUFFIX = '.index.npz'
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+def index_filename(tfrecords_filename: str) -> str:
+    return tfrecords_filename + INDEX_SUFFIX
+
+
+def _read_records(filename: str):
+    """
+    Reads the records of a tfrecords file without checking their crc
+    :return: generator of (offset, length, data), data is None if the file is truncated
+    """
+    with open(filename, 'rb') as f:
+        while True:
+            offset = f.tell()
+            header = f.read(12)  # uint64 length, uint32 crc of the length
+            if not header:
+                return
+            if len(header) < 12:
+                yield offset, 0, None
+                return
+            length = struct.unpack('<Q', header[:8])[0]
+            data = f.read(length)
+            if len(data) < length or len(f.read(4)) < 4:  # data, uint32 crc of the data
+                yield offset, length, None
+                return
+            yield offset, length, data
+
+
+def check_png(image_raw: bytes) -> Tuple[int, int, str]:
+    """
+    Reads the size of a PNG image in its header and checks the crc of its chunks, without decoding it
+    :return: width, height and the error found ('' if none)
+    """
+    if not image_raw.startswith(PNG_SIGNATURE):
+        return 0, 0, 'not a png'
+    position, width, height = len(PNG_SIGNATURE), 0, 0
+    while position + 8 <= len(image_raw):
+        length, chunk_type = struct.unpack('>I4s', image_raw[position:position + 8])
+        chunk_end = position + 8 + length + 4
+        if chunk_end > len(image_raw):
+            return width, height, 'truncated png'
+        chunk_data = image_raw[position + 8:position + 8 + length]
+        if zlib.crc32(chunk_type + chunk_data) != struct.unpack('>I', image_raw[chunk_end - 4:chunk_end])[0]:
+            return width, height, 'bad crc in {} chunk'.format(chunk_type.decode('latin1'))
+        if chunk_type == b'IHDR':
+            width, height = struct.unpack('>II', chunk_data[:8])
+        elif chunk_type == b'IEND':
+            return width, height, '' if width > 0 and height > 0 else 'empty png'
+        position = chunk_end
+    return width, height, 'truncated png'
+
+
+def index_tfrecords_file(filename: str) -> dict:
+    """
+    Scans a tfrecords file and writes its index next to it (`<filename>.index.npz`). For each record, the index
+    holds its offset and length in the file, the size of its image, the length of its label (number of codes if
+    the label is encoded, number of bytes of the label string otherwise, as seen by the model) and its corpus.
+    Corrupt records are flagged with the error found
+    :param filename: tfrecords file
+    :return: the index
+    """
+    columns = {key: list() for key in ['offsets', 'lengths', 'widths', 'heights', 'label_lengths', 'corpora',
+                                       'errors']}
+    for offset, length, data in _read_records(filename):
+        width, height, label_length, corpus, error = 0, 0, 0, -1, ''
+        if data is None:
+            error = 'truncated record'
+        else:
+            try:
+                feature = tf.train.Example.FromString(data).features.feature
+                if 'label_length' in feature:
+                    label_length = feature['label_length'].int64_list.value[0]
+                else:
+                    label_length = len(feature['label'].bytes_list.value[0])
+                corpus = feature['corpus'].int64_list.value[0]
+                width, height, error = check_png(feature['image_raw'].bytes_list.value[0])
+            except Exception as e:
+                error = 'unparsable example ({})'.format(repr(e))
+        if not error and label_length == 0:
+            error = 'empty label'
+        for key, value in zip(['offsets', 'lengths', 'widths', 'heights', 'label_lengths', 'corpora', 'errors'],
+                              [offset, length, width, height, label_length, corpus, error]):
+            columns[key].append(value)
+
+    index = {'offsets': np.array(columns['offsets'], dtype=np.int64),
+             'lengths': np.array(columns['lengths'], dtype=np.int64),
+             'widths': np.array(columns['widths'], dtype=np.int32),
+             'heights': np.array(columns['heights'], dtype=np.int32),
+             'label_lengths': np.array(columns['label_lengths'], dtype=np.int32),
+             'corpora': np.array(columns['corpora'], dtype=np.int64),
+             'errors': np.array(columns['errors'], dtype=np.str_)}
+    with open(index_filename(filename) + '.tmp', 'wb') as f:
+        np.savez(f, **index)
+    os.rename(index_filename(filename) + '.tmp', index_filename(filename))
+    return index
+
+
+def load_record_index(filename: str) -> dict:
+    """Loads the index of a tfrecords file, which must be more recent than the file"""
+    if not os.path.isfile(index_filename(filename)) or \
+            os.path.getmtime(index_filename(filename)) < os.path.getmtime(filename):
+        raise FileNotFoundError('No up to date index for {}, run python -m tf_crnn.record_index'.format(filename))
+    with np.load(index_filename(filename)) as index:
+        return dict(index)
+
+
+def index_tfrecords(files_pattern: str, n_processes: int=None, overwrite: bool=False) -> List[str]:
+    """
+    Indexes the tfrecords files matching the glob expression in parallel (see `index_tfrecords_file`).
+    Files with an up to date index are skipped unless `overwrite`
+    :return: list of the tfrecords files
+    """
+    filenames = sorted(glob(files_pattern))
+    todo = [filename for filename in filenames if overwrite or not os.path.isfile(index_filename(filename))
+            or os.path.getmtime(index_filename(filename)) < os.path.getmtime(filename)]
+    # Only needed by the indexer, the readers of the indices (training, export) do not depend on tqdm
+    from tqdm import tqdm
+    with Pool(n_processes) as pool:
+        for _ in tqdm(pool.imap_unordered(index_tfrecords_file, todo), total=len(todo), unit='file'):
+            pass
+    return filenames
+
+
+def sequence_lengths(index: dict, output_shape: Tuple[int, int], fixed_width: bool=True) -> np.ndarray:
+    """
+    Length of the sequences given to the CTC for each record, computed from the size of the image as
+    `padding_inputs_width` (or `resize_inputs_width` if not `fixed_width`) resizes it (data augmentation aside)
+    """
+    height, max_width = output_shape
+    increment = CONST.DIMENSION_REDUCTION_W_POOLING
+    ratios = index['widths'] / np.maximum(index['heights'], 1)
+    widths = np.round(ratios * height / increment) * increment
+    if fixed_width:
+        widths[widths <= 0] = height
+        widths = np.minimum(widths, max_width)
+    else:
+        widths = np.clip(widths, 2 * increment, max_width)
+    return (widths / increment - 1).astype(np.int32)
+
+
+def usable_records(index: dict, output_shape: Tuple[int, int], fixed_width: bool=True,
+                   keep_long_labels: bool=False) -> np.ndarray:
+    """
+    :param keep_long_labels: only skip the corrupt records, keep those whose label is too long (evaluation)
+    :return: boolean mask of the records which are not corrupt and whose label fits in the CTC sequence
+    """
+    valid = index['errors'] == ''
+    if keep_long_labels:
+        return valid
+    return valid & (index['label_lengths'] <= sequence_lengths(index, output_shape, fixed_width))
+
+
+def plan_bucket_widths(indices: List[dict], output_shape: Tuple[int, int], n_buckets: int,
+                       keep_long_labels: bool=False) -> List[int]:
+    """
+    Chooses the widths of the buckets so that they hold the same number of usable records
+    (see `data_handler.bucket_by_width`), from the indexed image sizes
+    :return: increasing list of bucket widths, the last one is the maximum width
+    """
+    height, max_width = output_shape
+    increment = CONST.DIMENSION_REDUCTION_W_POOLING
+    resized_widths = np.concatenate([(sequence_lengths(index, output_shape, fixed_width=False) + 1) * increment
+                                     for index in indices])
+    resized_widths = resized_widths[np.concatenate([usable_records(index, output_shape, fixed_width=False,
+                                                                   keep_long_labels=keep_long_labels)
+                                                    for index in indices])]
+    if len(resized_widths) == 0:
+        return [max_width]
+    quantiles = np.percentile(resized_widths, np.linspace(0, 100, n_buckets + 1)[1:])
+    widths = np.ceil(quantiles / increment).astype(np.int64) * increment
+    return sorted(set(int(w) for w in np.minimum(widths, max_width)) | {max_width})
+
+
+class ShuffledRecords:
+    """
+    Reads the records of indexed tfrecords files in a random order over all of them, without a shuffle buffer :
+    only the position of each record is kept in memory, 16 bytes per record (int64 offset, int32 length and file),
+    plus 4 bytes per record for each of the (at most two) permutations kept. The permutation of each epoch is drawn
+    from (seed, epoch), so that runs with the same seed see the records in the same order
+    """
+    def __init__(self, filenames: List[str], seed: int=0, keep_masks: List[np.ndarray]=None):
+        """
+        :param filenames: indexed tfrecords files (see `index_tfrecords_file`)
+        :param seed: seed of the permutations
+        :param keep_masks: for each file, boolean mask of the records to read (see `usable_records`), all if None
+        """
+        self.filenames = list(filenames)
+        self.seed = seed
+        file_ids, offsets, lengths = list(), list(), list()
+        for i, filename in enumerate(self.filenames):
+            index = load_record_index(filename)
+            keep = keep_masks[i] if keep_masks is not None else np.ones(len(index['offsets']), dtype=bool)
+            file_ids.append(np.full(np.sum(keep), i, dtype=np.int32))
+            offsets.append(index['offsets'][keep] + 12)  # data after the length and its crc
+            lengths.append(index['lengths'][keep].astype(np.int32))
+        self.file_ids = np.concatenate(file_ids)
+        self.offsets = np.concatenate(offsets)
+        self.lengths = np.concatenate(lengths)
+        assert len(self.offsets) > 0, 'No record to read'
+        self._permutations = dict()
+        self._files = dict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def permutation(self, epoch: int) -> np.ndarray:
+        """:return: order of the records during the epoch"""
+        with self._lock:
+            if epoch not in self._permutations:
+                # Parallel readers are at most at the boundary of two epochs
+                for old_epoch in [e for e in self._permutations if e < epoch - 1]:
+                    del self._permutations[old_epoch]
+                self._permutations[epoch] = np.random.RandomState([self.seed, epoch]).permutation(
+                    len(self)).astype(np.int32)
+            return self._permutations[epoch]
+
+    def _file_descriptor(self, file_id: int) -> int:
+        with self._lock:
+            if file_id not in self._files:
+                self._files[file_id] = os.open(self.filenames[file_id], os.O_RDONLY)
+            return self._files[file_id]
+
+    def locate(self, position: int) -> dict:
+        """:return: epoch, file and offset of the record read at `position`"""
+        epoch, i = divmod(int(position), len(self))
+        record = self.permutation(epoch)[i]
+        return {'position': int(position), 'epoch': epoch, 'seed': self.seed,
+                'file': self.filenames[self.file_ids[record]], 'offset': int(self.offsets[record]) - 12}
+
+    def read(self, position: int) -> bytes:
+        """:return: serialized example read at `position` (counted from the first record of epoch 0)"""
+        epoch, i = divmod(int(position), len(self))
+        record = self.permutation(epoch)[i]
+        return os.pread(self._file_descriptor(self.file_ids[record]), int(self.lengths[record]),
+                        int(self.offsets[record]))
+
+    def close(self):
+        with self._lock:
+            for fd in self._files.values():
+                os.close(fd)
+            self._files = dict()
+
+
+def index_report(filenames: List[str], output_shape: Tuple[int, int], fixed_width: bool=True) -> dict:
+    """Summary of the indices of tfrecords files : corrupt records, labels too long, sizes and corpora"""
+    indices = [load_record_index(filename) for filename in filenames]
+    errors = np.concatenate([index['errors'] for index in indices])
+    valid = errors == ''
+    corpora = np.concatenate([index['corpora'] for index in indices])[valid]
+    too_long = np.concatenate([index['label_lengths'] > sequence_lengths(index, output_shape, fixed_width)
+                               for index in indices]) & valid
+
+    def percentiles(values):
+        return {p: float(np.percentile(values, p)) for p in [0, 50, 90, 99, 100]} if len(values) else None
+
+    corpus_ids, corpus_counts = np.unique(corpora, return_counts=True)
+    return {'n_records': int(len(errors)),
+            'n_corrupt': int(np.sum(~valid)),
+            'corrupt_records': [{'file': filename, 'offset': int(offset), 'error': str(error)}
+                                for filename, index in zip(filenames, indices)
+                                for offset, error in zip(index['offsets'], index['errors']) if error],
+            'n_labels_too_long': int(np.sum(too_long)),
+            'corpus_counts': {int(c): int(n) for c, n in zip(corpus_ids, corpus_counts)},
+            'widths': percentiles(np.concatenate([index['widths'] for index in indices])[valid]),
+            'heights': percentiles(np.concatenate([index['heights'] for index in indices])[valid]),
+            'label_lengths': percentiles(np.concatenate([index['label_lengths'] for index in indices])[valid])}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Indexes the tfrecords files of tfrecords_train and tfrecords_eval '
+                                                 '(image sizes, label lengths, corpora, corrupt records)')
+    parser.add_argument('params_file', type=str, help='Parameters filename (JSON)')
+    parser.add_argument('-j', '--n_processes', type=int, help='Number of processes (default : number of cpus)')
+    parser.add_argument('--overwrite', action='store_true', help='Index again the files with an up to date index')
+    parser.add_argument('--report', type=str, help='JSON file to write the report to')
+    args = parser.parse_args()
+
+    parameters = Params(**import_params_from_json(json_filename=args.params_file))
+    fixed_width = parameters.bucket_width_step is None
+
+    report = dict()
+    for name, files_pattern in [('train', parameters.tfrecords_train), ('eval', parameters.tfrecords_eval)]:
+        filenames = index_tfrecords(files_pattern, args.n_processes, args.overwrite)
+        report[name] = index_report(filenames, parameters.input_shape, fixed_width)
+        print('[{}] {n_records} records, {n_corrupt} corrupt, {n_labels_too_long} with a label longer than the '
+              'sequence length, corpora {corpus_counts}'.format(name, **report[name]))
+
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=2)
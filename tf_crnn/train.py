@@ -9,10 +9,13 @@ except ImportError:
     pass
 import tensorflow as tf
 from .model import crnn_fn
-from .data_handler import make_input_fn
+from .data_handler import make_input_fn, saved_input_position
 from .data_handler import preprocess_image_for_prediction
 
 from .config import Params, import_params_from_json
+from .autotune import autotune_input_pipeline
+from .elastic_helpers import DistortionFieldBank
+from .checkpoints import BestCheckpointKeeper, InputStateListener
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Train the model according to the specified config in the JSON. '
@@ -32,8 +35,13 @@ if __name__ == '__main__':
         'Params': parameters,
     }
 
+    # Parallelism parameters of the input pipeline set to 'auto' are chosen by probing the host
+    if parameters.autotune_required:
+        parameters.input_pipeline_autotune = autotune_input_pipeline(parameters)
+        print('Autotuned input pipeline :', parameters.input_pipeline_autotune['values'])
+
     # The parameters are saved in the output_dir to keep their most recent copy,
-    # including the overriding command line arguments
+    # including the overriding command line arguments and the autotuned input pipeline
     parameters.export_experiment_params()
 
     os.environ['CUDA_VISIBLE_DEVICES'] = parameters.gpu
@@ -41,9 +49,16 @@ if __name__ == '__main__':
     config_sess.gpu_options.allow_growth = True
 
 
+    # Bank of displacement fields for the elastic distortion, kept during the whole training
+    distortion_bank = None
+    if parameters.dynamic_distortion and parameters.distortion_bank_size > 0:
+        distortion_bank = DistortionFieldBank(parameters.distortion_bank_size, *parameters.input_shape)
+        if parameters.distortion_bank_refresh_secs:
+            distortion_bank.start_refresh(parameters.distortion_bank_refresh_secs)
+
     # Config estimator
     est_config = tf.estimator.RunConfig().replace(
-        keep_checkpoint_max=200,
+        keep_checkpoint_max=1,  # the best checkpoints are copied by the checkpoint keeper
         save_checkpoints_steps=parameters.save_interval,
         session_config=config_sess,
         save_checkpoints_secs=None,
@@ -57,31 +72,82 @@ if __name__ == '__main__':
                                        config=est_config
                                        )
 
+    # Keeps the best evaluated checkpoints, new best ones are exported in the background
+    checkpoint_keeper = BestCheckpointKeeper(
+        parameters.output_model_dir,
+        k=parameters.keep_best_checkpoints,
+        metric=parameters.best_checkpoint_metric,
+        export_fn=lambda checkpoint_path: estimator.export_savedmodel(
+            os.path.join(parameters.output_model_dir, 'export'),
+            preprocess_image_for_prediction(fixed_height=parameters.input_shape[0], min_width=10),
+            checkpoint_path=checkpoint_path))
+
+    # With the global shuffle, a restarted training resumes at the position of the input saved in the last checkpoint
+    global_shuffle = parameters.shuffle_mode == 'global'
+    resume_position = saved_input_position(parameters.output_model_dir) if global_shuffle else None
+
     try:
         for e in range(0, parameters.n_epochs):
-            estimator.train(input_fn=make_input_fn(parameters.tfrecords_train,
-                                                   parameters.train_batch_size,
-                                                   parameters.input_shape,
-                                                   dynamic_distortion=parameters.dynamic_distortion,
-                                                   repeat=False),
-
-                            )
+            train_input_fn = make_input_fn(parameters.tfrecords_train,
+                                           parameters.train_batch_size,
+                                           parameters.input_shape,
+                                           dynamic_distortion=parameters.dynamic_distortion,
+                                           repeat=False,
+                                           bucket_width_step=parameters.bucket_width_step,
+                                           pixel_budget=parameters.batch_pixel_budget,
+                                           data_augmentation=parameters.data_augmentation,
+                                           vectorized=parameters.vectorized_input,
+                                           encoded_labels=parameters.encoded_labels,
+                                           uint8_images=parameters.uint8_images,
+                                           packed=parameters.packed_input,
+                                           record_index=parameters.use_record_index,
+                                           drop_infeasible=parameters.drop_ctc_infeasible,
+                                           global_shuffle=global_shuffle,
+                                           seed=parameters.shuffle_seed,
+                                           first_epoch=e,
+                                           resume_position=resume_position,
+                                           distortion_bank=distortion_bank,
+                                           **parameters.input_pipeline_params)
+            if global_shuffle:
+                start, end = train_input_fn.input_range
+                if start >= end:
+                    print('Epoch {} already done'.format(e))
+                    continue
+            try:
+                estimator.train(input_fn=train_input_fn,
+                                saving_listeners=[InputStateListener(parameters.output_model_dir,
+                                                                     train_input_fn.shuffled_records)]
+                                if global_shuffle else None
+                                )
+            finally:
+                # The input_fn of each epoch opens the train files again
+                if global_shuffle:
+                    train_input_fn.shuffled_records.close()
             print('Train done')
-            estimator.evaluate(input_fn=make_input_fn(parameters.tfrecords_eval,
+            eval_results = estimator.evaluate(input_fn=make_input_fn(parameters.tfrecords_eval,
                                                       parameters.eval_batch_size,
                                                       parameters.input_shape,
                                                       dynamic_distortion=False,
-                                                      repeat=False)
+                                                      repeat=False,
+                                                      bucket_width_step=parameters.bucket_width_step,
+                                                      data_augmentation=False,
+                                                      shuffle=False,
+                                                      vectorized=parameters.vectorized_input,
+                                                      encoded_labels=parameters.encoded_labels,
+                                                      uint8_images=parameters.uint8_images,
+                                                      packed=parameters.packed_input,
+                                                      record_index=parameters.use_record_index,
+                                                      keep_long_labels=True,
+                                                      cache=parameters.eval_cache,
+                                                      **parameters.input_pipeline_params)
                                )
             print('Eval done')
 
-
-            estimator.export_savedmodel(os.path.join(parameters.output_model_dir, 'export'),
-                                preprocess_image_for_prediction(fixed_height=parameters.input_shape[0], min_width=10))
+            checkpoint_keeper.update(tf.train.latest_checkpoint(parameters.output_model_dir), eval_results)
 
     except KeyboardInterrupt:
         print('Interrupted')
 
-    estimator.export_savedmodel(os.path.join(parameters.output_model_dir, 'export'),
-                                preprocess_image_for_prediction(fixed_height=parameters.input_shape[0], min_width=10))
-    print('Exported model to {}'.format(os.path.join(parameters.output_model_dir, 'export')))
+    # Waits for the export of the last best checkpoint
+    checkpoint_keeper.close()
+    print('Best checkpoint : {}'.format(checkpoint_keeper.best_checkpoint))
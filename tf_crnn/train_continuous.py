@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+import os
+import copy
+import json
+import time
+import argparse
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import partial
+try:
+    import better_exceptions
+except ImportError:
+    pass
+import tensorflow as tf
+from .model import crnn_fn
+from .data_handler import make_input_fn, preprocess_image_for_prediction, saved_input_position
+from .config import Params, CONST, import_params_from_json
+from .autotune import autotune_input_pipeline
+from .elastic_helpers import DistortionFieldBank
+from .checkpoints import BestCheckpointKeeper, InputStateListener
+
+
+class PhaseTimer:
+    """
+    Accumulates the wall time spent in named phases, each one belonging to a category ('setup', 'compute'...).
+    Phases can be nested, the time of a nested phase is not counted in the enclosing one
+    """
+    def __init__(self):
+        self.totals = OrderedDict()
+        self.categories = dict()
+        self._stack = list()
+
+    def start(self, phase: str, category: str) -> None:
+        self.categories[phase] = category
+        self._stack.append([phase, time.perf_counter(), 0.])
+
+    def stop(self) -> None:
+        phase, start, nested = self._stack.pop()
+        elapsed = time.perf_counter() - start
+        self.totals[phase] = self.totals.get(phase, 0.) + elapsed - nested
+        if self._stack:
+            self._stack[-1][2] += elapsed
+
+    @contextmanager
+    def phase(self, phase: str, category: str):
+        self.start(phase, category)
+        try:
+            yield
+        finally:
+            self.stop()
+
+    def report(self) -> dict:
+        """:return: dict with the seconds spent per phase and per category"""
+        per_category = OrderedDict()
+        for phase, seconds in self.totals.items():
+            per_category[self.categories[phase]] = per_category.get(self.categories[phase], 0.) + seconds
+        return {'phases_secs': self.totals, 'categories_secs': per_category}
+
+
+def train_input_fn(parameters: Params, distortion_bank: DistortionFieldBank=None):
+    """
+    Input function going n_epochs times through the training set. With the global shuffle, it resumes at the
+    position of the input saved in the last checkpoint
+    """
+    global_shuffle = parameters.shuffle_mode == 'global'
+    return make_input_fn(parameters.tfrecords_train,
+                         parameters.train_batch_size,
+                         parameters.input_shape,
+                         dynamic_distortion=parameters.dynamic_distortion,
+                         repeat=parameters.n_epochs,
+                         bucket_width_step=parameters.bucket_width_step,
+                         pixel_budget=parameters.batch_pixel_budget,
+                         data_augmentation=parameters.data_augmentation,
+                         vectorized=parameters.vectorized_input,
+                         encoded_labels=parameters.encoded_labels,
+                         uint8_images=parameters.uint8_images,
+                         packed=parameters.packed_input,
+                         record_index=parameters.use_record_index,
+                         drop_infeasible=parameters.drop_ctc_infeasible,
+                         global_shuffle=global_shuffle,
+                         seed=parameters.shuffle_seed,
+                         resume_position=saved_input_position(parameters.output_model_dir) if global_shuffle else None,
+                         distortion_bank=distortion_bank,
+                         **parameters.input_pipeline_params)
+
+
+def eval_input_fn(parameters: Params):
+    """Input function going once through the evaluation set each time its iterator is initialized"""
+    return make_input_fn(parameters.tfrecords_eval,
+                         parameters.eval_batch_size,
+                         parameters.input_shape,
+                         dynamic_distortion=False,
+                         repeat=False,
+                         bucket_width_step=parameters.bucket_width_step,
+                         data_augmentation=False,
+                         shuffle=False,
+                         vectorized=parameters.vectorized_input,
+                         encoded_labels=parameters.encoded_labels,
+                         uint8_images=parameters.uint8_images,
+                         packed=parameters.packed_input,
+                         record_index=parameters.use_record_index,
+                         keep_long_labels=True,
+                         cache=parameters.eval_cache,
+                         initializable=True,
+                         **parameters.input_pipeline_params)
+
+
+class Evaluator:
+    """
+    Evaluation graph and session built once. Each evaluation restores a checkpoint, re-initializes
+    the input iterator and the metrics and goes through the whole evaluation set
+    """
+    def __init__(self, parameters: Params, session_config: tf.ConfigProto, timer: PhaseTimer):
+        """
+        :param parameters: parameters of the experiment
+        :param session_config: configuration of the evaluation session
+        :param timer: timer accounting for the setup and compute time of the evaluations
+        """
+        self.timer = timer
+        self.last_checkpoint = None
+        with self.timer.phase('eval_setup', 'setup'):
+            self.graph = tf.Graph()
+            with self.graph.as_default():
+                features, labels = eval_input_fn(parameters)()
+                # crnn_fn sets the dropout of the parameters it gets to 1 outside of training
+                spec = crnn_fn(features, labels, tf.estimator.ModeKeys.EVAL, {'Params': copy.copy(parameters)})
+                self.metrics = {name: value for name, (value, _) in spec.eval_metric_ops.items()}
+                self.update_op = tf.group(*[update for _, update in spec.eval_metric_ops.values()])
+                self.global_step = tf.train.get_global_step()
+                self.reset_op = tf.group(tf.local_variables_initializer(),
+                                         *tf.get_collection(CONST.INPUT_INITIALIZERS))
+                self.saver = tf.train.Saver()
+                tables_init = tf.tables_initializer()
+            self.graph.finalize()
+
+            self.session = tf.Session(graph=self.graph, config=session_config)
+            self.session.run(tables_init)
+            self.summary_writer = tf.summary.FileWriter(os.path.join(parameters.output_model_dir, 'eval'))
+
+    def evaluate(self, checkpoint_path: str) -> dict:
+        """
+        :param checkpoint_path: checkpoint to evaluate
+        :return: dict of the metrics values and the global step of the checkpoint
+        """
+        if checkpoint_path == self.last_checkpoint:
+            return None
+        self.last_checkpoint = checkpoint_path
+
+        with self.timer.phase('eval_restore', 'setup'):
+            self.saver.restore(self.session, checkpoint_path)
+            self.session.run(self.reset_op)
+
+        with self.timer.phase('eval_compute', 'compute'):
+            while True:
+                try:
+                    self.session.run(self.update_op)
+                except tf.errors.OutOfRangeError:
+                    break
+            results, global_step = self.session.run([self.metrics, self.global_step])
+
+        summary = tf.Summary(value=[tf.Summary.Value(tag=name, simple_value=value) for name, value in results.items()])
+        self.summary_writer.add_summary(summary, global_step)
+        self.summary_writer.flush()
+        results['global_step'] = int(global_step)
+        print('Eval done :', results)
+        return results
+
+    def close(self) -> None:
+        self.summary_writer.close()
+        self.session.close()
+
+
+class EvaluationListener(tf.train.CheckpointSaverListener):
+    """
+    Times the checkpoint saves and evaluates each new checkpoint (if an evaluator is given),
+    the best ones are kept and exported by the checkpoint keeper
+    """
+    def __init__(self, model_dir: str, timer: PhaseTimer, evaluator: Evaluator=None,
+                 checkpoint_keeper: BestCheckpointKeeper=None):
+        self.model_dir = model_dir
+        self.timer = timer
+        self.evaluator = evaluator
+        self.checkpoint_keeper = checkpoint_keeper
+
+    def before_save(self, session, global_step_value):
+        self.timer.start('checkpoint_save', 'checkpoint')
+
+    def after_save(self, session, global_step_value):
+        self.timer.stop()
+        if self.evaluator is not None:
+            checkpoint = tf.train.latest_checkpoint(self.model_dir)
+            results = self.evaluator.evaluate(checkpoint)
+            if results is not None and self.checkpoint_keeper is not None:
+                with self.timer.phase('best_checkpoint_copy', 'checkpoint'):
+                    self.checkpoint_keeper.update(checkpoint, results)
+
+
+def train_and_evaluate(parameters: Params, session_config: tf.ConfigProto, timer: PhaseTimer,
+                       distortion_bank: DistortionFieldBank=None,
+                       checkpoint_keeper: BestCheckpointKeeper=None) -> None:
+    """
+    Trains for n_epochs with a single training graph and session. Checkpoints are saved every save_interval
+    steps (or save_interval_secs seconds) and evaluated in the same process if eval_mode is 'in_process'
+    :param parameters: parameters of the experiment
+    :param session_config: configuration of the training and evaluation sessions
+    :param timer: timer accounting for the setup and compute time
+    :param distortion_bank: DistortionFieldBank to sample the elastic distortions from
+    :param checkpoint_keeper: keeper of the best evaluated checkpoints (the training only keeps the most recent one)
+    """
+    with timer.phase('train_setup', 'setup'):
+        graph = tf.Graph()
+        with graph.as_default():
+            input_fn = train_input_fn(parameters, distortion_bank)
+            features, labels = input_fn()
+            spec = crnn_fn(features, labels, tf.estimator.ModeKeys.TRAIN, {'Params': parameters})
+            tf.add_to_collection(tf.GraphKeys.SAVERS, tf.train.Saver(sharded=True, max_to_keep=1))
+
+        # Built after the training graph, which must get the training dropout
+        evaluator = Evaluator(parameters, session_config, timer) if parameters.eval_mode == 'in_process' else None
+
+        with graph.as_default():
+            listener = EvaluationListener(parameters.output_model_dir, timer, evaluator, checkpoint_keeper)
+            saver_hook = tf.train.CheckpointSaverHook(
+                parameters.output_model_dir,
+                save_secs=parameters.save_interval_secs,
+                save_steps=None if parameters.save_interval_secs else int(parameters.save_interval),
+                scaffold=spec.scaffold,
+                listeners=[listener] + ([InputStateListener(parameters.output_model_dir, input_fn.shuffled_records)]
+                                        if input_fn.shuffled_records is not None else []))
+            session = tf.train.MonitoredTrainingSession(checkpoint_dir=parameters.output_model_dir,
+                                                        scaffold=spec.scaffold,
+                                                        hooks=list(spec.training_hooks),
+                                                        chief_only_hooks=[saver_hook],
+                                                        save_checkpoint_secs=None,
+                                                        save_summaries_steps=2000,
+                                                        config=session_config)
+
+    # The last checkpoint is saved and evaluated when the session is closed
+    with timer.phase('train_compute', 'compute'):
+        with session:
+            try:
+                while not session.should_stop():
+                    session.run(spec.train_op)
+            except KeyboardInterrupt:
+                print('Interrupted')
+    print('Train done')
+
+    if evaluator is not None:
+        evaluator.close()
+
+
+def export_model(parameters: Params, session_config: tf.ConfigProto, checkpoint_path: str=None) -> str:
+    """Exports the model of the given checkpoint (defaults to the latest one) as a SavedModel"""
+    estimator = tf.estimator.Estimator(model_fn=crnn_fn,
+                                       params={'Params': parameters},
+                                       model_dir=parameters.output_model_dir,
+                                       config=tf.estimator.RunConfig().replace(session_config=session_config))
+    export_dir = os.path.join(parameters.output_model_dir, 'export')
+    return estimator.export_savedmodel(export_dir,
+                                       preprocess_image_for_prediction(fixed_height=parameters.input_shape[0],
+                                                                       min_width=10),
+                                       checkpoint_path=checkpoint_path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Train the model according to the specified config in the JSON, '
+                                     'building the training and evaluation graphs only once. '
+                                     'The optional arguments override the ones from the file.')
+    parser.add_argument('params_file',              type=str, help='Parameters filename (JSON)')
+    parser.add_argument('-o', '--output_model_dir', type=str, required=False, help='Directory for output')
+    parser.add_argument('-n', '--n_epochs',         type=int, required=False, help='Number of epochs')
+    parser.add_argument('-g', '--gpu',              type=str, required=False, help="GPU 0,1 or '' ")
+    parser.add_argument('--evaluator', action='store_true',
+                        help="Only evaluate the checkpoints of output_model_dir as they are written "
+                             "(side process of a training with eval_mode 'side_process')")
+    parser.add_argument('--timeout', type=int, default=3600,
+                        help='Evaluator : seconds to wait for a new checkpoint before stopping')
+    args = vars(parser.parse_args())
+    evaluator_only, timeout = args.pop('evaluator'), args.pop('timeout')
+    args = dict(filter(lambda kv: kv[1] is not None, args.items()))
+
+    dict_params = import_params_from_json(json_filename=args.get('params_file'))
+    dict_params.update(args)
+    parameters = Params(**dict_params)
+
+    timer = PhaseTimer()
+    with timer.phase('autotune', 'setup'):
+        if parameters.autotune_required:
+            parameters.input_pipeline_autotune = autotune_input_pipeline(parameters)
+            print('Autotuned input pipeline :', parameters.input_pipeline_autotune['values'])
+
+    os.environ['CUDA_VISIBLE_DEVICES'] = parameters.gpu
+    config_sess = tf.ConfigProto()
+    config_sess.gpu_options.allow_growth = True
+
+    # The best checkpoints are kept by the process evaluating them, which exports them in the background
+    checkpoint_keeper = BestCheckpointKeeper(parameters.output_model_dir,
+                                             k=parameters.keep_best_checkpoints,
+                                             metric=parameters.best_checkpoint_metric,
+                                             export_fn=partial(export_model, parameters, config_sess))
+
+    if evaluator_only:
+        evaluator = Evaluator(parameters, config_sess, timer)
+        for checkpoint in tf.contrib.training.checkpoints_iterator(parameters.output_model_dir, timeout=timeout):
+            # The training only keeps its latest checkpoint, copy it before it gets deleted
+            with timer.phase('best_checkpoint_copy', 'checkpoint'):
+                try:
+                    staged_checkpoint = checkpoint_keeper.stage(checkpoint)
+                except FileNotFoundError:
+                    continue
+            try:
+                results = evaluator.evaluate(staged_checkpoint)
+            except tf.errors.NotFoundError:
+                continue  # deleted by the training while being staged
+            with timer.phase('best_checkpoint_copy', 'checkpoint'):
+                checkpoint_keeper.update(staged_checkpoint, results)
+        evaluator.close()
+    else:
+        parameters.export_experiment_params()
+
+        distortion_bank = None
+        if parameters.dynamic_distortion and parameters.distortion_bank_size > 0:
+            with timer.phase('distortion_bank', 'setup'):
+                distortion_bank = DistortionFieldBank(parameters.distortion_bank_size, *parameters.input_shape)
+            if parameters.distortion_bank_refresh_secs:
+                distortion_bank.start_refresh(parameters.distortion_bank_refresh_secs)
+
+        train_and_evaluate(parameters, config_sess, timer, distortion_bank,
+                           checkpoint_keeper if parameters.eval_mode == 'in_process' else None)
+
+    with timer.phase('wait_exports', 'export'):
+        checkpoint_keeper.close()
+
+    report = timer.report()
+    print('Time per category (s) :', dict(report['categories_secs']))
+    print('Time per phase (s) :', dict(report['phases_secs']))
+    report_filename = os.path.join(parameters.output_model_dir, 'timing{}_{}.json'.format(
+        '_evaluator' if evaluator_only else '', round(time.time())))
+    with open(report_filename, 'w') as f:
+        json.dump(report, f, indent=2)